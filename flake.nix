@@ -320,11 +320,45 @@
           program = "${self.packages.${system}.selenium-scenarios}/bin/registration";
           type = "app";
         };
+
+        # Runs a JSON list of the above scenarios on a shared pool of browsers.
+        run-scenarios = {
+          program = "${self.packages.${system}.selenium-scenarios}/bin/run-scenarios";
+          type = "app";
+        };
+
+        # Runs concurrent HTTP sessions of virtual users against a forum and
+        # reports the latency of every step (see ./tests/load).
+        load-test = {
+          program = "${self.packages.${system}.selenium-scenarios}/bin/load-test";
+          type = "app";
+        };
       };
 
 
       checks.${system} = {
         basic = import ./tests/basic/setup.nix { inherit self pkgs; };
+        load = import ./tests/load/setup.nix { inherit self pkgs; };
+
+        # Unit tests of the pure Python parts of the packages, which run in
+        # seconds, without virtual machines.
+        selenium-scenarios-unit = pkgs.runCommand "selenium-scenarios-unit" { nativeBuildInputs = [ pkgs.python3 ]; } ''
+          cd ${./packages/selenium-scenarios}
+          PYTHONDONTWRITEBYTECODE=1 python -m unittest -v test_thresholds
+          touch $out
+        '';
+        # The applier against the fake Discourse API (see
+        # ./packages/applier/conftest.py), with both of its transports.
+        applier-unit = pkgs.runCommand "applier-unit"
+          {
+            nativeBuildInputs = [
+              (pkgs.python3.withPackages (ps: with ps; [ pytest requests requests-unixsocket ]))
+            ];
+          } ''
+          cd ${./packages/applier}
+          PYTHONDONTWRITEBYTECODE=1 python -m pytest -v -p no:cacheprovider
+          touch $out
+        '';
       };
 
       devShells.${system}.default = pkgs.mkShell {
@@ -332,6 +366,7 @@
           pkgs.nixd
           pkgs.python3Packages.python-lsp-server
           pkgs.python3Packages.yapf
+          pkgs.python3Packages.pytest
           self.packages.${system}.selenium-scenarios
           self.packages.${system}.applier
         ];
@@ -3,7 +3,8 @@
 in
 {
   options = {
-    # This module provides a way to configure Discourse groups using Nix
+    # This module provides a way to configure Discourse groups (and other
+    # entities, such as categories) using Nix
     # It's an alternative solution to configuring entities such as groups
     # using the admin panel UI in Discourse.
     # The main advantage of this approach is that it allows to have a single
@@ -28,7 +29,11 @@ in
           usernames = mkOption {
             type = with types; nullOr (listOf str);
             default = null;
-            description = "The usernames of the group.";
+            description = ''
+              The usernames of the group members. Members that are not listed
+              here are removed from the group. If null, the membership is not
+              managed.
+            '';
           };
           owner_usernames = mkOption {
             type = with types; nullOr (listOf str);
@@ -80,15 +85,124 @@ in
 
       default = { };
     };
+
+    # Permissions granted by categories and tag groups. Attribute names are
+    # either identifiers of the groups defined in `services.discourse.groups`
+    # or names of groups that are not managed by Nix (e.g. `everyone`,
+    # `staff`). Categories and tag groups referencing groups defined in Nix
+    # are applied after those groups.
+    services.discourse.categories = mkOption {
+      type = types.attrsOf (types.submodule (args: {
+        options = {
+          name = mkOption {
+            type = types.str;
+            description = "The name of the category.";
+          };
+          slug = mkOption {
+            type = with types; nullOr str;
+            default = null;
+            description = "The slug of the category (derived from the name if null).";
+          };
+          color = mkOption {
+            type = types.str;
+            default = "0088CC";
+            description = "Background color of the category badge (hex, without #).";
+          };
+          text_color = mkOption {
+            type = types.str;
+            default = "FFFFFF";
+            description = "Text color of the category badge (hex, without #).";
+          };
+          parent = mkOption {
+            type = with types; nullOr str;
+            default = null;
+            description = "Identifier of the parent category (an attribute name of `services.discourse.categories`).";
+          };
+          permissions = mkOption {
+            type = types.attrsOf (types.enum [ "full" "create_post" "readonly" ]);
+            default = { };
+            description = "Permissions granted to groups. If empty, the category is public.";
+          };
+        };
+      }));
+
+      default = { };
+    };
+
+    services.discourse.tagGroups = mkOption {
+      type = types.attrsOf (types.submodule (args: {
+        options = {
+          name = mkOption {
+            type = types.str;
+            description = "The name of the tag group.";
+          };
+          tags = mkOption {
+            type = types.listOf types.str;
+            default = [ ];
+            description = "Tags belonging to the tag group.";
+          };
+          one_per_topic = mkOption {
+            type = types.bool;
+            default = false;
+            description = "Limit topics to one tag from this group.";
+          };
+          permissions = mkOption {
+            type = types.attrsOf (types.enum [ "full" "readonly" ]);
+            default = { everyone = "full"; };
+            description = "Permissions granted to groups.";
+          };
+        };
+      }));
+
+      default = { };
+    };
+
+    # Unlike `services.discourse.siteSettings`, which are applied by the
+    # upstream module, these settings are applied through the API by the
+    # `applier`, along with the rest of the entities defined here.
+    services.discourse.apiSiteSettings = mkOption {
+      type = with types; attrsOf (oneOf [ bool int str ]);
+      default = { };
+      description = "Site settings applied through the API, by setting name.";
+    };
+
+    # By default the configuration is applied once, when Discourse starts.
+    # The daemon applies it whenever it changes (e.g. after `nixos-rebuild
+    # switch`), without restarting Discourse.
+    services.discourse.applierDaemon.enable = mkEnableOption "the applier daemon, applying configuration changes as soon as they are made";
+
+    # Without it, groups removed from `services.discourse.groups` stay in
+    # Discourse. Automatic groups and groups that existed before they were
+    # defined here are never deleted.
+    services.discourse.applierPrune.enable = mkEnableOption "deleting the groups created by the applier once they are removed from the configuration";
+
+    # Changes made in the admin panel are corrected only when the
+    # configuration changes. The drift check only reports them: the report is
+    # written to /var/lib/discourse/api/drift.json and the check service fails
+    # if anything drifted.
+    services.discourse.applierDrift = {
+      enable = mkEnableOption "periodic checks of whether the entities managed by the applier were changed outside of it";
+      interval = mkOption {
+        type = types.str;
+        default = "5min";
+        example = "1h";
+        description = "Time between the drift checks, in the systemd.time(7) format.";
+      };
+    };
   };
 
   # This is an implementation part of this module.
   # Summary of what is done here:
-  # 1. Convert the `config.services.discourse.groups` value defined by the user
-  # of this module (flakes.nix) to the format that is easier to push into the
-  # Discourse API.
-  # 2. Setup the `applier` (defined as a package in flake.nix) so that it runs
-  # after Discourse is started to apply the desired group configuration.
+  # 1. Convert the `config.services.discourse.groups` (and `categories`,
+  # `tagGroups`, `apiSiteSettings`) values defined by the user of this module
+  # (flakes.nix) to the format that is easier to push into the Discourse API.
+  # 2. Validate and compile that configuration when the system is built.
+  # 3. Setup the `applier` (defined as a package in flake.nix) so that it runs
+  # after Discourse is started to apply the desired configuration.
+  # 4. Optionally run the `applier` daemon, which applies the configuration
+  # again whenever it changes.
+  # 5. Optionally check periodically whether the applied configuration
+  # drifted.
   config =
     let
       # Convert visibility level expressed as a string to an integer.
@@ -123,36 +237,62 @@ in
           # Merging attribute sets with // was chosen because it allows to
           # define an attribute conditionally.
           # Format used by those attributes can be seen here: https://docs.discourse.org/#tag/Groups/operation/createGroup
-          usernames = optionalConcated "usernames" group.usernames ",";
+          # The only exception are `usernames`, which are kept as a list. The
+          # `applier` synchronizes the membership separately from the rest of
+          # the group, adding and removing only the members that differ.
+          usernames = optionalAttrs (group.usernames != null) { inherit (group) usernames; };
           owner_usernames = optionalConcated "owner_usernames" group.owner_usernames ",";
           automatic_membership_email_domains = optionalConcated "automatic_membership_email_domains" group.automatic_membership_email_domains "|";
         in
         base // usernames // owner_usernames // automatic_membership_email_domains;
+      # Convert the permissions of a category or a tag group to a list of
+      # objects referencing either a group defined in Nix (by its attribute
+      # name) or a group that is not managed by Nix (by its name).
+      # full: 1, create_post: 2, readonly: 3
+      permissionsToApiFormat = permissions: mapAttrsToList
+        (group: level:
+          let
+            permission_type = { full = 1; create_post = 2; readonly = 3; }.${level};
+          in
+          if cfg.groups ? ${group}
+          then { inherit group permission_type; }
+          else { group_name = group; inherit permission_type; })
+        permissions;
+      categoryToApiFormat = category:
+        {
+          inherit (category) name color text_color parent;
+          permissions = permissionsToApiFormat category.permissions;
+        } // optionalAttrs (category.slug != null) { inherit (category) slug; };
+      tagGroupToApiFormat = tagGroup: {
+        inherit (tagGroup) name one_per_topic;
+        tag_names = tagGroup.tags;
+        permissions = permissionsToApiFormat tagGroup.permissions;
+      };
       # Aggregated set of all groups defined by the user of this module.
       groupsSpecificationInApiFormat = mapAttrs (_: groupSpecification: groupToApiFormat groupSpecification) cfg.groups;
       # `applier` expects a JSON file with the following format:
       configInApiFormat = {
         groups = groupsSpecificationInApiFormat;
+        categories = mapAttrs (_: categoryToApiFormat) cfg.categories;
+        tag_groups = mapAttrs (_: tagGroupToApiFormat) cfg.tagGroups;
+        site_settings = cfg.apiSiteSettings;
       };
-      configFile = builtins.toFile "desired.json" (builtins.toJSON configInApiFormat);
-      # Helper script to wait for Discourse to start.
-      waitForDiscourse = pkgs.writeScriptBin "wait-for-discourse" ''
-        timeout=$1
-        start_time=$(date +%s)
-
-        echo "Waiting for Discourse to start..."
-        while [ ! -S /run/discourse/sockets/unicorn.sock ]; do
-          current_time=$(date +%s)
-          elapsed_time=$((current_time - start_time))
-
-          if [ $elapsed_time -ge $timeout ]; then
-            echo "Timeout: Discourse did not start within $timeout seconds."
-            exit 1
-          fi
-
-          sleep 1;
-        done
+      plainConfigFile = builtins.toFile "desired-plain.json" (builtins.toJSON configInApiFormat);
+      # The config is validated when the system is built, so that mistakes in
+      # it fail the build instead of the start of Discourse. The compiled
+      # config has the hashes and the order of the entities computed already
+      # (see ../packages/applier/artifact.py), so the applier does not derive
+      # them on every start.
+      configFile = pkgs.runCommand "desired.json" { } ''
+        ${pkgs.applier}/bin/applier compile ${plainConfigFile} $out
       '';
+      pruneFlag = optionalString cfg.applierPrune.enable "--prune";
+      # With the daemon, the config is read from a path that does not change
+      # between generations, so that the text of `discourse.service` does not
+      # depend on the config and editing it does not restart Discourse (the
+      # daemon applies the changes instead).
+      appliedConfigFile =
+        if cfg.applierDaemon.enable then "/etc/discourse/applier.json" else configFile;
     in
     mkIf cfg.enable {
       # Easiest way to run the `applier` is to add it as a `postStart` of the
@@ -164,7 +304,7 @@ in
           set -o errexit -o pipefail -o nounset -o errtrace
           shopt -s inherit_errexit
 
-          cat ${configFile}
+          ${optionalString (!cfg.applierDaemon.enable) "cat ${plainConfigFile}"}
 
           if [[ ! -e /var/lib/discourse/api/key ]]; then
             echo "Creating master API key..."
@@ -176,9 +316,66 @@ in
           export DISCOURSE_API_KEY
           echo "Loaded master API key."
 
-          ${waitForDiscourse}/bin/wait-for-discourse 60
-          ${pkgs.applier}/bin/applier http://localhost ${configFile} /var/lib/discourse/api --unix-socket /run/discourse/sockets/unicorn.sock --loglevel debug
+          # Returns as soon as Discourse responds through its socket.
+          ${pkgs.applier}/bin/applier wait /run/discourse/sockets/unicorn.sock --timeout 60
+          ${pkgs.applier}/bin/applier http://localhost ${appliedConfigFile} /var/lib/discourse/api --unix-socket /run/discourse/sockets/unicorn.sock --transport stdlib --loglevel debug ${pruneFlag}
+        '';
+      };
+
+      # The daemon watches a path that does not change between generations,
+      # so that its service is not restarted when the configuration does.
+      environment.etc."discourse/applier.json" = mkIf cfg.applierDaemon.enable {
+        source = configFile;
+      };
+
+      # Started after the `postStart` of Discourse applied the configuration
+      # and stopped whenever Discourse is, so that the two never run at the
+      # same time. `applier control /run/discourse-applier/control.sock status`
+      # shows the outcome of the last change.
+      systemd.services.discourse-applier = mkIf cfg.applierDaemon.enable {
+        description = "Discourse configuration applier";
+        wantedBy = [ "multi-user.target" ];
+        after = [ "discourse.service" ];
+        requires = [ "discourse.service" ];
+        partOf = [ "discourse.service" ];
+        script = ''
+          DISCOURSE_API_KEY=$(<'/var/lib/discourse/api/key')
+          export DISCOURSE_API_KEY
+          exec ${pkgs.applier}/bin/applier daemon http://localhost /etc/discourse/applier.json /var/lib/discourse/api --unix-socket /run/discourse/sockets/unicorn.sock --control-socket /run/discourse-applier/control.sock ${pruneFlag}
+        '';
+        serviceConfig = {
+          User = "discourse";
+          Group = "discourse";
+          RuntimeDirectory = "discourse-applier";
+          Restart = "on-failure";
+        };
+      };
+
+      # Only reads from the API (conditionally, see ./packages/applier/drift.py)
+      # and from the state the applier keeps.
+      systemd.services.discourse-applier-drift = mkIf cfg.applierDrift.enable {
+        description = "Discourse configuration drift check";
+        after = [ "discourse.service" ];
+        requisite = [ "discourse.service" ];
+        script = ''
+          DISCOURSE_API_KEY=$(<'/var/lib/discourse/api/key')
+          export DISCOURSE_API_KEY
+          exec ${pkgs.applier}/bin/applier drift http://localhost /var/lib/discourse/api --unix-socket /run/discourse/sockets/unicorn.sock --transport stdlib --output /var/lib/discourse/api/drift.json
         '';
+        serviceConfig = {
+          Type = "oneshot";
+          User = "discourse";
+          Group = "discourse";
+        };
+      };
+
+      systemd.timers.discourse-applier-drift = mkIf cfg.applierDrift.enable {
+        description = "Periodic Discourse configuration drift check";
+        wantedBy = [ "timers.target" ];
+        timerConfig = {
+          OnActiveSec = cfg.applierDrift.interval;
+          OnUnitActiveSec = cfg.applierDrift.interval;
+        };
       };
     };
 }
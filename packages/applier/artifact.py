@@ -0,0 +1,180 @@
+# Compiled config (`applier compile`).
+#
+# The config generated by the Nix module is checked at build time, so that
+# mistakes in it (e.g. a category granting permissions to a group that is not
+# defined, or an attribute misspelled) fail the build instead of failing with
+# HTTP 4xx errors halfway through the start of Discourse. The compiled config
+# also carries everything the applier would otherwise derive from the config
+# on every run: the hash of the config, the hash and the references of every
+# entity and the order in which the entities may be applied. It is a compact
+# JSON document:
+# {
+#   "format": "applier-config",
+#   "version": 1,
+#   "hash": <hash of the config>,
+#   "config": <the config, with sorted keys>,
+#   # Entities in the order of their kinds (see `KINDS`) and attributes.
+#   "entities": [[<kind>, <attr>, <hash>, [[<kind>, <attr>], ...]], ...],
+#   # Indices of `entities` in the order they can be applied in.
+#   "order": [<index>, ...]
+# }
+# The applier accepts both the compiled and the plain config (which it then
+# compiles itself, see `load`).
+
+import json
+import logging
+
+# Local module ./entities.py
+from entities import KINDS
+# Local module ./parallel.py
+from parallel import topological_order
+# Local module ./reconcile.py
+from reconcile import canonical_hash
+
+FORMAT = 'applier-config'
+VERSION = 1
+
+
+class ConfigError(Exception):
+
+    def __init__(self, errors):
+        super().__init__('Invalid config:\n' + '\n'.join(errors))
+        self.errors = errors
+
+
+# The config along with what is derived from it. `entities` maps (kind name,
+# Nix attribute name) keys to the hashes of the entities, `references` maps
+# them to the keys of the entities they reference and `order` lists them in a
+# topological order (see `topological_order`).
+class CompiledConfig:
+
+    def __init__(self, config, config_hash, entities, references, order):
+        self.config = config
+        self.hash = config_hash
+        self.entities = entities
+        self.references = references
+        self.order = order
+
+    def to_json(self):
+        keys = list(self.entities)
+        index = {key: i for i, key in enumerate(keys)}
+        return {
+            'format': FORMAT,
+            'version': VERSION,
+            'hash': self.hash,
+            'config': self.config,
+            'entities': [[
+                kind, attr, self.entities[(kind, attr)],
+                [list(ref) for ref in self.references[(kind, attr)]]
+            ] for kind, attr in keys],
+            'order': [index[key] for key in self.order],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        if data.get('version') != VERSION:
+            raise Exception(
+                f'Unsupported version {data.get("version")} of the compiled'
+                f' config, expected {VERSION}')
+        keys = [(kind, attr) for kind, attr, _, _ in data['entities']]
+        return cls(
+            data['config'], data['hash'], {
+                (kind, attr): entity_hash
+                for kind, attr, entity_hash, _ in data['entities']
+            }, {(kind, attr): [tuple(ref) for ref in references]
+                for kind, attr, _, references in data['entities']},
+            [keys[i] for i in data['order']])
+
+
+# Descriptions of everything that is wrong with the config.
+def validate(config):
+    if not isinstance(config, dict):
+        return ['The config must be an object']
+    kinds = {kind.name: kind for kind in KINDS}
+    errors = [
+        f'{name}: unknown kind of entities, known ones: {", ".join(kinds)}'
+        for name in config if name not in kinds
+    ]
+    for kind in KINDS:
+        entities = config.get(kind.name, {})
+        if not isinstance(entities, dict):
+            errors.append(f'{kind.name}: expected an object')
+            continue
+        for attr, definition in entities.items():
+            entity_errors = kind.validate(definition)
+            for field, error in entity_errors:
+                path = f'{kind.name}.{attr}' + ('' if field is None else
+                                                f'.{field}')
+                errors.append(f'{path}: {error}')
+            if entity_errors:
+                continue
+            for ref_kind, ref_attr in kind.references(definition):
+                if (ref_kind not in kind.depends_on
+                        or ref_attr not in config.get(ref_kind, {})):
+                    errors.append(
+                        f'{kind.name}.{attr} references {ref_kind}.{ref_attr},'
+                        ' which is not defined in the config')
+    return errors
+
+
+# Validate the config and derive the rest of the `CompiledConfig` from it.
+# Raises `ConfigError` if the config is invalid.
+def compile_config(config):
+    errors = validate(config)
+    if errors:
+        raise ConfigError(errors)
+    entities = {}
+    references = {}
+    for kind in KINDS:
+        for attr in sorted(config.get(kind.name, {})):
+            definition = config[kind.name][attr]
+            entities[(kind.name, attr)] = canonical_hash(definition)
+            references[(kind.name, attr)] = kind.references(definition)
+    try:
+        order = topological_order(list(entities), references)
+    except Exception as e:
+        raise ConfigError([str(e)]) from e
+    return CompiledConfig(config, canonical_hash(config), entities,
+                          references, order)
+
+
+# Load the compiled or the plain config from `path`.
+def load(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if isinstance(data, dict) and data.get('format') == FORMAT:
+        return CompiledConfig.from_json(data)
+    logging.debug(f'{path} is not compiled, compiling it')
+    return compile_config(data)
+
+
+# `applier compile` subcommand, run when the config is built.
+def compile_command(argv):
+    # Local module ./main.py
+    from main import ArgumentProvider
+
+    provider = ArgumentProvider(default_loglevel='warning',
+                                prog='applier compile',
+                                argv=argv)
+    provider.parser.add_argument('config', help='Path to the plain config')
+    provider.parser.add_argument('output',
+                                 help='Path to write the compiled config to')
+    args = provider.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    try:
+        compiled = compile_config(config)
+    except ConfigError as e:
+        for error in e.errors:
+            logging.error(error)
+        raise SystemExit(1)
+
+    with open(args.output, 'w') as f:
+        json.dump(compiled.to_json(),
+                  f,
+                  sort_keys=True,
+                  separators=(',', ':'),
+                  ensure_ascii=False)
+    logging.info(f'Compiled {len(compiled.entities)} entities into'
+                 f' {args.output}')
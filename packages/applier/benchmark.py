@@ -0,0 +1,266 @@
+# Benchmark of the applier, run against the fake Discourse API from
+# ./fake_discourse.py.
+#
+# Every scenario generates a config, starts a fresh fake Discourse instance and
+# runs the applier twice in a subprocess:
+# - `initial`: everything has to be created,
+# - `forced`: with `--force`, nothing differs, so this measures the cost of
+#   fetching the remote state and comparing it with the config.
+# Roster scenarios apply a config with a single group, generate a roster of
+# users to be added to it and run `applier users` the same two ways.
+# The wall time, number of API requests and peak RSS of the applier process
+# are appended (along with the current git commit) to a JSON lines file, so
+# that the results can be compared across commits. The results of the previous
+# run of the same scenario are printed next to the new ones.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Local module ./fake_discourse.py
+from fake_discourse import FakeDiscourse, create_server, serve_in_background
+
+# Name -> (number of groups, members per group).
+SCENARIOS = {
+    'groups-10': (10, 10),
+    'groups-1k': (1000, 10),
+    'groups-10k': (10000, 0),
+    'members-100k': (10, 10000),
+}
+# Name -> number of users in the roster.
+ROSTER_SCENARIOS = {
+    'roster-500': 500,
+    'roster-50k': 50000,
+}
+
+
+def generate_config(groups, members_per_group):
+    return {
+        'groups': {
+            f'group{i}': {
+                'name': f'group{i}',
+                'full_name': f'Group {i}',
+                'bio_raw': '',
+                'visibility_level': 0,
+                'default_notification_level': 1,
+                'primary_group': False,
+                'public_admission': False,
+                'public_exit': False,
+                'usernames':
+                [f'user{i}_{j}' for j in range(members_per_group)],
+            }
+            for i in range(groups)
+        }
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_roster(path, users, group):
+    with open(path, 'w') as f:
+        f.write('username,email,name,groups\n')
+        for i in range(users):
+            f.write(f'user{i},user{i}@example.com,User {i},{group}\n')
+
+
+# Runs an entry point of ./main.py and writes its peak RSS (in KiB) to the file
+# given as the first argument. The `ru_maxrss` reported for the process cannot
+# be used, as Linux carries over the peak RSS of the process it was forked
+# from, i.e. of the benchmark holding the state of the fake API.
+APPLIER_PROGRAM = '''
+import atexit, sys
+
+def record_peak_rss(path):
+    with open('/proc/self/status') as status, open(path, 'w') as f:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                f.write(line.split()[1])
+
+atexit.register(record_peak_rss, sys.argv.pop(1))
+import main
+main.{entry_point}()
+'''
+
+
+# Run the applier in a subprocess and return its wall time (in seconds) and
+# peak RSS (in KiB). `entry_point` is the function of ./main.py to run.
+def run_applier(arguments, entry_point='apply'):
+    peak_rss_file = tempfile.NamedTemporaryFile(delete=False)
+    peak_rss_file.close()
+    command = [
+        sys.executable, '-c',
+        APPLIER_PROGRAM.format(entry_point=entry_point), peak_rss_file.name
+    ] + arguments + ['--loglevel', 'warning']
+    env = dict(os.environ, DISCOURSE_API_KEY='benchmark')
+    # The applier modules are next to this one.
+    paths = [os.path.dirname(os.path.abspath(__file__))]
+    if 'PYTHONPATH' in env:
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+
+    start = time.perf_counter()
+    try:
+        code = subprocess.run(command, env=env).returncode
+        elapsed = time.perf_counter() - start
+        with open(peak_rss_file.name, 'r') as f:
+            peak_rss = int(f.read())
+    finally:
+        os.unlink(peak_rss_file.name)
+    if code != 0:
+        raise Exception(f'The applier failed with code {code}')
+    return elapsed, peak_rss
+
+
+def run_scenario(name, args):
+    discourse = FakeDiscourse()
+    with tempfile.TemporaryDirectory() as directory:
+        unix_socket = None
+        if args.unix_socket:
+            unix_socket = os.path.join(directory, 'discourse.sock')
+        server = create_server(discourse,
+                               unix_socket=unix_socket,
+                               latency=args.latency,
+                               rate_limit=args.rate_limit)
+        url = serve_in_background(server)
+        applier_args = [
+            '--jobs', str(args.jobs), '--transport', args.transport
+        ]
+        if unix_socket is not None:
+            applier_args += ['--unix-socket', url]
+            url = 'http://localhost'
+
+        config = os.path.join(directory, 'config.json')
+        if name in ROSTER_SCENARIOS:
+            with open(config, 'w') as f:
+                json.dump({'groups': {'roster': {'name': 'roster'}}}, f)
+            run_applier([url, config, directory] + applier_args)
+            roster = os.path.join(directory, 'roster.csv')
+            write_roster(roster, ROSTER_SCENARIOS[name], 'roster')
+            arguments = ['users', url, config, directory, roster]
+        else:
+            with open(config, 'w') as f:
+                json.dump(generate_config(*SCENARIOS[name]), f)
+            arguments = [url, config, directory]
+
+        results = []
+        for run, extra_args in [('initial', []), ('forced', ['--force'])]:
+            requests_before = sum(discourse.requests.values())
+            wall_seconds, peak_rss = run_applier(arguments + applier_args +
+                                                 extra_args)
+            results.append({
+                'scenario': name,
+                'run': run,
+                'wall_seconds': round(wall_seconds, 3),
+                'requests': sum(discourse.requests.values()) - requests_before,
+                'peak_rss_kib': peak_rss,
+            })
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+# Results are comparable only if they were measured with the same parameters.
+def result_key(result):
+    return tuple(
+        result.get(key)
+        for key in ('scenario', 'run', 'jobs', 'transport', 'unix_socket',
+                    'latency', 'rate_limit'))
+
+
+def load_previous(path):
+    previous = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                result = json.loads(line)
+                previous[result_key(result)] = result
+    return previous
+
+
+def format_change(result, previous, key):
+    value = result[key]
+    if previous is None or not previous[key]:
+        return f'{value}'
+    change = (value - previous[key]) / previous[key] * 100
+    return f'{value} ({change:+.0f}%)'
+
+
+# `applier-benchmark` entry point (defined in the setup.py).
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the applier against a fake Discourse API')
+    parser.add_argument(
+        'scenarios',
+        nargs='*',
+        default=list(SCENARIOS) + list(ROSTER_SCENARIOS),
+        help='Scenarios to run:'
+        f' {", ".join(list(SCENARIOS) + list(ROSTER_SCENARIOS))}'
+        ' (all by default)')
+    parser.add_argument('--output',
+                        default='benchmark.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument(
+        '--transport',
+        choices=('requests', 'stdlib'),
+        default='stdlib',
+        help='HTTP client library the applier uses (stdlib by default, so'
+        ' that the benchmark does not need requests installed)')
+    parser.add_argument('--unix-socket',
+                        action='store_true',
+                        help='Connect to the fake API over a UNIX socket')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Latency (in seconds) of the fake API')
+    parser.add_argument(
+        '--rate-limit',
+        type=float,
+        default=None,
+        help='Rate limit (requests per second) of the fake API')
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        if name not in SCENARIOS and name not in ROSTER_SCENARIOS:
+            parser.error(f'Unknown scenario {name}')
+
+    previous = load_previous(args.output)
+    commit = current_commit()
+    parameters = {
+        'jobs': args.jobs,
+        'transport': args.transport,
+        'unix_socket': args.unix_socket,
+        'latency': args.latency,
+        'rate_limit': args.rate_limit
+    }
+    with open(args.output, 'a') as f:
+        for name in args.scenarios:
+            for result in run_scenario(name, args):
+                result = {
+                    'commit': commit,
+                    'time': int(time.time()),
+                    **result,
+                    **parameters
+                }
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+
+                last = previous.get(result_key(result))
+                print(f'{name:>14} {result["run"]:>8}:'
+                      f' {format_change(result, last, "wall_seconds")} s,'
+                      f' {format_change(result, last, "requests")} requests,'
+                      f' {format_change(result, last, "peak_rss_kib")} KiB'
+                      ' peak RSS')
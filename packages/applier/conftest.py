@@ -0,0 +1,56 @@
+# Fixtures shared by the tests of the applier (./test_*.py), run with
+# `pytest` in this directory (or as `checks.applier-unit` of the flake).
+#
+# The tests talking to the API use the fake one (see ./fake_discourse.py),
+# served in the background, through both transports (see ./transport.py).
+
+import json
+
+import pytest
+
+# Local module ./fake_discourse.py
+from fake_discourse import FakeDiscourse, create_server, serve_in_background
+# Local module ./main.py
+from main import Configurator, DiscourseClient
+
+
+@pytest.fixture
+def discourse():
+    return FakeDiscourse()
+
+
+@pytest.fixture
+def server(discourse):
+    server = create_server(discourse)
+    url = serve_in_background(server)
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['stdlib', 'requests'])
+def client(request, server):
+    if request.param == 'requests':
+        pytest.importorskip('requests')
+    client = DiscourseClient(server, 'key', transport=request.param)
+    yield client
+    client.close()
+
+
+# Write `config` into the data directory `tmp_path` and return a function
+# creating a `Configurator` applying it (with the given keyword arguments).
+@pytest.fixture
+def configurator(client, tmp_path):
+    configurators = []
+
+    def create(config, **kwargs):
+        path = tmp_path / 'config.json'
+        path.write_text(json.dumps(config))
+        configurator = Configurator(client, str(path), str(tmp_path),
+                                    **kwargs)
+        configurators.append(configurator)
+        return configurator
+
+    yield create
+    for configurator in configurators:
+        configurator.store.close()
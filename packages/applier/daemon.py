@@ -0,0 +1,291 @@
+# Long-running mode of the applier (`applier daemon`).
+#
+# Running the applier once per config change means importing the libraries,
+# connecting to Discourse, opening the store and fetching the remote entities
+# every time. The daemon does all that once: it applies the config at start,
+# then watches the config file and applies it again as soon as it changes.
+# The snapshots of the remote entities are kept in memory (updated with the
+# entities the daemon applies) and fetched again periodically, so that changes
+# made outside of the applier are noticed as well. A change of the config thus
+# costs only the API calls that apply it.
+#
+# The daemon can be controlled through a UNIX socket, see `control` below.
+
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import time
+
+# Local module ./entities.py
+from entities import KINDS
+# Local module ./inotify.py
+from inotify import Inotify
+# Local module ./main.py
+from main import ArgumentProvider, Configurator, create_client, export_metrics
+
+# Time given to whoever changes the config to finish writing it.
+SETTLE_SECONDS = 0.05
+
+
+# Notices changes of the file at `path`.
+# The file is compared by its metadata (and the target, if it is a symlink)
+# every time `changed` is called. With inotify, the directory of the file is
+# watched (editors often replace files instead of modifying them), so that
+# `fileno` becomes readable as soon as the file changes. Without inotify, or
+# if a symlink is changed elsewhere (e.g. /etc/static on NixOS), the change is
+# noticed by the periodic check.
+class ConfigWatcher:
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = self._signature()
+        self.inotify = None
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            logging.warning(
+                f'inotify is not available ({e}), polling {path} for changes')
+            return
+        self.inotify.add_watch(os.path.dirname(os.path.abspath(path)))
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (os.path.realpath(self.path), stat.st_ino, stat.st_size,
+                stat.st_mtime_ns)
+
+    # Object that becomes readable when the file may have changed, or None.
+    def selectable(self):
+        return self.inotify
+
+    # Whether the file changed since the last call.
+    def changed(self):
+        if self.inotify is not None:
+            self.inotify.drain()
+        signature = self._signature()
+        if signature == self.signature:
+            return False
+        time.sleep(SETTLE_SECONDS)
+        if self.inotify is not None:
+            self.inotify.drain()
+        self.signature = self._signature()
+        return True
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+class Daemon:
+
+    def __init__(self, args, client, configurator):
+        self.args = args
+        self.client = client
+        self.configurator = configurator
+        self.stopping = False
+        self.started_at = time.time()
+        self.runs = 0
+        self.last_run = None
+        self.last_refresh = None
+
+    # Apply the config file, unless it is broken. Failures are logged and
+    # reported through the control socket, the daemon keeps running.
+    def apply_config(self, trigger, force=False):
+        logging.info(f'Applying the config ({trigger})')
+        self.client.metrics.start_run()
+        started_at = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            self.configurator.load(self.args.config)
+            self.configurator.apply(force=force)
+        except Exception as e:
+            logging.exception('Applying the config failed')
+            error = str(e)
+            # The snapshots may not reflect what was applied before the
+            # failure.
+            self.configurator.snapshots.clear()
+        self.runs += 1
+        self.last_run = {
+            'trigger': trigger,
+            'started_at': started_at,
+            'duration_seconds': round(time.perf_counter() - start, 3),
+            'result': 'ok' if error is None else 'failed',
+            'error': error,
+            'stats': str(self.configurator.stats),
+        }
+        export_metrics(self.args, self.client)
+        return self.last_run
+
+    # Fetch the snapshots of the remote entities, either only the ones that
+    # are missing or all of them.
+    def refresh(self, missing_only=False):
+        logging.debug('Refreshing the snapshots of the remote entities')
+        try:
+            if missing_only:
+                for kind in KINDS:
+                    if self.configurator.config.get(kind.name):
+                        self.configurator.fetch_snapshot(kind)
+            else:
+                self.configurator.refresh_snapshots()
+        except Exception as e:
+            logging.warning(f'Refreshing the snapshots failed: {e}')
+        self.last_refresh = time.time()
+
+    def status(self):
+        now = time.time()
+        return {
+            'config': self.args.config,
+            'uptime_seconds': round(now - self.started_at),
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'snapshots': {
+                name: {
+                    'entities': len(snapshot),
+                    'age_seconds': round(now - snapshot.taken_at)
+                }
+                for name, snapshot in self.configurator.snapshots.items()
+            },
+            'rate_governor': self.client.governor.summary(),
+        }
+
+    def handle_command(self, command):
+        if command == 'status':
+            return self.status()
+        if command == 'apply':
+            return self.apply_config('control socket')
+        if command == 'reconcile':
+            self.refresh()
+            return self.apply_config('control socket', force=True)
+        return {'error': f'Unknown command {command}'}
+
+    # Serve a single client of the control socket. The client sends a single
+    # command terminated with a newline, the daemon responds with a JSON
+    # object terminated with a newline.
+    def serve_client(self, server):
+        connection, _ = server.accept()
+        with connection:
+            connection.settimeout(5)
+            try:
+                with connection.makefile('rb') as f:
+                    command = f.readline().decode().strip()
+                response = self.handle_command(command)
+                connection.sendall(json.dumps(response).encode() + b'\n')
+            except OSError as e:
+                logging.warning(f'Control socket client failed: {e}')
+
+    def stop(self, signum, frame):
+        logging.info(f'Received signal {signum}, stopping')
+        self.stopping = True
+
+    def run(self):
+        watcher = ConfigWatcher(self.args.config)
+        # Signals interrupt `select` through this pair of sockets.
+        wakeup_read, wakeup_write = socket.socketpair()
+        wakeup_write.setblocking(False)
+        signal.set_wakeup_fd(wakeup_write.fileno())
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        server = None
+        if self.args.control_socket is not None:
+            if os.path.exists(self.args.control_socket):
+                os.unlink(self.args.control_socket)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.args.control_socket)
+            os.chmod(self.args.control_socket, 0o600)
+            server.listen()
+
+        self.apply_config('start', force=self.args.force)
+        self.refresh(missing_only=True)
+
+        readable = [wakeup_read] + [
+            fd for fd in (watcher.selectable(), server) if fd is not None
+        ]
+        while not self.stopping:
+            next_refresh = self.last_refresh + self.args.refresh_interval
+            timeout = max(
+                0, min(self.args.poll_interval, next_refresh - time.time()))
+            ready, _, _ = select.select(readable, [], [], timeout)
+            if wakeup_read in ready:
+                wakeup_read.recv(4096)
+            if server in ready:
+                self.serve_client(server)
+            if watcher.changed():
+                self.apply_config('config change')
+            if time.time() >= next_refresh:
+                self.refresh()
+
+        if server is not None:
+            server.close()
+            os.unlink(self.args.control_socket)
+        watcher.close()
+
+
+# `applier daemon` entry point.
+def run_daemon(argv):
+    provider = ArgumentProvider(prog='applier daemon', argv=argv)
+    provider.add_url_related_options()
+    provider.add_config_related_options()
+    provider.parser.add_argument(
+        '--control-socket',
+        default=None,
+        help='Path of the UNIX socket accepting commands (see applier control)'
+    )
+    provider.parser.add_argument(
+        '--refresh-interval',
+        type=float,
+        default=60,
+        help='Interval (in seconds) of fetching the remote entities again')
+    provider.parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=1,
+        help='Interval (in seconds) of checking the config file for changes'
+        ' that inotify does not report')
+    args = provider.parse_args()
+
+    client = create_client(args)
+    configurator = Configurator(client,
+                                args.config,
+                                args.data_dir,
+                                jobs=args.jobs,
+                                cache_snapshots=True,
+                                prune=args.prune,
+                                keep=args.keep)
+    try:
+        Daemon(args, client, configurator).run()
+    finally:
+        configurator.store.close()
+        client.close()
+
+
+# `applier control` entry point: send a command to a running daemon and print
+# its response. Commands:
+# - status: the state of the daemon and the outcome of the last run,
+# - apply: apply the config now,
+# - reconcile: fetch the remote entities and apply all of them, correcting
+#   the changes made outside of the applier.
+def control(argv):
+    provider = ArgumentProvider(prog='applier control',
+                                default_loglevel='warning',
+                                argv=argv)
+    provider.parser.add_argument('control_socket',
+                                 help='Control socket of the daemon')
+    provider.parser.add_argument('command',
+                                 choices=['status', 'apply', 'reconcile'])
+    args = provider.parse_args()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(args.control_socket)
+        connection.sendall(args.command.encode() + b'\n')
+        with connection.makefile('rb') as f:
+            response = json.loads(f.readline())
+    print(json.dumps(response, indent=2))
+    if 'error' in response and response['error'] is not None:
+        raise SystemExit(1)
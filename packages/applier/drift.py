@@ -0,0 +1,221 @@
+# Drift detection (`applier drift`).
+#
+# Entities can be changed in the admin panel between deploys, the applier
+# corrects such changes only when the config changes (or with `--force`). This
+# finds them without changing anything: it takes a single snapshot of every
+# kind of entities the applier manages, compares the remote entities with the
+# definitions applied by the last successful run (kept in the store, see
+# `AttributeNameToIdStore`) and reports the ones that drifted, as a single
+# line of JSON. The exit code is 0 if nothing drifted, 1 if something did and
+# 2 if the check failed.
+#
+# The check is meant to run every few minutes (see the `applierDrift` option
+# of the NixOS module), so it is kept cheap:
+# - only the listings the applier takes snapshots of are requested, and only
+#   for the kinds that have applied entities,
+# - the listings are requested conditionally: their ETags are kept in
+#   `drift.sqlite3` in the data directory along with the bodies, and if
+#   Discourse responds with 304 Not Modified, the body is not sent again,
+# - entities are compared by the hashes of the attributes the config sets
+#   (see `projection_hash`), only the ones whose hashes differ are compared
+#   attribute by attribute to report what changed.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+# Local module ./entities.py
+from entities import KINDS
+# Local module ./main.py
+from main import (AttributeNameToIdStore, ArgumentProvider, create_client,
+                  export_metrics)
+# Local module ./parallel.py
+from parallel import map_ordered
+
+
+# Bodies of GET responses along with their ETags, stored in an SQLite
+# database. Used by the `DiscourseClient` to make its requests conditional.
+class ResponseCache:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            body BLOB NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        # Snapshots of different kinds are fetched concurrently.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _key(self, url, params):
+        if not params:
+            return url
+        return url + '?' + urllib.parse.urlencode(sorted(params.items()))
+
+    # The (ETag, body) of the cached response, or None.
+    def get(self, url, params):
+        with self.lock:
+            return self.db.execute(
+                'SELECT etag, body FROM responses WHERE key = ?',
+                (self._key(url, params), )).fetchone()
+
+    def put(self, url, params, etag, body):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO responses (key, etag, body) VALUES (?, ?, ?)'
+                ' ON CONFLICT (key) DO UPDATE SET etag = excluded.etag,'
+                ' body = excluded.body', (self._key(url, params), etag, body))
+
+
+# Compares the remote entities with the definitions applied last. Serves as
+# the `ctx` of the entity kinds, which need the store and the config (e.g. to
+# resolve the names of the groups categories grant permissions to).
+class DriftDetector:
+
+    def __init__(self, client, store, jobs=1):
+        self.client = client
+        self.store = store
+        self.jobs = jobs
+        # Kind name -> {Nix attribute name: (remote id, definition)}.
+        self.applied = {
+            kind.name: {
+                attr: (remote_id, definition)
+                for attr, remote_id, definition in store.applied_entities(
+                    kind.name)
+            }
+            for kind in KINDS
+        }
+        self.config = {
+            name: {
+                attr: definition
+                for attr, (_, definition) in entities.items()
+            }
+            for name, entities in self.applied.items()
+        }
+
+    def fetch_snapshot(self, kind):
+        with self.client.metrics.span('snapshot', kind.name):
+            return kind.snapshot(self.client)
+
+    # Entities that drifted, as dicts with the kind, the Nix attribute name
+    # and the remote id of the entity, and either the names of the attributes
+    # that changed or `missing` if the entity no longer exists. Returns them
+    # along with the number of checked entities.
+    def check(self):
+        kinds = [kind for kind in KINDS if self.applied[kind.name]]
+        snapshots = map_ordered(self.fetch_snapshot,
+                                [(kind, ) for kind in kinds], self.jobs)
+
+        drifted = []
+        checked = 0
+        for kind, snapshot in zip(kinds, snapshots):
+            for attr, applied in self.applied[kind.name].items():
+                remote_id, definition = applied
+                checked += 1
+                # Site settings are identified by their names.
+                key = attr if remote_id is None else remote_id
+                remote = snapshot.by_id.get(key)
+                entry = {'kind': kind.name, 'attr': attr, 'id': remote_id}
+                if remote is None:
+                    drifted.append({**entry, 'missing': True})
+                    continue
+                changed = kind.drift(self, definition, remote)
+                if changed:
+                    drifted.append({**entry, 'attributes': changed})
+        return drifted, checked
+
+
+# Numbers of the requests made by the client, of the ones answered with 304
+# Not Modified and of the received bytes.
+def request_counts(metrics):
+    with metrics.lock:
+        requests = sum(metrics.requests.values())
+        not_modified = sum(count for key, count in metrics.requests.items()
+                           if key[2] == '304')
+        received = sum(metrics.bytes_received.values())
+    return requests, not_modified, received
+
+
+def write_report(path, report):
+    # The report may be read (e.g. by monitoring) at any moment, so it has to
+    # be replaced at once.
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        f.write(report + '\n')
+    os.replace(temporary_path, path)
+
+
+# `applier drift` entry point.
+def drift(argv):
+    provider = ArgumentProvider(prog='applier drift', argv=argv)
+    provider.add_url_related_options()
+    provider.parser.add_argument('data_dir', help='Path to the data directory')
+    provider.parser.add_argument(
+        '--jobs',
+        type=int,
+        default=4,
+        help='Number of kinds of entities fetched concurrently')
+    provider.parser.add_argument('--output',
+                                 default=None,
+                                 help='Write the report to this file as well')
+    args = provider.parse_args()
+
+    start = time.monotonic()
+    client = create_client(args)
+    try:
+        state_path = os.path.join(args.data_dir, 'state.sqlite3')
+        if not os.path.exists(state_path):
+            raise Exception(f'{state_path} does not exist, the config was'
+                            ' never applied')
+        store = AttributeNameToIdStore(state_path)
+        client.response_cache = ResponseCache(
+            os.path.join(args.data_dir, 'drift.sqlite3'))
+        try:
+            drifted, checked = DriftDetector(client, store, args.jobs).check()
+        finally:
+            client.response_cache.close()
+            store.close()
+    except Exception as e:
+        logging.error(f'Checking for drift failed: {e}')
+        raise SystemExit(2)
+    finally:
+        client.close()
+
+    requests, not_modified, received = request_counts(client.metrics)
+    client.metrics.set_gauge('applier_drifted_entities', len(drifted),
+                             'Entities that differ from the applied config.')
+    export_metrics(args, client)
+
+    report = json.dumps(
+        {
+            'drifted': len(drifted),
+            'checked': checked,
+            'entities': drifted,
+            'requests': requests,
+            'not_modified': not_modified,
+            'received_bytes': received,
+            'seconds': round(time.monotonic() - start, 3),
+        },
+        separators=(',', ':'))
+    print(report)
+    if args.output is not None:
+        write_report(args.output, report)
+
+    if drifted:
+        logging.warning(f'{len(drifted)} of {checked} entities drifted')
+        raise SystemExit(1)
+    logging.info(f'None of {checked} entities drifted')
@@ -0,0 +1,504 @@
+# Kinds of Discourse entities managed by the applier.
+#
+# Every kind corresponds to a top-level attribute of the config (e.g. `groups`)
+# and knows how to take a snapshot of the remote entities of that kind and how
+# to apply a single desired entity. Entities may reference entities of other
+# kinds (e.g. a category granting permissions to a group), which makes them
+# depend on each other: the `Configurator` applies an entity only after all
+# entities it references were applied, while independent entities are applied
+# concurrently. Each kind declares the kinds its entities may reference in
+# `depends_on`.
+#
+# A kind is given the `Configurator` (`ctx`) when applying an entity, to access
+# the API client, the store, the config and the statistics of the run.
+#
+# Every kind also declares the attributes its definitions may have in
+# `fields`, so that a config can be validated before anything is applied (see
+# ./artifact.py).
+#
+# The methods a kind must implement are abstract, so a kind missing one of
+# them fails when `KINDS` is built (i.e. when this module is imported), not
+# halfway through applying a config.
+
+import abc
+import logging
+import re
+
+# Local module ./reconcile.py
+from reconcile import (Snapshot, chunks, diff_definition, diff_members,
+                       projection_hash)
+
+# Number of usernames sent in a single call adding or removing group members.
+MEMBERSHIP_CHUNK_SIZE = 500
+
+
+# Checks of the values of the attributes of definitions. Every check returns
+# a description of what is wrong with the value, or None if it is valid.
+def _string(value):
+    return None if isinstance(value, str) else 'expected a string'
+
+
+def _boolean(value):
+    return None if isinstance(value, bool) else 'expected a boolean'
+
+
+def _one_of(*allowed):
+
+    def check(value):
+        if isinstance(value, bool) or value not in allowed:
+            return f'expected one of {", ".join(map(repr, allowed))}'
+        return None
+
+    return check
+
+
+def _optional(check):
+    return lambda value: None if value is None else check(value)
+
+
+def _list_of(check):
+
+    def check_list(value):
+        if not isinstance(value, list):
+            return 'expected a list'
+        for index, item in enumerate(value):
+            error = check(item)
+            if error is not None:
+                return f'item {index}: {error}'
+        return None
+
+    return check_list
+
+
+def _hex_color(value):
+    if not isinstance(value, str) or not re.fullmatch(r'[0-9A-Fa-f]{6}',
+                                                     value):
+        return 'expected a hex color without #, e.g. 0088CC'
+    return None
+
+
+# Permissions are objects with either a `group` or a `group_name` (see
+# `_permissions_to_api`) and one of the permission types `allowed`.
+def _permissions(*allowed):
+    permission_type = _one_of(*allowed)
+
+    def check(value):
+        if not isinstance(value, dict):
+            return 'expected an object'
+        if sorted(value) not in (['group', 'permission_type'],
+                                 ['group_name', 'permission_type']):
+            return 'expected a group or a group_name and a permission_type'
+        error = _string(value.get('group', value.get('group_name')))
+        return error if error is not None else permission_type(
+            value['permission_type'])
+
+    return _list_of(check)
+
+
+class EntityKind(abc.ABC):
+    # Key of the kind in the config and in the store.
+    name = None
+    # Name of the Nix option the entities are defined with.
+    option = None
+    # Kinds of the entities that entities of this kind may reference.
+    depends_on = ()
+    # Whether entities removed from the config may be deleted (see
+    # `Configurator.prune_orphans`).
+    prunable = False
+    # Attributes of a definition: name -> (check, whether it is required).
+    fields = {}
+
+    # What is wrong with `definition`, as (attribute name, description) pairs.
+    # The attribute name is None if the whole definition is wrong.
+    def validate(self, definition):
+        if not isinstance(definition, dict):
+            return [(None, 'expected an object')]
+        errors = [(field, 'unknown attribute') for field in definition
+                  if field not in self.fields]
+        for field, (check, required) in self.fields.items():
+            if field not in definition:
+                if required:
+                    errors.append((field, 'missing'))
+                continue
+            error = check(definition[field])
+            if error is not None:
+                errors.append((field, error))
+        return errors
+
+    # Entities referenced by `definition`, as (kind name, Nix attribute name)
+    # pairs.
+    def references(self, definition):
+        return []
+
+    # Prunable kinds must implement `delete`, which the other kinds never
+    # need, so it cannot be abstract.
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.prunable and cls.delete is EntityKind.delete:
+            raise TypeError(
+                f'{cls.__name__} is prunable, but does not implement delete')
+
+    # Fetch the remote entities of this kind.
+    @abc.abstractmethod
+    def snapshot(self, client):
+        pass
+
+    # Apply a single entity. Returns the remote id of the entity (if it has
+    # one) and the name of the `ReconcileStats` counter describing the outcome.
+    @abc.abstractmethod
+    def apply(self, ctx, attr, definition, snapshot):
+        pass
+
+    # Names of the attributes in which the `remote` entity no longer matches
+    # the `definition` applied last (see ./drift.py). `ctx` provides the store
+    # and the config, like when applying.
+    @abc.abstractmethod
+    def drift(self, ctx, definition, remote):
+        pass
+
+    # Whether the remote entity is managed by Discourse itself, so it must
+    # never be deleted.
+    def protected(self, remote):
+        return False
+
+    # Delete the remote entity, only called for `prunable` kinds.
+    def delete(self, client, remote_id):
+        raise NotImplementedError(f'{self.name} cannot be deleted')
+
+
+# Kind of entities that have a numeric id and a name in Discourse, and are
+# created and updated by sending their whole definition to the API.
+class ResourceKind(EntityKind):
+
+    # Convert a definition from the config into the one accepted by the API.
+    def to_api(self, ctx, definition):
+        return definition
+
+    # Create the entity, returning its remote id.
+    @abc.abstractmethod
+    def create(self, client, api_definition):
+        pass
+
+    @abc.abstractmethod
+    def update(self, client, remote_id, api_definition):
+        pass
+
+    def apply(self, ctx, attr, definition, snapshot):
+        return self.apply_definition(ctx, attr, self.to_api(ctx, definition),
+                                     snapshot)
+
+    # If the entity does not exist, it will be created.
+    # If the entity exists, but some of its attributes differ from the ones in
+    # the config, it will be updated. Otherwise no API call is made.
+    def apply_definition(self, ctx, attr, api_definition, snapshot):
+        nix_attr = f'`services.discourse.{self.option}.{attr}`'
+        name = api_definition['name']
+        snapshot_fallback = lambda: snapshot.find_id_by_name(name)
+        remote_id = ctx.store.get_id(self.name, attr, snapshot_fallback)
+
+        if remote_id is None:
+            logging.debug(
+                f'Nix attribute {nix_attr} had no corresponding discourse entity'
+            )
+            remote_id = self.create(ctx.client, api_definition)
+            # Store the id right away, so that it is not lost even if applying
+            # the rest of the entity fails.
+            ctx.store.set_id(self.name, attr, remote_id)
+            snapshot.record(remote_id, api_definition)
+            return remote_id, 'created'
+
+        logging.debug(
+            f'Nix attribute {nix_attr} was mapped to discourse entity of id = {remote_id}'
+        )
+        remote = snapshot.by_id.get(remote_id)
+        if remote is None:
+            # The entity is not a part of the snapshot, so there is nothing to
+            # compare the definition with.
+            logging.debug(
+                f'Entity {nix_attr} is missing from the snapshot, updating it unconditionally'
+            )
+        else:
+            last_applied = ctx.store.get_applied(self.name, attr)
+            if last_applied is not None:
+                last_applied = self.to_api(ctx, last_applied)
+            changed = diff_definition(api_definition, remote, last_applied)
+            if not changed:
+                logging.debug(f'Entity {nix_attr} is up to date')
+                return remote_id, 'skipped'
+            logging.debug(
+                f'Entity {nix_attr} differs in: {", ".join(changed)}')
+
+        self.update(ctx.client, remote_id, api_definition)
+        snapshot.record(remote_id, api_definition)
+        return remote_id, 'updated'
+
+    # Attributes not returned by the API cannot drift, as far as the applier
+    # can tell.
+    def drift(self, ctx, definition, remote):
+        api_definition = self.to_api(ctx, definition)
+        if (projection_hash(api_definition,
+                            remote) == projection_hash(api_definition,
+                                                       api_definition)):
+            return []
+        return diff_definition(api_definition, remote, api_definition)
+
+
+class GroupKind(ResourceKind):
+    name = 'groups'
+    option = 'groups'
+    prunable = True
+    # Visibility and notification levels are given as their numbers (see
+    # ../../modules/discourse-extended.nix), owners and email domains as
+    # strings separated by `,` and `|` respectively.
+    fields = {
+        'name': (_string, True),
+        'full_name': (_string, False),
+        'bio_raw': (_string, False),
+        'usernames': (_list_of(_string), False),
+        'owner_usernames': (_string, False),
+        'automatic_membership_email_domains': (_string, False),
+        'visibility_level': (_one_of(0, 1, 2, 3, 4), False),
+        'primary_group': (_boolean, False),
+        'public_admission': (_boolean, False),
+        'public_exit': (_boolean, False),
+        'default_notification_level': (_one_of(0, 1, 2, 3, 4), False),
+    }
+
+    def snapshot(self, client):
+        return Snapshot(client.iter_groups())
+
+    # Membership is not a part of the definition sent to the API, it is
+    # synchronized separately.
+    def to_api(self, ctx, definition):
+        return {
+            attr: value
+            for attr, value in definition.items() if attr != 'usernames'
+        }
+
+    def create(self, client, api_definition):
+        return client.create_group(api_definition)
+
+    def update(self, client, remote_id, api_definition):
+        client.update_group(remote_id, api_definition)
+
+    # Automatic groups (e.g. `staff` or `trust_level_0`) are maintained by
+    # Discourse.
+    def protected(self, remote):
+        return bool(remote.get('automatic'))
+
+    def delete(self, client, remote_id):
+        client.delete_group(remote_id)
+
+    # Members are not listed along with the groups, only their number is. A
+    # different number of members means that the membership drifted, the
+    # same number is taken as no drift (it would take fetching the members to
+    # be sure).
+    def drift(self, ctx, definition, remote):
+        changed = super().drift(ctx, definition, remote)
+        usernames = definition.get('usernames')
+        if usernames is not None and 'user_count' in remote:
+            members = {username.lower() for username in usernames}
+            members |= _owners(self.to_api(ctx, definition))
+            if remote['user_count'] != len(members):
+                changed = sorted(changed + ['usernames'])
+        return changed
+
+    def apply(self, ctx, attr, definition, snapshot):
+        api_definition = self.to_api(ctx, definition)
+        remote_id, outcome = self.apply_definition(ctx, attr, api_definition,
+                                                   snapshot)
+        if definition.get('usernames') is not None:
+            self.sync_members(ctx,
+                              remote_id,
+                              api_definition,
+                              definition['usernames'],
+                              is_new=outcome == 'created')
+        return remote_id, outcome
+
+    # Make `usernames` the exact list of members of the group, by adding and
+    # removing only the members that differ.
+    # Changes are sent in chunks of `MEMBERSHIP_CHUNK_SIZE` usernames, with
+    # the progress logged after every chunk. Since the difference is always
+    # computed from the current membership, an interrupted run is resumed
+    # from the last applied chunk the next time the applier runs.
+    def sync_members(self, ctx, group_id, api_definition, usernames, is_new):
+        name = api_definition['name']
+        desired = {username.lower(): username for username in usernames}
+        # Group owners are members as well (Discourse makes them members when
+        # the group is created), they are managed through the
+        # `owner_usernames` attribute instead, so they are never added or
+        # removed here.
+        owners = _owners(api_definition)
+        current = {owner: owner for owner in owners}
+        if not is_new:
+            for member in ctx.client.iter_group_members(name):
+                current[member['username'].lower()] = member['username']
+        to_add, to_remove = diff_members(desired, current, owners)
+        if not to_add and not to_remove:
+            logging.debug(f'Members of group {name} are up to date')
+            return
+
+        for action, to_change, counter in [
+            (ctx.client.add_group_members, to_add, 'members_added'),
+            (ctx.client.remove_group_members, to_remove, 'members_removed'),
+        ]:
+            done = 0
+            for chunk in chunks(to_change, MEMBERSHIP_CHUNK_SIZE):
+                action(group_id, chunk)
+                done += len(chunk)
+                ctx.stats.count(counter, len(chunk))
+                logging.info(
+                    f'Group {name}: {counter.replace("_", " ")} {done}/{len(to_change)}'
+                )
+
+
+# Lowercase usernames of the owners of a group.
+def _owners(api_definition):
+    owners = api_definition.get('owner_usernames', '')
+    return {owner.lower() for owner in owners.split(',') if owner}
+
+
+# Permissions granted by categories and tag groups are given in the config as
+# a list of {"group": <Nix attribute of a group>, "permission_type": <int>} or
+# {"group_name": <name of a group not managed by Nix>, "permission_type": <int>}
+# objects. The API expects them as a mapping of group names to permission types.
+def _permissions_to_api(ctx, permissions):
+    result = {}
+    for permission in permissions:
+        if 'group' in permission:
+            group = ctx.config.get('groups', {}).get(permission['group'], {})
+            name = group.get('name')
+        else:
+            name = permission['group_name']
+        result[name] = permission['permission_type']
+    return result
+
+
+def _permission_references(definition):
+    return [('groups', permission['group'])
+            for permission in definition.get('permissions', [])
+            if 'group' in permission]
+
+
+# Categories, optionally nested in a parent category defined in Nix (given by
+# its Nix attribute name in `parent`).
+class CategoryKind(ResourceKind):
+    name = 'categories'
+    option = 'categories'
+    depends_on = ('groups', 'categories')
+    fields = {
+        'name': (_string, True),
+        'slug': (_string, False),
+        'color': (_hex_color, False),
+        'text_color': (_hex_color, False),
+        'parent': (_optional(_string), False),
+        'permissions': (_permissions(1, 2, 3), False),
+    }
+
+    def references(self, definition):
+        references = _permission_references(definition)
+        if definition.get('parent') is not None:
+            references.append(('categories', definition['parent']))
+        return references
+
+    def snapshot(self, client):
+        return Snapshot(client.list_categories())
+
+    def to_api(self, ctx, definition):
+        api_definition = {
+            attr: value
+            for attr, value in definition.items()
+            if attr not in ('parent', 'permissions')
+        }
+        if definition.get('parent') is not None:
+            # The parent was applied before this category, its id is known.
+            api_definition['parent_category_id'] = ctx.store.get_id(
+                'categories', definition['parent'], lambda: None)
+        if definition.get('permissions'):
+            api_definition['permissions'] = _permissions_to_api(
+                ctx, definition['permissions'])
+        return api_definition
+
+    def create(self, client, api_definition):
+        return client.create_category(api_definition)
+
+    def update(self, client, remote_id, api_definition):
+        client.update_category(remote_id, api_definition)
+
+
+# Tag groups, which declare tags and who may use them.
+class TagGroupKind(ResourceKind):
+    name = 'tag_groups'
+    option = 'tagGroups'
+    depends_on = ('groups', )
+    fields = {
+        'name': (_string, True),
+        'tag_names': (_list_of(_string), False),
+        'one_per_topic': (_boolean, False),
+        'permissions': (_permissions(1, 3), False),
+    }
+
+    def references(self, definition):
+        return _permission_references(definition)
+
+    def snapshot(self, client):
+        return Snapshot(client.list_tag_groups())
+
+    def to_api(self, ctx, definition):
+        api_definition = dict(definition)
+        api_definition['permissions'] = _permissions_to_api(
+            ctx, definition.get('permissions', []))
+        return api_definition
+
+    def create(self, client, api_definition):
+        return client.create_tag_group(api_definition)
+
+    def update(self, client, remote_id, api_definition):
+        client.update_tag_group(remote_id, api_definition)
+
+
+# Settings are returned by the API as strings, numbers or booleans, depending
+# on their type.
+def _normalize_setting(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return '' if value is None else str(value)
+
+
+# Site settings, where the Nix attribute is the name of the setting and the
+# definition is its value.
+class SiteSettingKind(EntityKind):
+    name = 'site_settings'
+    option = 'apiSiteSettings'
+
+    # The definition is the value of the setting itself.
+    def validate(self, definition):
+        if isinstance(definition, (bool, int, str)):
+            return []
+        return [(None, 'expected a boolean, an integer or a string')]
+
+    def snapshot(self, client):
+        return Snapshot(client.list_site_settings(),
+                        id_key='setting',
+                        name_key='setting')
+
+    def apply(self, ctx, attr, definition, snapshot):
+        remote = snapshot.by_id.get(attr)
+        if remote is not None and (_normalize_setting(remote['value'])
+                                   == _normalize_setting(definition)):
+            logging.debug(f'Site setting {attr} is up to date')
+            return None, 'skipped'
+        ctx.client.update_site_setting(attr, definition)
+        snapshot.record(attr, {'value': definition})
+        return None, 'updated'
+
+    def drift(self, ctx, definition, remote):
+        if (_normalize_setting(
+                remote['value']) == _normalize_setting(definition)):
+            return []
+        return ['value']
+
+
+# All kinds, in the order in which their entities are applied (unless
+# dependencies require otherwise).
+KINDS = [SiteSettingKind(), GroupKind(), CategoryKind(), TagGroupKind()]
@@ -0,0 +1,449 @@
+# A stand-in for the Discourse API, used to develop and benchmark the applier
+# without booting the NixOS virtual machine with a real Discourse instance.
+#
+# The server keeps all the state in memory and implements only the endpoints
+# (and the parts of their behavior) the applier relies on:
+# - GET groups.json (paginated like Discourse, by `page`),
+# - POST admin/groups.json, PUT groups/{id}.json, DELETE admin/groups/{id}.json,
+# - GET groups/{name}/members.json (paginated by `offset` and `limit`),
+#   PUT and DELETE groups/{id}/members.json,
+# - GET site.json, POST categories.json, PUT categories/{id}.json,
+# - GET and POST tag_groups.json, PUT tag_groups/{id}.json,
+# - GET admin/site_settings.json, PUT admin/site_settings/{name}.json,
+# - GET admin/users/list/all.json (paginated by `page`), POST users.json,
+#   PUT u/{username}.json,
+# - GET srv/status.
+# Like Rails (Rack::ETag and Rack::ConditionalGet), successful GET responses
+# have an ETag and requests with a matching If-None-Match get 304 Not Modified.
+# It listens either on a TCP port or on a UNIX socket (like Unicorn does), can
+# delay every response and can refuse requests exceeding a rate limit with 429,
+# like Discourse does.
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Number of groups returned per page of groups.json (the same as in Discourse).
+GROUPS_PAGE_SIZE = 36
+# Maximum number of members returned per page of members.json.
+MEMBERS_PAGE_LIMIT = 1000
+# Number of users returned per page of the admin user listing.
+USERS_PAGE_SIZE = 100
+# Groups that exist in every Discourse instance.
+AUTOMATIC_GROUPS = [
+    'everyone', 'admins', 'moderators', 'staff', 'trust_level_0',
+    'trust_level_1', 'trust_level_2', 'trust_level_3', 'trust_level_4'
+]
+
+
+class NotFound(Exception):
+    pass
+
+
+# The state of the fake Discourse instance.
+class FakeDiscourse:
+
+    def __init__(self, groups_page_size=GROUPS_PAGE_SIZE):
+        self.groups_page_size = groups_page_size
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.groups = {}
+        # Group id -> set of usernames.
+        self.members = collections.defaultdict(set)
+        self.categories = {}
+        self.tag_groups = {}
+        self.site_settings = {'title': 'Discourse', 'login_required': False}
+        self.users = {}
+        # Lowercase username -> user.
+        self.users_by_username = {}
+        # Number of requests served, by method.
+        self.requests = collections.Counter()
+
+        for name in AUTOMATIC_GROUPS:
+            self._insert(self.groups, {'name': name, 'automatic': True})
+
+    def _insert(self, table, entity):
+        entity['id'] = self.next_id
+        table[self.next_id] = entity
+        self.next_id += 1
+        return entity
+
+    def _group_by_name(self, name):
+        for group in self.groups.values():
+            if group['name'] == name:
+                return group
+        raise NotFound(f'group {name}')
+
+    # Handle a request and return the response body. Paths do not start with
+    # a slash, `params` map to single values.
+    def handle(self, method, path, params, body):
+        with self.lock:
+            self.requests[method] += 1
+            for pattern, handler in self.ROUTES:
+                match = re.fullmatch(pattern, f'{method} {path}')
+                if match is not None:
+                    return handler(self, params, body, *match.groups())
+        raise NotFound(f'{method} {path}')
+
+    def list_groups(self, params, body):
+        page = int(params.get('page', 0))
+        size = self.groups_page_size
+        groups = sorted(self.groups.values(), key=lambda group: group['name'])
+        # Members are not listed along with the groups, only their number.
+        listed = [{
+            **group, 'user_count': len(self.members[group['id']])
+        } for group in groups[page * size:(page + 1) * size]]
+        return {
+            'groups': listed,
+            'total_rows_groups': len(groups),
+            'load_more_groups': f'/groups?page={page + 1}',
+        }
+
+    def create_group(self, params, body):
+        definition = dict(body['group'])
+        usernames = definition.pop('usernames', None)
+        for group in self.groups.values():
+            if group['name'] == definition['name']:
+                raise ValueError(f'Name {definition["name"]} is taken')
+        group = self._insert(self.groups, {'automatic': False, **definition})
+        if usernames:
+            self.members[group['id']].update(usernames.split(','))
+        # Like Discourse, makes the owners members of the new group.
+        owners = definition.get('owner_usernames') or ''
+        self.members[group['id']].update(owner for owner in owners.split(',')
+                                         if owner)
+        return {'basic_group': group}
+
+    def update_group(self, params, body, group_id):
+        definition = dict(body['group'])
+        definition.pop('usernames', None)
+        self.groups[int(group_id)].update(definition)
+        return {'success': 'OK'}
+
+    def delete_group(self, params, body, group_id):
+        if self.groups.pop(int(group_id), None) is None:
+            raise NotFound(f'group {group_id}')
+        self.members.pop(int(group_id), None)
+        return {'success': 'OK'}
+
+    def list_members(self, params, body, group_name):
+        group = self._group_by_name(group_name)
+        offset = int(params.get('offset', 0))
+        limit = min(int(params.get('limit', 50)), MEMBERS_PAGE_LIMIT)
+        usernames = sorted(self.members[group['id']])
+        return {
+            'members': [{
+                'username': username
+            } for username in usernames[offset:offset + limit]],
+            'owners': [],
+            'meta': {
+                'total': len(usernames),
+                'limit': limit,
+                'offset': offset
+            },
+        }
+
+    # Like Discourse, refuses to add users if all of them are members
+    # already.
+    def add_members(self, params, body, group_id):
+        usernames = body['usernames'].split(',')
+        existing = self.members[int(group_id)].intersection(usernames)
+        if existing == set(usernames):
+            raise ValueError(
+                f'{", ".join(sorted(existing))} is already a member of this group'
+            )
+        self.members[int(group_id)].update(usernames)
+        return {'success': 'OK'}
+
+    def remove_members(self, params, body, group_id):
+        self.members[int(group_id)].difference_update(
+            body['usernames'].split(','))
+        return {'success': 'OK'}
+
+    def site(self, params, body):
+        return {'categories': list(self.categories.values())}
+
+    # Permissions are not returned by Discourse along with the categories, so
+    # they are not stored either.
+    def create_category(self, params, body):
+        definition = {
+            key: value
+            for key, value in body.items() if key != 'permissions'
+        }
+        return {'category': self._insert(self.categories, definition)}
+
+    def update_category(self, params, body, category_id):
+        definition = {
+            key: value
+            for key, value in body.items() if key != 'permissions'
+        }
+        self.categories[int(category_id)].update(definition)
+        return {'success': 'OK'}
+
+    def list_tag_groups(self, params, body):
+        return {'tag_groups': list(self.tag_groups.values())}
+
+    def create_tag_group(self, params, body):
+        return {'tag_group': self._insert(self.tag_groups, dict(body))}
+
+    def update_tag_group(self, params, body, tag_group_id):
+        self.tag_groups[int(tag_group_id)].update(body)
+        return {'tag_group': self.tag_groups[int(tag_group_id)]}
+
+    def list_site_settings(self, params, body):
+        return {
+            'site_settings': [{
+                'setting': name,
+                'value': value
+            } for name, value in self.site_settings.items()]
+        }
+
+    def update_site_setting(self, params, body, name):
+        self.site_settings[name] = body[name]
+        return {'success': 'OK'}
+
+    def list_users(self, params, body):
+        page = int(params.get('page', 1))
+        # Users are never deleted, so they are ordered by their ids already.
+        users = list(self.users.values())[(page - 1) * USERS_PAGE_SIZE:page *
+                                          USERS_PAGE_SIZE]
+        if params.get('show_emails') != 'true':
+            users = [{
+                key: value
+                for key, value in user.items() if key != 'email'
+            } for user in users]
+        return users
+
+    # Discourse reports failures to create a user in a successful response.
+    def create_user(self, params, body):
+        username = body['username']
+        if username.lower() in self.users_by_username:
+            return {
+                'success': False,
+                'message': f'Username {username} is taken'
+            }
+        user = self._insert(
+            self.users, {
+                'username': username,
+                'name': body.get('name') or '',
+                'email': body['email'],
+            })
+        self.users_by_username[username.lower()] = user
+        return {'success': True, 'active': True, 'user_id': user['id']}
+
+    def update_user(self, params, body, username):
+        user = self.users_by_username.get(username.lower())
+        if user is None:
+            raise NotFound(f'user {username}')
+        user.update({key: body[key] for key in ('name', ) if key in body})
+        return {'success': 'OK', 'user': user}
+
+    ROUTES = [
+        (r'GET groups\.json', list_groups),
+        (r'POST admin/groups\.json', create_group),
+        (r'PUT groups/(\d+)\.json', update_group),
+        (r'DELETE admin/groups/(\d+)\.json', delete_group),
+        (r'GET groups/([^/]+)/members\.json', list_members),
+        (r'PUT groups/(\d+)/members\.json', add_members),
+        (r'DELETE groups/(\d+)/members\.json', remove_members),
+        (r'GET site\.json', site),
+        (r'POST categories\.json', create_category),
+        (r'PUT categories/(\d+)\.json', update_category),
+        (r'GET tag_groups\.json', list_tag_groups),
+        (r'POST tag_groups\.json', create_tag_group),
+        (r'PUT tag_groups/(\d+)\.json', update_tag_group),
+        (r'GET admin/site_settings\.json', list_site_settings),
+        (r'PUT admin/site_settings/(\w+)\.json', update_site_setting),
+        (r'GET admin/users/list/all\.json', list_users),
+        (r'POST users\.json', create_user),
+        (r'PUT u/([^/]+)\.json', update_user),
+    ]
+
+
+# Refuses requests exceeding `rate` requests per second (over a sliding window
+# of one second).
+class RateLimiter:
+
+    def __init__(self, rate, retry_after=1):
+        self.rate = rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.recent = collections.deque()
+        self.refused = 0
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and self.recent[0] <= now - 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.rate:
+                self.refused += 1
+                return False
+            self.recent.append(now)
+            return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive connections, like the ones served by Unicorn.
+    protocol_version = 'HTTP/1.1'
+
+    # Set by `create_server`.
+    discourse = None
+    latency = 0
+    limiter = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body, headers={}):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        # The body has to be read even if the request is refused, otherwise
+        # it would be parsed as the next request on the connection.
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null')
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.limiter is not None and not self.limiter.allow():
+            self._respond(429, {'errors': ['Slow down, too many requests']},
+                          {'Retry-After': str(self.limiter.retry_after)})
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.lstrip('/')
+        if path == 'srv/status':
+            self._respond(200, b'ok')
+            return
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            response = self.discourse.handle(self.command, path, params, body)
+        except NotFound:
+            self._respond(404, {'errors': ['The requested URL is invalid']})
+        except (KeyError, ValueError) as e:
+            self._respond(422, {'errors': [str(e)]})
+        else:
+            if self.command != 'GET':
+                self._respond(200, response)
+                return
+            data = json.dumps(response).encode()
+            etag = f'W/"{hashlib.md5(data).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                self._respond(304, b'', {'ETag': etag})
+            else:
+                self._respond(200, data, {'ETag': etag})
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    # `BaseHTTPRequestHandler` expects the client address to be a tuple.
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+# Create a server of `discourse`, listening on the TCP `port` (on localhost)
+# or on the UNIX socket at `unix_socket`. `latency` (in seconds) is added to
+# every response and requests exceeding `rate_limit` per second are refused.
+def create_server(discourse,
+                  port=None,
+                  unix_socket=None,
+                  latency=0,
+                  rate_limit=None,
+                  retry_after=1):
+    limiter = None if rate_limit is None else RateLimiter(
+        rate_limit, retry_after)
+    handler = type(
+        'Handler',
+        (_Handler, ),
+        {
+            'discourse': discourse,
+            'latency': latency,
+            'limiter': limiter,
+            # Headers and body are written separately, with Nagle's algorithm
+            # every response of a keep-alive connection would be delayed until
+            # the client acknowledges the headers (40ms on Linux).
+            'disable_nagle_algorithm': unix_socket is None,
+        })
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        return _UnixHTTPServer(unix_socket, handler)
+    server = ThreadingHTTPServer(('127.0.0.1', port or 0), handler)
+    server.daemon_threads = True
+    return server
+
+
+# Serve requests in a background thread. Returns the base URL of the server.
+def serve_in_background(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if isinstance(server, _UnixHTTPServer):
+        return server.server_address
+    host, port = server.server_address
+    return f'http://{host}:{port}'
+
+
+# `fake-discourse` entry point (defined in the setup.py).
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a fake Discourse API for the applier')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8080,
+                        help='TCP port to listen on')
+    parser.add_argument('--unix-socket',
+                        default=None,
+                        help='UNIX socket to listen on instead of TCP')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Delay (in seconds) added to every response')
+    parser.add_argument('--page-size',
+                        type=int,
+                        default=GROUPS_PAGE_SIZE,
+                        help='Number of groups per page of groups.json')
+    parser.add_argument(
+        '--rate-limit',
+        type=float,
+        default=None,
+        help='Refuse requests exceeding this many per second with 429')
+    parser.add_argument('--retry-after',
+                        type=int,
+                        default=1,
+                        help='Retry-After (in seconds) of refused requests')
+    args = parser.parse_args()
+
+    discourse = FakeDiscourse(groups_page_size=args.page_size)
+    server = create_server(discourse,
+                           port=args.port,
+                           unix_socket=args.unix_socket,
+                           latency=args.latency,
+                           rate_limit=args.rate_limit,
+                           retry_after=args.retry_after)
+    print(f'Serving a fake Discourse API on {server.server_address}',
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,141 @@
+# Client-side rate governor used by the `DiscourseClient`.
+#
+# Discourse enforces per-key limits on the number of API requests. Instead of
+# guessing a fixed delay between the calls, the governor lets requests through
+# as fast as the server accepts them and learns the acceptable rate from the
+# 429 (Too Many Requests) responses:
+# - Until the first 429 is seen, requests are not limited at all.
+# - After a 429, the rate is set to a fraction of the rate observed just before
+#   it (multiplicative decrease) and all requests wait for the period
+#   requested by the server in the `Retry-After` header.
+# - Every successful request raises the rate a bit (additive increase), so the
+#   governor keeps probing for the limit.
+# Requests are spaced out by a token bucket, which allows short bursts of up to
+# `burst` requests.
+
+import collections
+import random
+import threading
+import time
+
+
+# Parse the value of a `Retry-After` header (either a number of seconds or an
+# HTTP date) into a number of seconds. Returns None if it cannot be parsed.
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # Imported here, as dates are rare and the module is slow to import.
+    import email.utils
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+# Delay before the `attempt`-th retry (counting from 0) of a failed request:
+# exponential backoff with full jitter.
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class RateGovernor:
+
+    # `rate` is the initial limit in requests per second (None means no limit
+    # until the server says otherwise).
+    def __init__(self,
+                 rate=None,
+                 burst=5,
+                 min_rate=0.2,
+                 decrease_factor=0.5,
+                 increase_step=0.1,
+                 window_seconds=10.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.window_seconds = window_seconds
+
+        self.lock = threading.Lock()
+        # Theoretical arrival time of the next request if the bucket was
+        # empty (virtual scheduling form of the token bucket).
+        self.next_arrival = 0.0
+        # Nobody may send a request before this time (set by `Retry-After`).
+        self.blocked_until = 0.0
+        # Send times of the recent requests, used to estimate the rate at
+        # which the server started refusing them.
+        self.recent = collections.deque()
+
+        # Sum of the delays of all requests (concurrent requests may wait at
+        # the same time, so it can exceed the wall time of the run).
+        self.throttled_seconds = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+
+    # Block until the next request may be sent.
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.blocked_until)
+            if self.rate is not None:
+                interval = 1.0 / self.rate
+                arrival = max(self.next_arrival, now)
+                start = max(start, arrival - (self.burst - 1) * interval)
+                self.next_arrival = max(arrival, start) + interval
+            wait = start - now
+            self.throttled_seconds += wait
+
+            self.recent.append(start)
+            while self.recent and self.recent[0] < start - self.window_seconds:
+                self.recent.popleft()
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate += self.increase_step
+
+    # Called when the server responded with 429. `retry_after` is the number
+    # of seconds the server asked to wait (if known).
+    def on_rate_limited(self, retry_after):
+        with self.lock:
+            self.rate_limited += 1
+            now = time.monotonic()
+            # Concurrent requests refused during the same pause are a result of
+            # a single violation, so the rate is decreased only once.
+            if now >= self.blocked_until:
+                if self.rate is None:
+                    # Rate of the requests sent within the window, bursts
+                    # shorter than a second are counted as lasting a second.
+                    span = now - self.recent[0] if self.recent else 0.0
+                    observed = len(self.recent) / max(span, 1.0)
+                else:
+                    observed = self.rate
+                self.rate = max(self.min_rate, observed * self.decrease_factor)
+                # The bucket starts empty after the pause.
+                self.next_arrival = 0.0
+
+            if retry_after is None:
+                retry_after = 1.0 / self.rate
+            # Spread the requests that were waiting for the pause to end, so
+            # they do not hit the server all at the same moment.
+            jitter = random.uniform(0, 1.0 / self.rate)
+            self.blocked_until = max(self.blocked_until,
+                                     now + retry_after + jitter)
+
+    def on_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def summary(self):
+        rate = 'unlimited' if self.rate is None else f'{self.rate:.2f} req/s'
+        return (f'{self.throttled_seconds:.2f}s of cumulative request delay,'
+                f' {self.rate_limited} requests rate limited,'
+                f' {self.retries} retries, current rate: {rate}')
@@ -0,0 +1,54 @@
+# Minimal binding of inotify(7), through ctypes (the standard library does not
+# provide one). Used to react to file changes without polling.
+
+import ctypes
+import os
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+# Events signalling that an entry of a watched directory changed.
+DIRECTORY_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+                     | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+
+# An inotify instance. Its file descriptor becomes readable whenever an event
+# occurs on one of the watched paths.
+# Raises OSError if inotify is not available.
+class Inotify:
+
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(f'inotify is not supported: {e}')
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise('inotify_init1')
+
+    def _raise(self, what):
+        error = ctypes.get_errno()
+        raise OSError(error, f'{what}: {os.strerror(error)}')
+
+    def add_watch(self, path, mask=DIRECTORY_CHANGES):
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            self._raise(f'Cannot watch {path}')
+
+    def fileno(self):
+        return self.fd
+
+    # Discard the pending events.
+    def drain(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
@@ -1,11 +1,34 @@
-import requests
-import requests_unixsocket
 import argparse
+import fnmatch
+import importlib
 import os
 import json
 import logging
+import sys
+import threading
+import time
 import urllib.parse
 
+# Local module ./governor.py
+from governor import RateGovernor, backoff_delay, parse_retry_after
+# Local module ./transport.py
+from transport import (TRANSPORTS, UNIX_SOCKET_SCHEME, HTTPError,
+                       TransportError, create_transport)
+
+# Requests using these methods can be repeated without changing the outcome
+# (with the exception of adding group members, see `add_group_members`).
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# Responses with these status codes are transient failures worth retrying.
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+# Number of members requested per page (the maximum accepted by Discourse).
+MEMBERS_PAGE_SIZE = 1000
+# Progress of pruning is logged after every this many deleted entities.
+PRUNE_BATCH_SIZE = 100
+
+# Every entry point imports this module, so the modules that only some of them
+# need (the store, the entity kinds, the membership checks, the metrics) are
+# imported by the functions using them, to keep the startup fast.
+
 # When modeling the Discourse entities (such as groups or categories), we can express
 # their desired configuration in Nix. Given that, we need a way to apply that configuration
 # to the Discourse instance. This is what this script is for.
@@ -52,73 +75,428 @@ import urllib.parse
 # identifiers and the Discourse-side identifiers in a persistent store.
 # Each time the script is run, it will load the store, compare the Nix-side identifiers
 # with the ones in the store and if they differ, it will assume that the group
-# was renamed. This is this store class:
+# was renamed.
+# Besides the mappings, the store keeps the definition and the hash of every
+# entity applied by the last successful run, and the hash of the whole config,
+# so that unchanged entities do not have to be applied again.
+#
+# The store is an SQLite database (in WAL mode). Every entity is committed as
+# soon as it is applied, so if the applier is interrupted, the next run does
+# not lose the ids learned so far and resumes with the entities that were not
+# applied yet.
+# Entities which existed before they were added to the config (and were found
+# by their name) are marked as adopted, so that they are never deleted when
+# they are removed from the config again. This is this store class:
 class AttributeNameToIdStore:
 
-    def __init__(self, path):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entities (
+            kind TEXT NOT NULL,
+            attr TEXT NOT NULL,
+            remote_id INTEGER,
+            hash TEXT,
+            definition TEXT,
+            adopted INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, attr)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS entities_by_remote_id
+            ON entities (kind, remote_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID;
+    """
+
+    # `legacy_path` is the location of the JSON file used by the previous
+    # versions of the store. If the database is created from scratch and the
+    # file exists, its contents are imported.
+    def __init__(self, path, legacy_path=None):
         logging.debug(f'Loading attribute to id mappings from {path}')
         self.path = path
 
-        try:
-            with open(path, 'r') as f:
-                self.data = json.load(f)
-        except FileNotFoundError:
+        # Check if the data directory exists.
+        if not os.path.exists(os.path.dirname(path)):
+            raise Exception(
+                f'Data directory {os.path.dirname(path)} does not exist')
+
+        import sqlite3
+
+        is_new = not os.path.exists(path)
+        # Entities may be applied concurrently, the connection is shared by
+        # all threads and guarded by a lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+        # Stores created before entities could be adopted.
+        columns = [
+            row[1] for row in self.db.execute('PRAGMA table_info(entities)')
+        ]
+        if 'adopted' not in columns:
+            self.db.execute('ALTER TABLE entities ADD COLUMN'
+                            ' adopted INTEGER NOT NULL DEFAULT 0')
+
+        if is_new:
             logging.info(
-                f'Attribute to id mappings file {path} not found, creating a new one'
+                f'Attribute to id mappings file {path} not found, created a new one'
             )
-            self.data = {"groups": {}}
-
-            # Check if the data directory exists.
-            if not os.path.exists(os.path.dirname(path)):
-                raise Exception(
-                    f'Data directory {os.path.dirname(path)} does not exist')
-
-    def save(self, with_config=None):
-        logging.debug(f'Saving attribute to id mappings to {self.path}')
-        if with_config is not None:
-            # Add the config to the store file, for testing/debugging purposes.
-            self.data["config"] = with_config
-        with open(self.path, 'w') as f:
-            json.dump(self.data, f)
-
-    def get_group_id(self, nix_attr_name, api_fallback):
-        gid = self.data['groups'].get(nix_attr_name)
+            if legacy_path is not None and os.path.exists(legacy_path):
+                self.import_json(legacy_path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # Import the mappings, hashes and config saved by the JSON-based store.
+    # The file is renamed afterwards, so that it is not imported again.
+    # The JSON-based store did not tell the entities it created from the ones
+    # it found by their names, so all of them are imported as adopted (and
+    # never deleted by `prune_orphans`).
+    def import_json(self, legacy_path):
+        logging.info(f'Importing attribute to id mappings from {legacy_path}')
+        with open(legacy_path, 'r') as f:
+            data = json.load(f)
+
+        hashes = data.get('hashes', {})
+        config = data.get('config') or {}
+        rows = []
+        for kind, ids in data.items():
+            if kind in ('hashes', 'config'):
+                continue
+            for attr, remote_id in ids.items():
+                definition = config.get(kind, {}).get(attr)
+                rows.append(
+                    (kind, attr, remote_id, hashes.get(kind, {}).get(attr),
+                     None if definition is None else json.dumps(definition),
+                     True))
+
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'INSERT INTO entities'
+                ' (kind, attr, remote_id, hash, definition, adopted)'
+                ' VALUES (?, ?, ?, ?, ?, ?)', rows)
+            if 'config' in hashes:
+                self.db.execute(
+                    "INSERT INTO meta (key, value) VALUES ('config_hash', ?)",
+                    (hashes['config'], ))
+        os.rename(legacy_path, legacy_path + '.imported')
+
+    def _query_one(self, query, parameters):
+        with self.lock:
+            row = self.db.execute(query, parameters).fetchone()
+        return None if row is None else row[0]
+
+    def get_id(self, kind, nix_attr_name, fallback):
+        gid = self._query_one(
+            'SELECT remote_id FROM entities WHERE kind = ? AND attr = ?',
+            (kind, nix_attr_name))
         if gid is None:
             logging.debug(
-                f'Nix attribute `services.discourse.groups.{nix_attr_name}`'
-                'had no corresponding discourse group id in the store file,'
-                ' using API fallback to find it')
-            gid = api_fallback()
-            self.set_group_id(nix_attr_name, gid)
+                f'Entity `{kind}.{nix_attr_name}` had no corresponding'
+                ' discourse id in the store file, using a fallback to find it')
+            gid = fallback()
+            self.set_id(kind, nix_attr_name, gid, adopted=True)
         return gid
 
-    def set_group_id(self, nix_attr_name, gid):
-        if gid is not None:
-            self.data["groups"][nix_attr_name] = gid
+    # `adopted` tells whether the remote entity existed already, as opposed to
+    # being created by the applier.
+    def set_id(self, kind, nix_attr_name, remote_id, adopted=False):
+        if remote_id is None:
+            return
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO entities (kind, attr, remote_id, adopted) VALUES (?, ?, ?, ?)'
+                ' ON CONFLICT (kind, attr) DO UPDATE SET remote_id = excluded.remote_id,'
+                ' adopted = excluded.adopted',
+                (kind, nix_attr_name, remote_id, adopted))
+
+    def get_hash(self, kind, nix_attr_name):
+        return self._query_one(
+            'SELECT hash FROM entities WHERE kind = ? AND attr = ?',
+            (kind, nix_attr_name))
+
+    # Definition of the entity that was applied during the previous run, or
+    # None if unknown.
+    def get_applied(self, kind, nix_attr_name):
+        definition = self._query_one(
+            'SELECT definition FROM entities WHERE kind = ? AND attr = ?',
+            (kind, nix_attr_name))
+        return None if definition is None else json.loads(definition)
+
+    # Entities of `kind` applied by the previous runs, as (attr, remote id,
+    # definition) triples.
+    def applied_entities(self, kind):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT attr, remote_id, definition FROM entities'
+                ' WHERE kind = ? AND definition IS NOT NULL'
+                ' ORDER BY attr', (kind, )).fetchall()
+        return [(attr, remote_id, json.loads(definition))
+                for attr, remote_id, definition in rows]
+
+    # Record that the entity was applied successfully. This is the checkpoint
+    # a resumed run starts from.
+    def commit_entity(self, kind, nix_attr_name, remote_id, entity_hash,
+                      definition):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO entities (kind, attr, remote_id, hash, definition)'
+                ' VALUES (?, ?, ?, ?, ?) ON CONFLICT (kind, attr) DO UPDATE SET'
+                ' remote_id = excluded.remote_id, hash = excluded.hash,'
+                ' definition = excluded.definition',
+                (kind, nix_attr_name, remote_id, entity_hash,
+                 json.dumps(definition, sort_keys=True)))
+
+    # Forget the hashes and definitions of the entities of `kind` that are not
+    # in `nix_attr_names` (so they will be applied if they are ever added
+    # back). Their ids are kept.
+    def forget_missing(self, kind, nix_attr_names):
+        with self.lock:
+            stored = [
+                attr for (attr, ) in self.db.execute(
+                    'SELECT attr FROM entities WHERE kind = ?', (kind, ))
+            ]
+            missing = [(kind, attr) for attr in stored
+                       if attr not in nix_attr_names]
+            self.db.executemany(
+                'UPDATE entities SET hash = NULL, definition = NULL'
+                ' WHERE kind = ? AND attr = ?', missing)
+
+    # Entities of `kind` that are not in `nix_attr_names`, but are still
+    # mapped to remote entities, as (attr, remote id, adopted) triples. Remote
+    # entities that an attribute in the config is mapped to are left out.
+    def orphans(self, kind, nix_attr_names):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT attr, remote_id, adopted FROM entities'
+                ' WHERE kind = ? AND remote_id IS NOT NULL',
+                (kind, )).fetchall()
+        in_use = {
+            remote_id
+            for attr, remote_id, _ in rows if attr in nix_attr_names
+        }
+        orphans = {}
+        for attr, remote_id, adopted in rows:
+            if attr not in nix_attr_names and remote_id not in in_use:
+                orphans.setdefault(remote_id, (attr, remote_id, bool(adopted)))
+        return list(orphans.values())
+
+    # Forget the entity of `kind` with `remote_id`, along with all the
+    # attributes mapped to it.
+    def delete_entity(self, kind, remote_id):
+        with self.lock:
+            self.db.execute(
+                'DELETE FROM entities WHERE kind = ? AND remote_id = ?',
+                (kind, remote_id))
+
+    def get_config_hash(self):
+        return self._query_one(
+            "SELECT value FROM meta WHERE key = 'config_hash'", ())
+
+    def set_config_hash(self, config_hash):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES ('config_hash', ?)"
+                ' ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                (config_hash, ))
+
+
+# Kinds of entities (see ./entities.py), imported when first needed.
+def _kinds():
+    # Local module ./entities.py
+    from entities import KINDS
+    return KINDS
 
 
 # REST API client for Discourse.
-# FIXME: Pagination is not supported.
+# The client owns a transport (see ./transport.py) with a pool of keep-alive
+# connections, so it should be closed when no longer needed. The transport is
+# created when the first request is made, so that runs which do not call the
+# API do not pay for importing it.
+# Every attempt of a request is recorded in `metrics`.
+# Requests are paced by a `RateGovernor`. Requests refused with 429 are retried
+# after the period requested by the server (the request was not processed, so
+# this is safe for any method), other transient failures are retried only for
+# idempotent requests.
+# Paginated listings are exposed as generators, which fetch the next page only
+# when the previous one was consumed. This keeps the memory usage independent
+# of the size of the listing and allows to stop early.
+# With a `response_cache` (see ./drift.py), GET requests are conditional: the
+# ETag of the cached response is sent in `If-None-Match` and if Discourse
+# responds with 304 Not Modified, the cached body is used.
 class DiscourseClient:
 
-    def __init__(self, url, token):
+    # `timeout` is a (connect timeout, read timeout) tuple, in seconds.
+    # `transport` is the name of one of the `TRANSPORTS`.
+    def __init__(self,
+                 url,
+                 token,
+                 pool_size=4,
+                 timeout=(5, 60),
+                 governor=None,
+                 max_retries=8,
+                 metrics=None,
+                 transport='requests',
+                 response_cache=None):
+        self.transport_name = transport
+        self.pool_size = pool_size
         self.headers = {'Api-Key': token, 'Api-Username': 'system'}
+        self.transport_lock = threading.Lock()
+        self._transport = None
+        self.timeout = timeout
         self.url = url
+        self.governor = governor if governor is not None else RateGovernor()
+        self.max_retries = max_retries
+        if metrics is None:
+            # Local module ./metrics.py
+            from metrics import Metrics
+            metrics = Metrics()
+        self.metrics = metrics
+        self.response_cache = response_cache
+
+    @property
+    def transport(self):
+        with self.transport_lock:
+            if self._transport is None:
+                self._transport = create_transport(self.transport_name,
+                                                   self.pool_size,
+                                                   self.timeout[0],
+                                                   self.headers)
+            return self._transport
 
-    def _request(self, method, path, data=None):
+    def close(self):
+        with self.transport_lock:
+            if self._transport is not None:
+                self._transport.close()
+                self._transport = None
+
+    def _attempt(self, method, url, data, params, endpoint, headers):
+        start = time.perf_counter()
+        with self.metrics.span('request', f'{method} {endpoint}') as span:
+            try:
+                res = self.transport.request(method, url, data, params,
+                                             self.timeout, headers)
+            except TransportError:
+                span['status'] = 'error'
+                self.metrics.observe_request(method, endpoint, 'error',
+                                             time.perf_counter() - start, 0, 0)
+                raise
+            # Reading `content` waits for the whole body, so it is included
+            # in the latency.
+            received = len(res.content)
+            span['status'] = res.status_code
+            self.metrics.observe_request(method, endpoint, res.status_code,
+                                         time.perf_counter() - start,
+                                         res.sent_bytes, received)
+        return res
+
+    def _send(self, method, url, data, params, endpoint, headers=None):
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            retryable = method in IDEMPOTENT_METHODS and not last_attempt
+            if attempt > 0:
+                self.metrics.count_retry(method, endpoint)
+
+            self.governor.acquire()
+            try:
+                res = self._attempt(method, url, data, params, endpoint,
+                                    headers)
+            except TransportError as e:
+                if not retryable:
+                    raise
+                logging.warning(f'{method} {url} failed ({e}), retrying')
+            else:
+                if res.status_code == 429:
+                    retry_after = parse_retry_after(
+                        res.headers.get('Retry-After'))
+                    self.governor.on_rate_limited(retry_after)
+                    if last_attempt:
+                        return res
+                    logging.debug(
+                        f'{method} {url} was rate limited (Retry-After: {retry_after}), retrying'
+                    )
+                    self.governor.on_retry()
+                    # The governor delays the next attempt.
+                    continue
+                if res.status_code not in RETRYABLE_STATUS_CODES or not retryable:
+                    self.governor.on_success()
+                    return res
+                logging.warning(
+                    f'{method} {url} failed with status code {res.status_code}, retrying'
+                )
+
+            self.governor.on_retry()
+            time.sleep(backoff_delay(attempt))
+
+    # `endpoint` labels the request in the metrics. By default it is derived
+    # from the path, paths containing names have to provide it explicitly.
+    def _request(self, method, path, data=None, params=None, endpoint=None):
         url = f"{self.url}/{path}"
-        res = requests.request(method, url, headers=self.headers, json=data)
-        res.raise_for_status()
+        if endpoint is None:
+            # Local module ./metrics.py
+            from metrics import endpoint_of
+            endpoint = endpoint_of(path)
+        cached = None
+        headers = None
+        if method == 'GET' and self.response_cache is not None:
+            cached = self.response_cache.get(url, params)
+            if cached is not None:
+                headers = {'If-None-Match': cached[0]}
+        res = self._send(method, url, data, params, endpoint, headers)
+        if res.status_code == 304 and cached is not None:
+            return json.loads(cached[1])
         # Discourse API returns 200 in every successful case
         if res.status_code != 200:
-            raise Exception(
-                f'API request failed with status code {res.status_code} and body {res.text}'
+            raise HTTPError(
+                res.status_code,
+                f'API request {method} {path} failed with status code {res.status_code} and body {res.text}'
             )
+        if method == 'GET' and self.response_cache is not None:
+            etag = res.headers.get('ETag')
+            if etag is not None:
+                self.response_cache.put(url, params, etag, res.content)
         return res.json()
 
+    # Iterate over all groups visible to the API user.
+    # Discourse returns them in pages of a fixed size, numbered from 0.
+    def iter_groups(self):
+        page = 0
+        seen = 0
+        while True:
+            res = self._request('GET', 'groups.json', params={'page': page})
+            groups = res['groups']
+            yield from groups
+
+            seen += len(groups)
+            total = res.get('total_rows_groups')
+            if not groups or (total is not None and seen >= total):
+                return
+            page += 1
+
+    # Iterate over all members of the group named `group_name`.
+    def iter_group_members(self, group_name, page_size=MEMBERS_PAGE_SIZE):
+        offset = 0
+        while True:
+            res = self._request('GET',
+                                f'groups/{group_name}/members.json',
+                                params={
+                                    'offset': offset,
+                                    'limit': page_size
+                                },
+                                endpoint='groups/{name}/members.json')
+            members = res['members']
+            yield from members
+
+            offset += len(members)
+            if not members or offset >= res['meta']['total']:
+                return
+
     def find_group_id_by_name(self, name):
-        res = self._request('GET', 'groups.json')
-        for group in res['groups']:
+        for group in self.iter_groups():
             if group['name'] == name:
                 gid = group['id']
                 logging.debug(
@@ -128,10 +506,6 @@ class DiscourseClient:
         logging.debug(f'No group with name \'{name}\' was found using the API')
         return None
 
-    def get_group_members(self, group_name):
-        res = self._request('GET', f'groups/{group_name}/members.json')
-        return res['members']
-
     def create_group(self, definition):
         # https://docs.discourse.org/#tag/Groups/operation/createGroup
         data = {'group': definition}
@@ -151,6 +525,121 @@ class DiscourseClient:
             f'Updated group {definition["name"]} with id = {group_id} using the API'
         )
 
+    def delete_group(self, group_id):
+        # https://docs.discourse.org/#tag/Groups/operation/deleteGroup
+        self._request('DELETE', f'admin/groups/{group_id}.json')
+        logging.debug(f'Deleted group with id = {group_id} using the API')
+
+    def add_group_members(self, group_id, usernames):
+        # https://docs.discourse.org/#tag/Groups/operation/addGroupMembers
+        data = {'usernames': ','.join(usernames)}
+        try:
+            self._request('PUT', f'groups/{group_id}/members.json', data=data)
+        except HTTPError as e:
+            # Unlike other PUT requests, adding members is not idempotent:
+            # Discourse responds with 422 if all the users are members
+            # already. That is the case when the request is retried after an
+            # attempt whose response was lost had added them, and either way
+            # the users end up being members.
+            if e.status_code != 422 or 'already a member' not in str(e):
+                raise
+            logging.debug(f'Users {data["usernames"]} are members of group'
+                          f' {group_id} already')
+
+    def remove_group_members(self, group_id, usernames):
+        # https://docs.discourse.org/#tag/Groups/operation/removeGroupMembers
+        data = {'usernames': ','.join(usernames)}
+        self._request('DELETE', f'groups/{group_id}/members.json', data=data)
+
+    # All categories (including subcategories) visible to the API user.
+    def list_categories(self):
+        res = self._request('GET', 'site.json')
+        return res['categories']
+
+    def create_category(self, definition):
+        # https://docs.discourse.org/#tag/Categories/operation/createCategory
+        res = self._request('POST', 'categories.json', data=definition)
+        cid = res['category']['id']
+        logging.debug(
+            f'Created category with name \'{definition["name"]}\' and id = {cid} using the API'
+        )
+        return cid
+
+    def update_category(self, category_id, definition):
+        # https://docs.discourse.org/#tag/Categories/operation/updateCategory
+        self._request('PUT', f'categories/{category_id}.json', data=definition)
+        logging.debug(
+            f'Updated category {definition["name"]} with id = {category_id} using the API'
+        )
+
+    def list_tag_groups(self):
+        res = self._request('GET', 'tag_groups.json')
+        return res['tag_groups']
+
+    def create_tag_group(self, definition):
+        # https://docs.discourse.org/#tag/Tags/operation/createTagGroup
+        res = self._request('POST', 'tag_groups.json', data=definition)
+        tid = res['tag_group']['id']
+        logging.debug(
+            f'Created tag group with name \'{definition["name"]}\' and id = {tid} using the API'
+        )
+        return tid
+
+    def update_tag_group(self, tag_group_id, definition):
+        # https://docs.discourse.org/#tag/Tags/operation/updateTagGroup
+        self._request('PUT',
+                      f'tag_groups/{tag_group_id}.json',
+                      data=definition)
+        logging.debug(
+            f'Updated tag group {definition["name"]} with id = {tag_group_id} using the API'
+        )
+
+    def list_site_settings(self):
+        res = self._request('GET', 'admin/site_settings.json')
+        return res['site_settings']
+
+    def update_site_setting(self, name, value):
+        self._request('PUT',
+                      f'admin/site_settings/{name}.json',
+                      data={name: value},
+                      endpoint='admin/site_settings/{name}.json')
+        logging.debug(f'Updated site setting {name} using the API')
+
+    # A single page (numbered from 1) of all the users (including the ones
+    # not activated, suspended or staged, whose usernames are taken too),
+    # along with their emails. Pages have a fixed size, the first empty one
+    # ends the listing.
+    def list_users(self, page):
+        # https://docs.discourse.org/#tag/Users/operation/adminListUsers
+        return self._request('GET',
+                             'admin/users/list/all.json',
+                             params={
+                                 'page': page,
+                                 'show_emails': 'true'
+                             })
+
+    def create_user(self, definition):
+        # https://docs.discourse.org/#tag/Users/operation/createUser
+        res = self._request('POST', 'users.json', data=definition)
+        # Discourse responds with 200 even if the user cannot be created.
+        if not res.get('success'):
+            raise Exception(
+                f'Creating user {definition["username"]} failed: {res.get("message")}'
+            )
+        uid = res['user_id']
+        logging.debug(
+            f'Created user with username \'{definition["username"]}\' and id = {uid} using the API'
+        )
+        return uid
+
+    def update_user(self, username, definition):
+        # https://docs.discourse.org/#tag/Users/operation/updateUser
+        self._request('PUT',
+                      f'u/{username}.json',
+                      data=definition,
+                      endpoint='u/{username}.json')
+        logging.debug(f'Updated user {username} using the API')
+
 
 # The business logic of the applier.
 # Expects to be given a path to a JSON config file, which describes the desired
@@ -160,54 +649,330 @@ class DiscourseClient:
 #     # Nix-side identifier of the group may be any string.
 #     # There may be any number of groups such as the one below.
 #     "@nix-side-identifier": {
-#        # Attributes of the group, as described in the Discourse API docs
+#        # Attributes of the group, as described in the Discourse API docs,
+#        # except for `usernames`, which is a list of the group members.
 #      }
-#   }
+#   },
+#   # Other kinds of entities, see ./entities.py for their formats.
+#   "categories": { ... },
+#   "tag_groups": { ... },
+#   "site_settings": { ... }
 # }
+# The config may also be compiled (see ./artifact.py), with the hashes,
+# references and order of the entities already derived from it. A plain config
+# is compiled when it is loaded, so either way it is validated before anything
+# is applied.
+# Entities that do not reference each other are independent, so up to `jobs`
+# of them can be applied concurrently. An entity referencing other entities
+# (e.g. a category granting permissions to a group) is applied after them.
+# Only the entities whose definition changed since the last successful run are
+# applied, and if the whole config is the same, the run ends right away.
+# Changes made to the entities outside of the applier (e.g. in the admin panel)
+# are therefore corrected only if the config changes or `force` is set.
+# The time spent in every phase of the run (load, diff, fetch, write, save) and
+# on every entity is recorded in the metrics of the client.
+# If `cache_snapshots` is set, the snapshots of the remote entities are kept
+# between runs (and updated with the entities applied), so that a long-running
+# applier does not have to fetch them every time the config changes.
+# If `prune` is set, entities removed from the config are deleted afterwards
+# (see `prune_orphans`), except for the ones named in `keep`.
+# A run can be limited to the entities matching the `only` selectors and not
+# matching the `exclude` ones (see `select`). Such a run applies only a part of
+# the config, so it leaves the rest of the store as it is and does not record
+# the hash of the config.
 class Configurator:
 
-    def __init__(self, client, config, data_dir):
+    def __init__(self,
+                 client,
+                 config,
+                 data_dir,
+                 jobs=1,
+                 force=False,
+                 cache_snapshots=False,
+                 prune=False,
+                 keep=(),
+                 only=(),
+                 exclude=()):
         self.client = client
+        self.metrics = client.metrics
+        self.jobs = jobs
+        self.force = force
+        self.cache_snapshots = cache_snapshots
+        self.prune = prune
+        self.keep = set(keep)
+        self.only = list(only)
+        self.exclude = list(exclude)
+        # Kind name -> `Snapshot`, if `cache_snapshots` is set.
+        self.snapshots = {}
 
-        with open(config, 'r') as f:
-            self.config = json.load(f)
+        with self.metrics.span('phase', 'load'):
+            self.load(config)
+            self.store = AttributeNameToIdStore(
+                os.path.join(data_dir, 'state.sqlite3'),
+                legacy_path=os.path.join(data_dir,
+                                         'nix_to_discourse_ids.json'))
 
-        data_path = os.path.join(data_dir, 'nix_to_discourse_ids.json')
-        self.store = AttributeNameToIdStore(data_path)
+        # Local module ./reconcile.py
+        from reconcile import ReconcileStats
+        self.stats = ReconcileStats()
 
-    # Apply the desired configuration of a single group.
-    # If the group does not exist, it will be created.
-    # If the group exists, but its name differs from the one in the config,
-    # it will be updated.
-    def apply_group(self, group_attr_name, definition):
-        api_fallback = lambda: self.client.find_group_id_by_name(definition[
-            'name'])
-        discourse_group_id = self.store.get_group_id(group_attr_name,
-                                                     api_fallback)
+    def load(self, config):
+        # Local module ./artifact.py
+        import artifact
+        self.compiled = artifact.load(config)
+        self.config = self.compiled.config
 
-        if discourse_group_id is None:
-            logging.debug(
-                f'Nix attribute `services.discourse.groups.{group_attr_name}` had no corresponding discourse group'
-            )
-            discourse_group_id = self.client.create_group(definition)
-            self.store.set_group_id(group_attr_name, discourse_group_id)
-        else:
-            logging.debug(
-                f'Nix attribute `services.discourse.groups.{group_attr_name}` was mapped to discourse group of id = {discourse_group_id}`'
-            )
-            self.client.update_group(discourse_group_id, definition)
+    # Apply a single entity and commit it to the store along with its hash.
+    # `snapshot` is a `Snapshot` of the remote entities of the same kind.
+    def apply_entity(self, kind, attr, definition, entity_hash, snapshot):
+        with self.metrics.span('entity', f'{kind.name}.{attr}') as span:
+            remote_id, outcome = kind.apply(self, attr, definition, snapshot)
+            span['outcome'] = outcome
+            self.stats.count(outcome)
+            self.store.commit_entity(kind.name, attr, remote_id, entity_hash,
+                                     definition)
+
+    def fetch_snapshot(self, kind):
+        if kind.name in self.snapshots:
+            return self.snapshots[kind.name]
+        with self.metrics.span('snapshot', kind.name):
+            snapshot = kind.snapshot(self.client)
+        if self.cache_snapshots:
+            self.snapshots[kind.name] = snapshot
+        return snapshot
+
+    # Fetch the snapshots of the kinds of entities in the config again, to
+    # notice changes made outside of the applier.
+    def refresh_snapshots(self):
+        # Local module ./parallel.py
+        from parallel import map_ordered
+
+        kinds = [kind for kind in _kinds() if self.config.get(kind.name)]
+        self.snapshots.clear()
+        map_ordered(self.fetch_snapshot, [(kind, ) for kind in kinds],
+                    self.jobs)
+
+    # Keys of the entities matching the selectors, along with all the entities
+    # they reference (directly or not), as those have to be applied first.
+    # `references` maps the keys of all entities to the keys they reference.
+    # Selectors are `kind.attr` glob patterns, where `kind` is either the key
+    # of the kind in the config or the name of its Nix option, e.g.
+    # `groups.students`, `tagGroups.*` or `categories.cs-*`.
+    def select(self, references):
+        kinds = {kind.name: kind for kind in _kinds()}
+
+        def matching(patterns, key):
+            kind = kinds[key[0]]
+            names = {f'{kind.name}.{key[1]}', f'{kind.option}.{key[1]}'}
+            return [
+                pattern for pattern in patterns if any(
+                    fnmatch.fnmatchcase(name, pattern) for name in names)
+            ]
+
+        selected = set()
+        unused = set(self.only)
+        for key in references:
+            matched = matching(self.only, key)
+            unused.difference_update(matched)
+            if self.only and not matched:
+                continue
+            if not matching(self.exclude, key):
+                selected.add(key)
+        if unused:
+            raise Exception('No entity in the config matches the selectors: ' +
+                            ', '.join(sorted(unused)))
+
+        to_visit = list(selected)
+        while to_visit:
+            for ref in references[to_visit.pop()]:
+                if ref not in selected:
+                    selected.add(ref)
+                    to_visit.append(ref)
+        return selected
+
+    # `force` overrides the one given to the constructor.
+    def apply(self, force=None):
+        # Local module ./reconcile.py
+        from reconcile import ReconcileStats
+
+        force = self.force if force is None else force
+        self.stats = ReconcileStats()
+        reconciled = self.apply_changes(force)
+        if self.prune:
+            self.prune_orphans()
+        # Logged after pruning, so that the deleted entities are counted.
+        if reconciled or self.stats.deleted:
+            logging.info(f'Reconciled entities ({self.stats})')
+
+    # Apply the entities that changed since the last run. Returns whether
+    # the whole config was reconciled (and not skipped as unchanged or only
+    # partially applied).
+
+    def apply_changes(self, force):
+        # Local module ./parallel.py
+        from parallel import map_ordered, run_graph
+
+        with self.metrics.span('phase', 'diff'):
+            config_hash = self.compiled.hash
+            if not force and self.store.get_config_hash() == config_hash:
+                logging.info(
+                    'The config did not change since the last successful run, nothing to apply'
+                )
+                return False
+
+            references = self.compiled.references
+            partial = bool(self.only or self.exclude)
+            if partial:
+                selected = self.select(references)
+                logging.info(f'Selected {len(selected)} of {len(references)}'
+                             ' entities')
+
+            # Entities applied by an interrupted run have their hashes
+            # committed already, so they are skipped here as well.
+            kinds = {kind.name: kind for kind in _kinds()}
+            changed = {}
+            for key, entity_hash in self.compiled.entities.items():
+                if partial and key not in selected:
+                    continue
+                kind_name, attr = key
+                if (not force
+                        and self.store.get_hash(kind_name, attr) == entity_hash):
+                    self.stats.count('unchanged')
+                else:
+                    changed[key] = (kinds[kind_name], attr,
+                                    self.config[kind_name][attr], entity_hash)
+
+        if changed:
+            # Take a single snapshot of the remote entities of every kind that
+            # has something to apply, instead of querying the API separately
+            # for every entity.
+            kinds = [
+                kind for kind in _kinds()
+                if any(key[0] == kind.name for key in changed)
+            ]
+            with self.metrics.span('phase', 'fetch'):
+                snapshots = map_ordered(self.fetch_snapshot,
+                                        [(kind, ) for kind in kinds],
+                                        self.jobs)
+            snapshots = dict(zip((kind.name for kind in kinds), snapshots))
+            for kind in kinds:
+                logging.debug(
+                    f'Fetched a snapshot of {len(snapshots[kind.name])} {kind.name}'
+                )
+
+            # Unchanged entities are applied already, so only the references
+            # between changed entities constrain the order. The order of all
+            # the entities is an order of the changed ones as well.
+            dependencies = {
+                key: [ref for ref in references[key] if ref in changed]
+                for key in changed
+            }
+            order = [key for key in self.compiled.order if key in changed]
+            items = [(key, changed[key] + (snapshots[key[0]], ))
+                     for key in order]
+            with self.metrics.span('phase', 'write'):
+                run_graph(self.apply_entity, items, dependencies, self.jobs)
+
+        if partial:
+            logging.info(f'Reconciled the selected entities ({self.stats}),'
+                         ' the rest of the config was not applied')
+            return False
+
+        with self.metrics.span('phase', 'save'):
+            for kind in _kinds():
+                self.store.forget_missing(
+                    kind.name,
+                    self.config.get(kind.name, {}).keys())
+            self.store.set_config_hash(config_hash)
+        return True
+
+    # Remote entities which the applier created (or adopted) for attributes
+    # that are no longer in the config. Returns a list of (kind, attr, remote
+    # entity, reason, snapshot of the kind) tuples, where `reason` tells why
+    # the entity must be kept (or is None). Entities which no longer exist are
+    # forgotten right away.
+    def find_orphans(self):
+        orphans = []
+        for kind in _kinds():
+            if not kind.prunable:
+                continue
+            candidates = self.store.orphans(
+                kind.name,
+                self.config.get(kind.name, {}).keys())
+            if not candidates:
+                continue
+            snapshot = self.fetch_snapshot(kind)
+            for attr, remote_id, adopted in candidates:
+                remote = snapshot.by_id.get(remote_id)
+                if remote is None:
+                    logging.debug(
+                        f'{kind.name}.{attr} (id = {remote_id}) was deleted'
+                        ' already, forgetting it')
+                    self.store.delete_entity(kind.name, remote_id)
+                    continue
+                reason = None
+                if kind.protected(remote):
+                    reason = 'it is managed by Discourse'
+                elif adopted:
+                    reason = 'it existed before it was added to the config'
+                elif remote.get('name') in self.keep:
+                    reason = 'it is kept explicitly'
+                orphans.append((kind, attr, remote, reason, snapshot))
+        return orphans
+
+    def delete_orphan(self, kind, attr, remote, snapshot):
+        try:
+            kind.delete(self.client, remote['id'])
+        except HTTPError as e:
+            if e.status_code != 404:
+                raise
+        self.store.delete_entity(kind.name, remote['id'])
+        snapshot.remove(remote['id'])
+        self.stats.count('deleted')
+        logging.debug(f'Deleted {kind.name}.{attr} ({remote.get("name")})')
 
-    # TODO: Implement deletion of groups that are not present in the config
-    def apply(self):
-        for group_attr_name, definition in self.config["groups"].items():
-            self.apply_group(group_attr_name, definition)
-        self.store.save(with_config=self.config)
+    # Delete the remote entities removed from the config. Only the entities
+    # created by the applier are deleted: the ones that Discourse manages, the
+    # ones that existed before they were added to the config and the ones
+    # listed in `keep` are just forgotten. Deletions are made by up to `jobs`
+    # workers at once. With `dry_run`, nothing is deleted or forgotten and the
+    # orphans are returned instead.
+    def prune_orphans(self, dry_run=False):
+        # Local module ./parallel.py
+        from parallel import map_ordered
+        # Local module ./reconcile.py
+        from reconcile import chunks
 
+        with self.metrics.span('phase', 'prune'):
+            orphans = self.find_orphans()
+            if dry_run:
+                return orphans
 
+            to_delete = []
+            for kind, attr, remote, reason, snapshot in orphans:
+                if reason is None:
+                    to_delete.append((kind, attr, remote, snapshot))
+                    continue
+                logging.info(
+                    f'Not deleting {kind.name}.{attr} ({remote.get("name")}),'
+                    f' as {reason}, only forgetting it')
+                self.store.delete_entity(kind.name, remote['id'])
+
+            done = 0
+            for chunk in chunks(to_delete, PRUNE_BATCH_SIZE):
+                map_ordered(self.delete_orphan, chunk, self.jobs)
+                done += len(chunk)
+                logging.info(f'Pruned {done}/{len(to_delete)} entities')
+        return orphans
+
+
+# `argv` are the arguments to parse (by default the ones the program was run
+# with), subcommands parse the arguments following their name.
 class ArgumentProvider:
 
-    def __init__(self, default_loglevel='info'):
-        self.parser = argparse.ArgumentParser()
+    def __init__(self, default_loglevel='info', prog=None, argv=None):
+        self.argv = argv
+        self.parser = argparse.ArgumentParser(prog=prog)
         self.parser.add_argument(
             '--loglevel',
             default=default_loglevel,
@@ -222,17 +987,104 @@ class ArgumentProvider:
             help='UNIX domain socket path, which'
             ' should be used instead of the standard TCP transport',
             default=None)
+        self.parser.add_argument(
+            '--pool-size',
+            type=int,
+            default=4,
+            help='Maximum number of keep-alive connections to Discourse')
+        self.parser.add_argument(
+            '--connect-timeout',
+            type=float,
+            default=5,
+            help='Timeout (in seconds) for establishing a connection')
+        self.parser.add_argument(
+            '--read-timeout',
+            type=float,
+            default=60,
+            help='Timeout (in seconds) for receiving a response')
+        self.parser.add_argument(
+            '--rate-limit',
+            type=float,
+            default=None,
+            help='Initial limit of API requests per second. By default'
+            ' requests are not limited until Discourse responds with 429')
+        self.parser.add_argument(
+            '--max-retries',
+            type=int,
+            default=8,
+            help='Maximum number of retries of a single API request')
+        self.parser.add_argument(
+            '--transport',
+            choices=TRANSPORTS,
+            default=None,
+            help='HTTP implementation used to talk to Discourse. stdlib starts'
+            ' faster, but supports only plain HTTP (over TCP or a UNIX socket).'
+            ' By default stdlib with --unix-socket and requests otherwise')
+        self.parser.add_argument(
+            '--metrics-file',
+            default=None,
+            help='Write request and timing metrics to this file in the'
+            ' Prometheus text format (for the node exporter textfile collector)'
+        )
+        self.parser.add_argument(
+            '--trace',
+            default=None,
+            help='Write a trace of the run to this file in the Chrome trace'
+            ' format (viewable in chrome://tracing or ui.perfetto.dev)')
 
     def add_config_related_options(self):
         self.parser.add_argument('config', help='Path to the config file')
         self.parser.add_argument('data_dir', help='Path to the data directory')
+        self.parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help='Number of entities that may be applied concurrently')
+        self.parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Apply all entities, even if the config did not change'
+            ' since the last successful run')
+        self.parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='Delete the groups created by the applier that were removed'
+            ' from the config')
+        self.parser.add_argument(
+            '--keep',
+            action='append',
+            default=[],
+            help='Name of a group never deleted by --prune (may be repeated)')
 
     def add_user_with_group(self):
-        self.parser.add_argument('user', help='Discourse username')
-        self.parser.add_argument('group', help='Discourse group name')
+        self.parser.add_argument('user', nargs='?', help='Discourse username')
+        self.parser.add_argument('group',
+                                 nargs='?',
+                                 help='Discourse group name')
+        self.parser.add_argument(
+            '--batch',
+            default=None,
+            help='File with (user, group) pairs to check instead, one per'
+            ' line, separated by whitespace or a comma (- for stdin)')
+        self.parser.add_argument(
+            '--cache-dir',
+            default=None,
+            help='Directory in which the members of the groups are cached')
+        self.parser.add_argument(
+            '--cache-ttl',
+            type=float,
+            default=300,
+            help='Time (in seconds) for which the cached members are used')
+        self.parser.add_argument(
+            '--jobs',
+            type=int,
+            default=4,
+            help='Number of groups whose members may be fetched concurrently')
 
     def parse_args(self):
-        args = self.parser.parse_args()
+        # Optional positional arguments (e.g. of `user-in-group`) may follow
+        # options as well.
+        args = self.parser.parse_intermixed_args(self.argv)
 
         # Discourse API is always available to access from the local machine
         # through a UNIX socket on which Unicorn listens.
@@ -240,18 +1092,19 @@ class ArgumentProvider:
         # environment it is useful to run applier on another machine, so that the
         # applier can be run independently from the Discourse instance virtual machine.
         if hasattr(args, 'url') and args.unix_socket:
-            # Allow using UNIX sockets in the requests package
-            requests_unixsocket.monkeypatch()
-
+            # `DiscourseClient` routes URLs with this scheme through the socket.
             escaped_path = urllib.parse.quote_plus(args.unix_socket)
-            args.url = f'http+unix://{escaped_path}'
+            args.url = f'{UNIX_SOCKET_SCHEME}{escaped_path}'
+        # The socket is plain HTTP, which the faster stdlib transport speaks.
+        if hasattr(args, 'url') and args.transport is None:
+            args.transport = 'stdlib' if args.unix_socket else 'requests'
 
         logging.basicConfig(level=args.loglevel.upper())
         # Do it before loading the token from the environment
         logging.info(
             f'The applier started with the following arguments: {args}')
 
-        args.token = os.environ['DISCOURSE_API_KEY']
+        args.token = os.environ.get('DISCOURSE_API_KEY')
         if hasattr(args, 'url') and args.token is None:
             raise Exception(
                 'DISCOURSE_API_KEY environment variable is not set')
@@ -259,30 +1112,153 @@ class ArgumentProvider:
         return args
 
 
+def create_client(args):
+    # Local module ./metrics.py
+    from metrics import Metrics
+
+    # Every worker applying entities concurrently needs its own connection.
+    pool_size = max(args.pool_size, getattr(args, 'jobs', 1))
+    return DiscourseClient(args.url,
+                           args.token,
+                           pool_size=pool_size,
+                           timeout=(args.connect_timeout, args.read_timeout),
+                           governor=RateGovernor(rate=args.rate_limit),
+                           max_retries=args.max_retries,
+                           metrics=Metrics(trace=args.trace is not None),
+                           transport=args.transport)
+
+
+# Export the metrics collected by the client, as requested by the arguments.
+def export_metrics(args, client):
+    governor = client.governor
+    client.metrics.set_gauge('applier_throttled_seconds',
+                             governor.throttled_seconds,
+                             'Cumulative delay imposed by the rate governor.')
+    client.metrics.set_gauge('applier_rate_limited_requests',
+                             governor.rate_limited,
+                             'Requests refused by Discourse with 429.')
+    if args.metrics_file is not None:
+        client.metrics.write_prometheus(args.metrics_file)
+        logging.debug(f'Wrote metrics to {args.metrics_file}')
+    if args.trace is not None:
+        client.metrics.write_trace(args.trace)
+        logging.debug(f'Wrote the trace to {args.trace}')
+
+
+# Subcommands of the `applier`: name -> (module, function). The function is
+# given the arguments following the name of the subcommand. The modules are
+# imported only when needed, as they depend on this one.
+SUBCOMMANDS = {
+    'daemon': ('daemon', 'run_daemon'),
+    'control': ('daemon', 'control'),
+    'wait': ('wait', 'wait'),
+    'drift': ('drift', 'drift'),
+    'users': ('users', 'provision_users'),
+    'compile': ('artifact', 'compile_command'),
+}
+
+
 # `applier` entry point (defined in the setup.py).
+# Without a subcommand, the config is applied once.
 def apply():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module, function = SUBCOMMANDS[sys.argv[1]]
+        command = getattr(importlib.import_module(module), function)
+        return command(sys.argv[2:])
+
     provider = ArgumentProvider()
     provider.add_url_related_options()
     provider.add_config_related_options()
+    provider.parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only list the groups --prune would delete, without applying'
+        ' or deleting anything')
+    provider.parser.add_argument(
+        '--only',
+        action='append',
+        default=[],
+        help='Apply only the entities matching this kind.attr glob pattern'
+        ' (e.g. groups.students, may be repeated) and the entities they'
+        ' reference')
+    provider.parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        help='Do not apply the entities matching this kind.attr glob pattern'
+        ' (may be repeated), unless the applied entities reference them')
     args = provider.parse_args()
+    if args.dry_run and not args.prune:
+        provider.parser.error('--dry-run can only be used with --prune')
+    if args.prune and (args.only or args.exclude):
+        provider.parser.error(
+            '--prune needs the whole config, it cannot be used with --only'
+            ' or --exclude')
 
-    client = DiscourseClient(args.url, args.token)
-    configurator = Configurator(client, args.config, args.data_dir)
-    configurator.apply()
+    client = create_client(args)
+    # The metrics are exported even if the run fails, as they may help to
+    # find out why.
+    try:
+        configurator = Configurator(client,
+                                    args.config,
+                                    args.data_dir,
+                                    jobs=args.jobs,
+                                    force=args.force,
+                                    prune=args.prune,
+                                    keep=args.keep,
+                                    only=args.only,
+                                    exclude=args.exclude)
+        if args.dry_run:
+            orphans = configurator.prune_orphans(dry_run=True)
+            for kind, attr, remote, reason, _ in orphans:
+                action = 'delete' if reason is None else f'keep ({reason})'
+                print(f'{kind.name}.{attr}\t{remote.get("name")}\t{action}')
+            configurator.store.close()
+            return
+        configurator.apply()
+        configurator.store.close()
+    finally:
+        client.close()
+        export_metrics(args, client)
 
+    logging.info(f'Rate governor: {client.governor.summary()}')
     logging.info('Applied the configuration successfully')
 
 
 # entry point used by the test suite
+# Checks that the user is a member of the group, or with `--batch`, that all
+# the (user, group) pairs listed in a file hold (see ./membership.py). The
+# pairs that do not hold are printed, one per line, and make the exit code 1.
 def assert_user_in_group():
+    # Local module ./membership.py
+    from membership import MemberCache, MembershipChecker, read_pairs
+
     provider = ArgumentProvider()
     provider.add_url_related_options()
     provider.add_user_with_group()
     args = provider.parse_args()
+    if args.batch is None and (args.user is None or args.group is None):
+        provider.parser.error('either a user and a group or --batch is needed')
+
+    if args.batch is None:
+        pairs = [(args.user, args.group)]
+    elif args.batch == '-':
+        pairs = [(user, group) for _, user, group in read_pairs(sys.stdin)]
+    else:
+        with open(args.batch, 'r') as f:
+            pairs = [(user, group) for _, user, group in read_pairs(f)]
 
-    client = DiscourseClient(args.url, args.token)
+    cache = None
+    if args.cache_dir is not None:
+        cache = MemberCache(args.cache_dir, args.cache_ttl)
+    client = create_client(args)
+    try:
+        mismatches = MembershipChecker(client, cache, args.jobs).check(pairs)
+    finally:
+        client.close()
+        export_metrics(args, client)
 
-    if client.find_group_id_by_name(args.group) is None:
-        raise Exception(f'Group with name {args.group} does not exist')
-    members = client.get_group_members(args.group)
-    assert args.user in [member["username"] for member in members]
+    for user, group, reason in mismatches:
+        print(f'{user}\t{group}\t{reason}')
+    if mismatches:
+        raise SystemExit(1)
@@ -0,0 +1,129 @@
+# Verification of group memberships (`user-in-group`).
+#
+# A batch of (user, group) pairs is checked at once. The members of every
+# group are fetched only once, no matter how many pairs refer to the group
+# (different groups are fetched concurrently), and indexed in a set of
+# lowercase usernames (Discourse usernames are case insensitive). A group that
+# does not exist is recognized by the 404 response to the listing of its
+# members, so the list of all groups is not needed.
+#
+# The member sets can also be cached on disk for a given time, so that checks
+# run one after another (e.g. by a post-deploy script) do not fetch the same
+# groups again.
+
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+# Local module ./parallel.py
+from parallel import map_ordered
+# Local module ./transport.py
+from transport import HTTPError
+
+
+# Read (line number, user, group) triples from `f`, one pair per line, with
+# the user and the group separated by whitespace or a comma. Empty lines and
+# lines starting with # are skipped.
+def read_pairs(f):
+    for number, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.replace(',', ' ').split()
+        if len(fields) != 2:
+            raise ValueError(
+                f'Line {number} should contain a user and a group: {line}')
+        yield number, fields[0], fields[1]
+
+
+# Member sets of groups cached in `directory`, a JSON file per group. Entries
+# older than `ttl` seconds are ignored.
+class MemberCache:
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, group):
+        return os.path.join(
+            self.directory,
+            urllib.parse.quote(group.lower(), safe='') + '.json')
+
+    # The cached member set of the group, or None if there is none that is
+    # fresh enough.
+    def load(self, group):
+        try:
+            with open(self._path(group), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('fetched_at', 0) > self.ttl:
+            return None
+        return set(entry['usernames'])
+
+    def store(self, group, usernames):
+        path = self._path(group)
+        # Concurrent checks may read the file at any moment, so it has to be
+        # replaced at once.
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(
+                {
+                    'fetched_at': time.time(),
+                    'usernames': sorted(usernames)
+                }, f)
+        os.replace(temporary_path, path)
+
+
+class MembershipChecker:
+
+    def __init__(self, client, cache=None, jobs=1):
+        self.client = client
+        self.cache = cache
+        self.jobs = jobs
+
+    # Lowercase usernames of the members of the group, or None if there is no
+    # such group.
+    def members(self, group):
+        if self.cache is not None:
+            usernames = self.cache.load(group)
+            if usernames is not None:
+                logging.debug(
+                    f'Members of group {group} loaded from the cache')
+                return usernames
+        try:
+            usernames = {
+                member['username'].lower()
+                for member in self.client.iter_group_members(group)
+            }
+        except HTTPError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        logging.debug(f'Fetched {len(usernames)} members of group {group}')
+        if self.cache is not None:
+            self.cache.store(group, usernames)
+        return usernames
+
+    # Check the (user, group) `pairs` and return the ones that do not hold,
+    # in the same order, along with the reason.
+    def check(self, pairs):
+        groups = list(dict.fromkeys(group for _, group in pairs))
+        indexes = dict(
+            zip(
+                groups,
+                map_ordered(self.members, [(group, ) for group in groups],
+                            self.jobs)))
+        mismatches = []
+        for user, group in pairs:
+            members = indexes[group]
+            if members is None:
+                mismatches.append((user, group, 'the group does not exist'))
+            elif user.lower() not in members:
+                mismatches.append((user, group, 'not a member'))
+        logging.info(f'Checked {len(pairs)} memberships in {len(groups)}'
+                     f' groups, {len(mismatches)} do not hold')
+        return mismatches
@@ -0,0 +1,231 @@
+# Instrumentation of the applier.
+#
+# `Metrics` collects the latency of every API request (per endpoint and
+# method), the number of bytes sent and received, retries and the time spent
+# in every phase of a run and on every entity. The data can be exported as:
+# - a Prometheus textfile-collector file (see
+#   https://github.com/prometheus/node_exporter#textfile-collector),
+# - a Chrome trace (JSON that can be opened in chrome://tracing or
+#   https://ui.perfetto.dev), showing what every worker thread was doing.
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+# Upper bounds (in seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+# Turn a request path into a label shared by all requests to the same
+# endpoint, e.g. `groups/42.json` into `groups/{id}.json`.
+def endpoint_of(path):
+    return re.sub(r'(^|/)\d+(?=/|\.json|$)', r'\1{id}', path.split('?')[0])
+
+
+def _labels(**labels):
+    escaped = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        value = value.replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+
+    # Trace events are kept for every span (including every request), so
+    # long runs should collect them only if `trace` is set.
+    def __init__(self, trace=True):
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.latency = {}
+        self.requests = {}
+        self.bytes_sent = {}
+        self.bytes_received = {}
+        self.retries = {}
+        self.phases = {}
+        self.entities = {}
+        self.gauges = {}
+        # Complete ("X") events of the Chrome trace format.
+        self.trace_events = []
+        self.thread_ids = {}
+
+    # Forget the timings of the previous run (of a long-running applier).
+    # Request metrics are cumulative, so they are kept.
+    def start_run(self):
+        with self.lock:
+            self.started = time.time()
+            self.origin = time.perf_counter()
+            self.phases.clear()
+            self.entities.clear()
+            self.trace_events.clear()
+
+    def _add(self, counters, key, value):
+        counters[key] = counters.get(key, 0) + value
+
+    # Record a single attempt of an API request. `status` is the HTTP status
+    # code, or 'error' if no response was received.
+    def observe_request(self, method, endpoint, status, seconds, sent,
+                        received):
+        key = (method, endpoint)
+        with self.lock:
+            self.latency.setdefault(key, _Histogram()).observe(seconds)
+            self._add(self.requests, key + (str(status), ), 1)
+            self._add(self.bytes_sent, key, sent)
+            self._add(self.bytes_received, key, received)
+
+    def count_retry(self, method, endpoint):
+        with self.lock:
+            self._add(self.retries, (method, endpoint), 1)
+
+    def set_gauge(self, name, value, help_text):
+        with self.lock:
+            self.gauges[name] = (value, help_text)
+
+    # Measure the duration of the enclosed block. Spans of the 'phase' and
+    # 'entity' categories are also exported to Prometheus. The block may add
+    # arguments shown in the trace to the yielded dict.
+    @contextlib.contextmanager
+    def span(self, category, name, **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            duration = time.perf_counter() - start
+            thread = threading.get_ident()
+            with self.lock:
+                if self.trace:
+                    tid = self.thread_ids.setdefault(thread,
+                                                     len(self.thread_ids))
+                    self.trace_events.append({
+                        'name': name,
+                        'cat': category,
+                        'ph': 'X',
+                        'ts': (start - self.origin) * 1e6,
+                        'dur': duration * 1e6,
+                        'pid': os.getpid(),
+                        'tid': tid,
+                        'args': args,
+                    })
+                if category == 'phase':
+                    self._add(self.phases, name, duration)
+                elif category == 'entity':
+                    self._add(self.entities, name, duration)
+
+    def write_trace(self, path):
+        with self.lock:
+            trace = {
+                'traceEvents':
+                sorted(self.trace_events, key=lambda event: event['ts']),
+                'displayTimeUnit':
+                'ms',
+            }
+        _write_atomically(path, json.dumps(trace))
+
+    def prometheus_text(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            metric('applier_request_duration_seconds', 'histogram',
+                   'Latency of API requests.')
+            for (method, endpoint), histogram in sorted(self.latency.items()):
+                for bound, count in zip(LATENCY_BUCKETS, histogram.buckets):
+                    labels = _labels(method=method,
+                                     endpoint=endpoint,
+                                     le=bound)
+                    lines.append(
+                        f'applier_request_duration_seconds_bucket{labels} {count}'
+                    )
+                labels = _labels(method=method, endpoint=endpoint, le='+Inf')
+                lines.append(
+                    f'applier_request_duration_seconds_bucket{labels} {histogram.count}'
+                )
+                labels = _labels(method=method, endpoint=endpoint)
+                lines.append(
+                    f'applier_request_duration_seconds_sum{labels} {histogram.sum}'
+                )
+                lines.append(
+                    f'applier_request_duration_seconds_count{labels} {histogram.count}'
+                )
+
+            metric('applier_requests_total', 'counter',
+                   'API requests by response status.')
+            for (method, endpoint,
+                 status), count in sorted(self.requests.items()):
+                labels = _labels(method=method,
+                                 endpoint=endpoint,
+                                 status=status)
+                lines.append(f'applier_requests_total{labels} {count}')
+
+            for name, counters, help_text in [
+                ('applier_request_sent_bytes_total', self.bytes_sent,
+                 'Bytes of request bodies sent.'),
+                ('applier_response_received_bytes_total', self.bytes_received,
+                 'Bytes of response bodies received.'),
+                ('applier_request_retries_total', self.retries,
+                 'Retried API requests.'),
+            ]:
+                metric(name, 'counter', help_text)
+                for (method, endpoint), value in sorted(counters.items()):
+                    labels = _labels(method=method, endpoint=endpoint)
+                    lines.append(f'{name}{labels} {value}')
+
+            metric('applier_phase_duration_seconds', 'gauge',
+                   'Time spent in a phase of the last run.')
+            for phase, seconds in sorted(self.phases.items()):
+                lines.append(
+                    f'applier_phase_duration_seconds{_labels(phase=phase)} {seconds}'
+                )
+
+            metric('applier_entity_duration_seconds', 'gauge',
+                   'Time spent applying an entity in the last run.')
+            for entity, seconds in sorted(self.entities.items()):
+                lines.append(
+                    f'applier_entity_duration_seconds{_labels(entity=entity)} {seconds}'
+                )
+
+            for name, (value, help_text) in sorted(self.gauges.items()):
+                metric(name, 'gauge', help_text)
+                lines.append(f'{name} {value}')
+
+            metric('applier_last_run_timestamp_seconds', 'gauge',
+                   'Start time of the last run.')
+            lines.append(f'applier_last_run_timestamp_seconds {self.started}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        _write_atomically(path, self.prometheus_text())
+
+
+# The textfile collector may read the file at any moment, so it has to be
+# replaced at once.
+def _write_atomically(path, content):
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        f.write(content)
+    os.replace(temporary_path, path)
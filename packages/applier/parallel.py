@@ -0,0 +1,225 @@
+# Helpers for applying entities concurrently.
+#
+# Entities are applied by a bounded pool of worker threads, an entity that
+# depends on other entities is applied only after them. To keep the output of
+# the applier deterministic regardless of how the work gets scheduled, log
+# records emitted by a worker are held back and replayed in the order in which
+# the entities were submitted.
+
+import collections
+import concurrent.futures
+import logging
+import threading
+
+_local = threading.local()
+
+
+# Filter attached to the handlers of the root logger. It diverts records
+# emitted on a worker thread into the buffer of the entity that is currently
+# being applied there. Filters of a logger do not see the records propagated
+# from its child loggers (e.g. `urllib3.connectionpool`), while the filters of
+# its handlers do. A record passes all the handlers on the thread that emitted
+# it one after another, so it is buffered only once.
+class _CaptureFilter(logging.Filter):
+
+    def filter(self, record):
+        buffer = getattr(_local, 'buffer', None)
+        if buffer is None:
+            return True
+        if not buffer or buffer[-1] is not record:
+            buffer.append(record)
+        return False
+
+
+_capture_filter = _CaptureFilter()
+# Number of running pools capturing records (pools may be nested), guarded by
+# the lock.
+_capturing = 0
+_capturing_lock = threading.Lock()
+
+
+def _start_capturing():
+    global _capturing
+    with _capturing_lock:
+        _capturing += 1
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(_capture_filter)
+
+
+def _stop_capturing():
+    global _capturing
+    with _capturing_lock:
+        _capturing -= 1
+        if _capturing == 0:
+            for handler in logging.getLogger().handlers:
+                handler.removeFilter(_capture_filter)
+
+
+def _call_captured(function, item):
+    _local.buffer = []
+    try:
+        return function(*item), _local.buffer, None
+    except Exception as e:
+        return None, _local.buffer, e
+    finally:
+        _local.buffer = None
+
+
+def _replay(records):
+    logger = logging.getLogger()
+    for record in records:
+        logger.handle(record)
+
+
+# Call `function(*item)` for every item using up to `jobs` threads and return
+# the results in the order of `items`. If any call raises, the remaining calls
+# are cancelled and the exception of the first failed item is re-raised.
+def map_ordered(function, items, jobs):
+    if jobs <= 1:
+        return [function(*item) for item in items]
+
+    _start_capturing()
+    results = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(_call_captured, function, item) for item in items
+            ]
+            try:
+                for future in futures:
+                    result, records, error = future.result()
+                    _replay(records)
+                    if error is not None:
+                        raise error
+                    results.append(result)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        _stop_capturing()
+    return results
+
+
+def _result(future):
+    result, records, error = future.result()
+    _replay(records)
+    if error is not None:
+        raise error
+    return result
+
+
+# Like `map_ordered`, but `items` may be any iterable (even an infinite one)
+# and the results are yielded one by one. Items are taken from `items` only
+# when there are less than `2 * jobs` calls whose results were not yielded
+# yet, so the memory usage does not depend on the number of items. Closing the
+# generator cancels the calls that did not start yet.
+def imap_ordered(function, items, jobs):
+    if jobs <= 1:
+        for item in items:
+            yield function(*item)
+        return
+
+    _start_capturing()
+    pending = collections.deque()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            try:
+                for item in items:
+                    pending.append(pool.submit(_call_captured, function, item))
+                    if len(pending) >= 2 * jobs:
+                        yield _result(pending.popleft())
+                while pending:
+                    yield _result(pending.popleft())
+            finally:
+                for future in pending:
+                    future.cancel()
+    finally:
+        _stop_capturing()
+
+
+# Order `keys` so that every key comes after all of its `dependencies` (a dict
+# mapping keys to collections of keys they depend on). Among the keys that are
+# ready at the same time, the original order of `keys` is preserved.
+def topological_order(keys, dependencies):
+    remaining = {key: set(dependencies.get(key, ())) for key in keys}
+    order = []
+    while remaining:
+        ready = [key for key in remaining if not remaining[key]]
+        if not ready:
+            cycle = ', '.join(str(key) for key in remaining)
+            raise Exception(f'Dependency cycle between: {cycle}')
+        for key in ready:
+            del remaining[key]
+            order.append(key)
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+
+# Call `function(*args)` for every `(key, args)` pair of `items` using up to
+# `jobs` threads, calling it for a key only after the calls for all of its
+# `dependencies` finished. `items` must be in a topological order (see
+# `topological_order`), which is also the order in which log records are
+# replayed. If any call raises, no new calls are started and the exception of
+# the first failed item is re-raised once the running calls finish.
+def run_graph(function, items, dependencies, jobs):
+    if jobs <= 1:
+        for _, args in items:
+            function(*args)
+        return
+
+    order = [key for key, _ in items]
+    arguments = dict(items)
+    waiting_for = {key: set(dependencies.get(key, ())) for key in order}
+    dependents = {key: [] for key in order}
+    for key, deps in waiting_for.items():
+        for dep in deps:
+            dependents[dep].append(key)
+
+    _start_capturing()
+    finished = {}
+    next_to_replay = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            running = {}
+
+            def submit(key):
+                future = pool.submit(_call_captured, function, arguments[key])
+                running[future] = key
+
+            for key in order:
+                if not waiting_for[key]:
+                    submit(key)
+
+            failed = False
+            while running:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    _, records, error = future.result()
+                    finished[key] = (records, error)
+                    failed = failed or error is not None
+                    if failed:
+                        continue
+                    for dependent in dependents[key]:
+                        waiting_for[dependent].discard(key)
+                        if not waiting_for[dependent]:
+                            submit(dependent)
+
+                while (next_to_replay < len(order)
+                       and order[next_to_replay] in finished):
+                    _replay(finished[order[next_to_replay]][0])
+                    next_to_replay += 1
+    finally:
+        _stop_capturing()
+
+    # After a failure some calls are never started, replay the records of the
+    # calls that finished after them.
+    for key in order[next_to_replay:]:
+        if key in finished:
+            _replay(finished[key][0])
+    for key in order:
+        if key in finished and finished[key][1] is not None:
+            raise finished[key][1]
@@ -0,0 +1,164 @@
+# Helpers used by the `Configurator` to find out which of the desired entities
+# actually differ from the ones already present in the Discourse instance.
+#
+# Instead of asking the API about every entity separately, the `Configurator`
+# downloads the list of remote entities once (a snapshot), indexes it and then
+# compares every desired definition with its remote counterpart field by field.
+# Only the entities that really differ are sent back to the API.
+
+import hashlib
+import json
+import threading
+import time
+
+
+# Hash of the canonical JSON representation of `value`. Used to find out
+# whether the config (or a single entity) changed since the last run, without
+# asking the API about it.
+def canonical_hash(value):
+    canonical = json.dumps(value,
+                           sort_keys=True,
+                           separators=(',', ':'),
+                           ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Index of the remote entities of a single kind (e.g. groups), built from a
+# single listing of them.
+# Entities applied by the `Configurator` are recorded in the snapshot, so that
+# it stays accurate if it is reused by the next run (see ./daemon.py).
+class Snapshot:
+
+    def __init__(self, entities, id_key='id', name_key='name'):
+        self.id_key = id_key
+        self.name_key = name_key
+        self.taken_at = time.time()
+        self.lock = threading.Lock()
+        self.by_id = {}
+        self.by_name = {}
+        for entity in entities:
+            self.by_id[entity[id_key]] = entity
+            self.by_name[entity[name_key]] = entity
+
+    def __len__(self):
+        return len(self.by_id)
+
+    # Record that the entity with `entity_id` was created or updated with
+    # `definition`.
+    def record(self, entity_id, definition):
+        with self.lock:
+            entity = dict(self.by_id.get(entity_id, {self.id_key: entity_id}))
+            if self.by_name.get(entity.get(self.name_key)) is not None:
+                del self.by_name[entity[self.name_key]]
+            entity.update(definition)
+            self.by_id[entity_id] = entity
+            self.by_name[entity[self.name_key]] = entity
+
+    # Record that the entity with `entity_id` was deleted.
+    def remove(self, entity_id):
+        with self.lock:
+            entity = self.by_id.pop(entity_id, None)
+            if entity is not None:
+                self.by_name.pop(entity.get(self.name_key), None)
+
+    def find_id_by_name(self, name):
+        entity = self.by_name.get(name)
+        if entity is None:
+            return None
+        return entity[self.id_key]
+
+
+# The API does not always express values the same way as the config does, e.g.
+# an empty bio of a group is returned as `null` instead of an empty string and
+# the order of tags in a tag group is not preserved.
+def _normalize(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return sorted(value, key=str)
+    return value
+
+
+# Compare the desired definition of an entity with its remote counterpart and
+# return the (sorted) names of the attributes that differ.
+#
+# Not every attribute that can be set through the API is also returned by it
+# (e.g. `owner_usernames` of a group). Such attributes are compared with the
+# definition applied during the previous run instead. If that one is unknown
+# too, the attribute is assumed to differ.
+def diff_definition(desired, remote, last_applied=None):
+    changed = []
+    for attr, value in desired.items():
+        if attr in remote:
+            current = remote[attr]
+        elif last_applied is not None and attr in last_applied:
+            current = last_applied[attr]
+        else:
+            changed.append(attr)
+            continue
+
+        if _normalize(value) != _normalize(current):
+            changed.append(attr)
+    return sorted(changed)
+
+
+# Hash of the attributes set by `desired`, with their values taken from
+# `entity` and normalized the way `diff_definition` compares them. Attributes
+# missing from `entity` are taken from `desired` itself (they cannot be
+# compared). The hash of `desired` equals the one of its remote counterpart
+# exactly when `diff_definition` finds no difference between them, so only
+# the entities whose hashes differ need to be compared field by field.
+def projection_hash(desired, entity):
+    projection = {
+        attr: _normalize(entity[attr] if attr in entity else value)
+        for attr, value in desired.items()
+    }
+    return canonical_hash(projection)
+
+
+# Compare the desired members of a group with the current ones. Both are
+# given as dicts mapping lowercase usernames (Discourse usernames are case
+# insensitive) to usernames. Members listed in `protected` are never removed.
+# Returns sorted lists of usernames to add and to remove.
+def diff_members(desired, current, protected=()):
+    to_add = [desired[u] for u in desired.keys() - current.keys()]
+    to_remove = [
+        current[u] for u in current.keys() - desired.keys()
+        if u not in protected
+    ]
+    return sorted(to_add), sorted(to_remove)
+
+
+# Split `items` into lists of at most `size` elements.
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Number of API calls issued (or avoided) during a single run of the applier,
+# along with the number of membership changes and deleted entities. Entities
+# may be applied concurrently, so the counters are guarded by a lock.
+class ReconcileStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self.members_added = 0
+        self.members_removed = 0
+        self.deleted = 0
+
+    # Increase the counter named `outcome` (e.g. 'created') by `n`.
+    def count(self, outcome, n=1):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + n)
+
+    def __str__(self):
+        return (f'created: {self.created}, updated: {self.updated},'
+                f' skipped (already up to date): {self.skipped},'
+                f' unchanged since the last run: {self.unchanged},'
+                f' members added: {self.members_added},'
+                f' members removed: {self.members_removed},'
+                f' deleted: {self.deleted}')
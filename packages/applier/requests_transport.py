@@ -0,0 +1,90 @@
+# The `requests` transport of the `DiscourseClient` (see ./transport.py).
+#
+# All API calls made by the client go through a single `requests.Session`, so
+# that connections (both TCP and UNIX socket ones) are kept alive and reused
+# between the calls, instead of being opened anew for every request.
+
+import requests
+import requests_unixsocket
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+from requests_unixsocket.adapters import UnixHTTPConnectionPool
+
+# Local module ./transport.py
+from transport import UNIX_SOCKET_SCHEME, TransportError
+
+
+# Connection pool holding up to `maxsize` keep-alive connections to a single
+# UNIX socket.
+class _UnixSocketConnectionPool(UnixHTTPConnectionPool):
+
+    def __init__(self, socket_url, timeout, maxsize):
+        super().__init__(socket_url, timeout)
+        # `UnixHTTPConnectionPool` always creates a pool of size 1, recreate
+        # the underlying queue with the requested size.
+        self.pool = self.QueueCls(maxsize)
+        for _ in range(maxsize):
+            self.pool.put(None)
+
+
+# Transport adapter for the `http+unix://` scheme. It is mounted on the
+# session instead of relying on `requests_unixsocket.monkeypatch()`, which
+# patches the `requests` module globally.
+#
+# `requests_unixsocket.UnixAdapter` keeps a separate single-connection pool for
+# every requested URL, so a connection is reused only when the exact same URL
+# is requested again. This adapter keeps one pool per socket instead.
+class UnixSocketAdapter(requests_unixsocket.UnixAdapter):
+
+    def __init__(self, pool_size, connect_timeout):
+        super().__init__(timeout=connect_timeout)
+        self.pool_size = pool_size
+
+    def get_connection(self, url, proxies=None):
+        if proxies and proxies.get(urlparse(url.lower()).scheme):
+            raise ValueError(
+                f'{self.__class__.__name__} does not support proxies')
+
+        socket_path = urlparse(url).netloc
+        with self.pools.lock:
+            pool = self.pools.get(socket_path)
+            if pool is None:
+                pool = _UnixSocketConnectionPool(url, self.timeout,
+                                                 self.pool_size)
+                self.pools[socket_path] = pool
+        return pool
+
+
+# Create a session that keeps up to `pool_size` connections alive per host
+# (or per UNIX socket).
+def create_session(pool_size, connect_timeout):
+    session = requests.Session()
+    http_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', http_adapter)
+    session.mount('https://', http_adapter)
+    session.mount(UNIX_SOCKET_SCHEME,
+                  UnixSocketAdapter(pool_size, connect_timeout))
+    return session
+
+
+class RequestsTransport:
+
+    def __init__(self, pool_size, connect_timeout, headers):
+        self.session = create_session(pool_size, connect_timeout)
+        self.session.headers.update(headers)
+
+    def request(self, method, url, data, params, timeout, headers=None):
+        try:
+            response = self.session.request(method,
+                                            url,
+                                            json=data,
+                                            params=params,
+                                            headers=headers,
+                                            timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise TransportError(str(e)) from e
+        response.sent_bytes = len(response.request.body or b'')
+        return response
+
+    def close(self):
+        self.session.close()
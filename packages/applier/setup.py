@@ -7,11 +7,19 @@ from setuptools import setup, find_packages
 setup(
     name='applier',
     packages=find_packages(),
-    py_modules=['main'],
+    py_modules=[
+        'main', 'artifact', 'benchmark', 'daemon', 'drift', 'entities',
+        'fake_discourse', 'governor', 'inotify', 'membership', 'metrics',
+        'parallel', 'reconcile', 'requests_transport', 'startup_benchmark',
+        'stdlib_transport', 'transport', 'unix_http', 'users', 'wait'
+    ],
     entry_points={
         'console_scripts': [
             'applier = main:apply',
             'user-in-group = main:assert_user_in_group',
+            'fake-discourse = fake_discourse:main',
+            'applier-benchmark = benchmark:main',
+            'applier-startup-benchmark = startup_benchmark:main',
         ]
     },
 )
@@ -0,0 +1,142 @@
+# Startup benchmark of the applier.
+#
+# When the config did not change since the last run, the applier has nothing
+# to do, so its run time is made of the interpreter startup and the imports.
+# This measures:
+# - the import time of ./main.py, broken down into the modules it imports (as
+#   reported by `python -X importtime`),
+# - the wall time of such an `applier` run and of a `user-in-group` check,
+#   with both transports, against the fake Discourse API from
+#   ./fake_discourse.py.
+# Medians of `--runs` runs are reported.
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Local module ./benchmark.py
+from benchmark import current_commit, generate_config, run_applier
+# Local module ./fake_discourse.py
+from fake_discourse import FakeDiscourse, create_server, serve_in_background
+
+# import time: <self us> | <cumulative us> | <indentation><module>
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+# Parse the output of `-X importtime` into a tree of (name, cumulative
+# microseconds, children) nodes. Modules are listed after the modules they
+# import, which are indented more.
+def parse_importtime(output):
+    stack = []
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        depth = len(match.group(3))
+        children = []
+        while stack and stack[-1][0] > depth:
+            children.insert(0, stack.pop()[1])
+        stack.append((depth, (match.group(4), int(match.group(2)), children)))
+    return [node for _, node in stack]
+
+
+# Median cumulative import time (in milliseconds) of ./main.py and of the
+# modules it imports directly.
+def measure_imports(runs):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    samples = {}
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import main'],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True)
+        for name, cumulative, children in parse_importtime(process.stderr):
+            if name != 'main':
+                continue
+            samples.setdefault('main', []).append(cumulative)
+            for child, child_cumulative, _ in children:
+                samples.setdefault(child, []).append(child_cumulative)
+    return {
+        name: statistics.median(values) / 1000
+        for name, values in samples.items()
+    }
+
+
+# Median wall times (in seconds) of runs which have nothing to apply and of
+# `user-in-group` checks.
+def measure_runs(runs, transport):
+    discourse = FakeDiscourse()
+    with tempfile.TemporaryDirectory() as directory:
+        unix_socket = os.path.join(directory, 'discourse.sock')
+        server = create_server(discourse, unix_socket=unix_socket)
+        serve_in_background(server)
+        config = os.path.join(directory, 'config.json')
+        with open(config, 'w') as f:
+            json.dump(generate_config(10, 10), f)
+
+        common = [
+            'http://localhost', '--unix-socket', unix_socket, '--transport',
+            transport
+        ]
+        # The first run applies the config, the following ones have nothing
+        # to apply.
+        run_applier(common + [config, directory])
+        nothing_to_apply = [
+            run_applier(common + [config, directory])[0] for _ in range(runs)
+        ]
+        user_in_group = [
+            run_applier(common + ['user0_0', 'group0'],
+                        entry_point='assert_user_in_group')[0]
+            for _ in range(runs)
+        ]
+        server.shutdown()
+        server.server_close()
+    return {
+        'nothing_to_apply_seconds': statistics.median(nothing_to_apply),
+        'user_in_group_seconds': statistics.median(user_in_group),
+    }
+
+
+# `applier-startup-benchmark` entry point (defined in the setup.py).
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the startup time of the applier')
+    parser.add_argument('--runs',
+                        type=int,
+                        default=10,
+                        help='Number of runs to take the median of')
+    parser.add_argument('--output',
+                        default=None,
+                        help='JSON lines file the results are appended to')
+    args = parser.parse_args()
+
+    imports = measure_imports(args.runs)
+    result = {
+        'commit': current_commit(),
+        'time': int(time.time()),
+        'import_main_ms': imports.pop('main')
+    }
+    print(f'Import of main: {result["import_main_ms"]:.1f} ms, of which:')
+    for name, milliseconds in sorted(imports.items(),
+                                     key=lambda item: -item[1])[:10]:
+        print(f'{name:>24}: {milliseconds:.1f} ms')
+
+    for transport in ('requests', 'stdlib'):
+        runs = measure_runs(args.runs, transport)
+        print(
+            f'{transport:>8} transport: nothing to apply in'
+            f' {runs["nothing_to_apply_seconds"] * 1000:.0f} ms,'
+            f' user-in-group in {runs["user_in_group_seconds"] * 1000:.0f} ms')
+        result[transport] = runs
+
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
@@ -0,0 +1,113 @@
+# The `stdlib` transport of the `DiscourseClient` (see ./transport.py), based on
+# `http.client`.
+
+import http.client
+import json
+import select
+import threading
+import urllib.parse
+
+# Local module ./transport.py
+from transport import TransportError
+# Local module ./unix_http.py
+from unix_http import UnixHTTPConnection
+
+
+class Response:
+
+    def __init__(self, status_code, headers, content, sent_bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.sent_bytes = sent_bytes
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+# Whether the server closed an idle keep-alive connection (an idle
+# connection becomes readable only when it is closed).
+def _is_dropped(connection):
+    return (connection.sock is None
+            or bool(select.select([connection.sock], [], [], 0)[0]))
+
+
+class StdlibTransport:
+
+    def __init__(self, pool_size, connect_timeout, headers):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.headers = dict(headers)
+        self.lock = threading.Lock()
+        # Idle connections by (scheme, address).
+        self.idle = {}
+
+    def _connect(self, scheme, address):
+        if scheme == 'http+unix':
+            return UnixHTTPConnection(urllib.parse.unquote(address),
+                                      timeout=self.connect_timeout)
+        if scheme == 'http':
+            return http.client.HTTPConnection(address,
+                                              timeout=self.connect_timeout)
+        raise ValueError(f'The stdlib transport does not support {scheme}://')
+
+    def _acquire(self, key):
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                connection = idle.pop()
+                if not _is_dropped(connection):
+                    return connection
+                connection.close()
+        return self._connect(*key)
+
+    def _release(self, key, connection):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    # `timeout` is a (connect timeout, read timeout) tuple, the connect
+    # timeout is the one given to the constructor. `headers` are sent in
+    # addition to the ones given to the constructor.
+    def request(self, method, url, data, params, timeout, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path
+        if params:
+            target += '?' + urllib.parse.urlencode(params)
+        headers = {**self.headers, **(headers or {})}
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+
+        connection = self._acquire(key)
+        try:
+            connection.request(method, target, body=body, headers=headers)
+            connection.sock.settimeout(timeout[1])
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise TransportError(f'{method} {url} failed: {e!r}') from e
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return Response(response.status, response.headers, content,
+                        len(body or b''))
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
@@ -0,0 +1,145 @@
+# Tests of ./artifact.py.
+
+import json
+
+import pytest
+
+# Local module ./artifact.py
+import artifact
+
+CONFIG = {
+    'groups': {
+        'students': {
+            'name': 'students',
+            'usernames': ['alice']
+        },
+    },
+    'categories': {
+        'cs': {
+            'name': 'Computer Science',
+            'permissions': [{
+                'group': 'students',
+                'permission_type': 1
+            }],
+        },
+        'cs-algorithms': {
+            'name': 'Algorithms',
+            'parent': 'cs'
+        },
+    },
+    'site_settings': {
+        'title': 'Forum'
+    },
+}
+
+
+def test_valid_config():
+    assert artifact.validate(CONFIG) == []
+
+
+def test_invalid_attributes():
+    config = {
+        'groups': {
+            'a': {
+                'name': 'a',
+                'visibility_level': 7,
+                'colour': 'red'
+            },
+            'b': {
+                'full_name': 'B'
+            },
+        },
+        'categories': {
+            'c': {
+                'name': 'c',
+                'color': '#fff'
+            }
+        },
+        'site_settings': {
+            'title': ['Forum']
+        },
+        'badges': {},
+    }
+    errors = artifact.validate(config)
+    assert 'badges: unknown kind of entities, known ones:' in errors[0]
+    assert errors[1:] == [
+        'site_settings.title: expected a boolean, an integer or a string',
+        'groups.a.colour: unknown attribute',
+        'groups.a.visibility_level: expected one of 0, 1, 2, 3, 4',
+        'groups.b.name: missing',
+        'categories.c.color: expected a hex color without #, e.g. 0088CC',
+    ]
+
+
+def test_undefined_references():
+    config = {
+        'categories': {
+            'c': {
+                'name': 'c',
+                'parent': 'missing',
+                'permissions': [{
+                    'group': 'nobody',
+                    'permission_type': 1
+                }],
+            },
+        },
+    }
+    assert artifact.validate(config) == [
+        'categories.c references groups.nobody, which is not defined in the'
+        ' config',
+        'categories.c references categories.missing, which is not defined in'
+        ' the config',
+    ]
+
+
+def test_compile_orders_referenced_entities_first():
+    compiled = artifact.compile_config(CONFIG)
+    order = compiled.order
+    assert order.index(('groups', 'students')) < order.index(
+        ('categories', 'cs'))
+    assert order.index(('categories', 'cs')) < order.index(
+        ('categories', 'cs-algorithms'))
+    assert compiled.references[('categories', 'cs-algorithms')] == [
+        ('categories', 'cs')
+    ]
+
+
+def test_compile_refuses_cycles():
+    config = {
+        'categories': {
+            'a': {
+                'name': 'a',
+                'parent': 'b'
+            },
+            'b': {
+                'name': 'b',
+                'parent': 'a'
+            },
+        }
+    }
+    with pytest.raises(artifact.ConfigError, match='Dependency cycle'):
+        artifact.compile_config(config)
+
+
+def test_load_compiled_and_plain_configs(tmp_path):
+    plain = tmp_path / 'plain.json'
+    plain.write_text(json.dumps(CONFIG))
+    compiled = tmp_path / 'compiled.json'
+    compiled.write_text(
+        json.dumps(artifact.compile_config(CONFIG).to_json()))
+
+    from_plain = artifact.load(str(plain))
+    from_compiled = artifact.load(str(compiled))
+    assert from_compiled.hash == from_plain.hash
+    assert from_compiled.entities == from_plain.entities
+    assert from_compiled.references == from_plain.references
+    assert from_compiled.order == from_plain.order
+    assert from_compiled.config == CONFIG
+
+
+def test_load_refuses_invalid_configs(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps({'groups': {'a': {}}}))
+    with pytest.raises(artifact.ConfigError) as error:
+        artifact.load(str(path))
+    assert error.value.errors == ['groups.a.name: missing']
@@ -0,0 +1,77 @@
+# Tests of ./governor.py.
+
+import email.utils
+import time
+
+import pytest
+
+# Local module ./governor.py
+from governor import RateGovernor, backoff_delay, parse_retry_after
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+
+
+def test_parse_retry_after_http_date():
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < parse_retry_after(date) <= 30
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(20):
+        assert 0 <= backoff_delay(attempt, base=0.5, cap=2.0) <= 2.0
+
+
+def test_unlimited_until_rate_limited():
+    governor = RateGovernor()
+    for _ in range(20):
+        governor.acquire()
+        governor.on_success()
+    assert governor.rate is None
+    assert governor.throttled_seconds == 0
+
+
+def test_rate_limiting_decreases_the_rate_multiplicatively():
+    governor = RateGovernor(rate=10, decrease_factor=0.5, min_rate=1)
+    governor.on_rate_limited(0)
+    assert governor.rate == 5
+    # Refusals during the pause are caused by the same violation.
+    governor.on_rate_limited(0)
+    assert governor.rate == 5
+    assert governor.rate_limited == 2
+
+
+def test_rate_never_drops_below_the_minimum():
+    governor = RateGovernor(rate=1, decrease_factor=0.1, min_rate=0.5)
+    governor.on_rate_limited(0)
+    assert governor.rate == 0.5
+
+
+def test_first_rate_limit_uses_the_observed_rate():
+    governor = RateGovernor(decrease_factor=0.5, min_rate=0.1)
+    for _ in range(8):
+        governor.acquire()
+    # 8 requests within less than a second are counted as 8 per second.
+    governor.on_rate_limited(0)
+    assert governor.rate == pytest.approx(4)
+
+
+def test_success_increases_the_rate_additively():
+    governor = RateGovernor(rate=2, increase_step=0.5)
+    governor.on_success()
+    governor.on_success()
+    assert governor.rate == 3
+
+
+def test_retry_after_blocks_all_requests():
+    governor = RateGovernor(rate=1000)
+    before = time.monotonic()
+    governor.on_rate_limited(0.2)
+    assert governor.blocked_until >= before + 0.2
+    governor.acquire()
+    assert time.monotonic() - before >= 0.2
+    assert governor.throttled_seconds > 0
@@ -0,0 +1,231 @@
+# Tests of the `Configurator` and the `DiscourseClient` of ./main.py, against
+# the fake Discourse API (see ./conftest.py).
+
+import json
+import logging
+
+import pytest
+
+CONFIG = {
+    'groups': {
+        'students': {
+            'name': 'students',
+            'usernames': ['alice', 'bob'],
+        },
+        'staff-like': {
+            'name': 'tutors',
+            'owner_usernames': 'carol',
+            'usernames': ['carol', 'dave'],
+        },
+    },
+    'categories': {
+        'cs': {
+            'name': 'Computer Science',
+            'permissions': [{
+                'group': 'students',
+                'permission_type': 1
+            }],
+        },
+        'cs-algorithms': {
+            'name': 'Algorithms',
+            'parent': 'cs'
+        },
+    },
+    'tag_groups': {
+        'languages': {
+            'name': 'Languages',
+            'tag_names': ['python', 'nix']
+        },
+    },
+    'site_settings': {
+        'title': 'Forum'
+    },
+}
+
+
+def group_named(discourse, name):
+    return next(group for group in discourse.groups.values()
+                if group['name'] == name)
+
+
+def test_apply_creates_the_entities(discourse, configurator):
+    configurator(CONFIG).apply()
+    students = group_named(discourse, 'students')
+    assert discourse.members[students['id']] == {'alice', 'bob'}
+    tutors = group_named(discourse, 'tutors')
+    assert discourse.members[tutors['id']] == {'carol', 'dave'}
+    categories = {
+        category['name']: category
+        for category in discourse.categories.values()
+    }
+    assert categories['Algorithms']['parent_category_id'] == categories[
+        'Computer Science']['id']
+    assert discourse.site_settings['title'] == 'Forum'
+
+
+def test_unchanged_config_is_not_applied_again(discourse, configurator,
+                                               caplog):
+    configurator(CONFIG).apply()
+    requests_before = sum(discourse.requests.values())
+    with caplog.at_level(logging.INFO):
+        configurator(CONFIG).apply()
+    assert sum(discourse.requests.values()) == requests_before
+    assert 'The config did not change' in caplog.text
+
+
+def test_forced_run_skips_up_to_date_entities(discourse, configurator):
+    configurator(CONFIG).apply()
+    requests_before = discourse.requests.copy()
+    configurator = configurator(CONFIG, force=True)
+    configurator.apply()
+    # Only the snapshots and the members are fetched.
+    assert discourse.requests - requests_before == {
+        'GET': discourse.requests['GET'] - requests_before['GET']
+    }
+    stats = configurator.stats
+    assert (stats.created, stats.updated, stats.members_added) == (0, 0, 0)
+    assert stats.skipped == 6
+
+
+def test_changes_are_applied(discourse, configurator):
+    configurator(CONFIG).apply()
+    changed = json.loads(json.dumps(CONFIG))
+    changed['groups']['students']['usernames'] = ['alice', 'erin']
+    changed['groups']['students']['full_name'] = 'Students'
+    configurator = configurator(changed)
+    configurator.apply()
+    students = group_named(discourse, 'students')
+    assert students['full_name'] == 'Students'
+    assert discourse.members[students['id']] == {'alice', 'erin'}
+    stats = configurator.stats
+    assert (stats.updated, stats.unchanged) == (1, 5)
+    assert (stats.members_added, stats.members_removed) == (1, 1)
+
+
+def test_select_includes_the_referenced_entities(configurator):
+    configurator = configurator(CONFIG,
+                                only=['categories.cs-*'],
+                                exclude=['tagGroups.*'])
+    assert configurator.select(configurator.compiled.references) == {
+        ('categories', 'cs-algorithms'),
+        ('categories', 'cs'),
+        ('groups', 'students'),
+    }
+
+
+def test_select_by_option_name_and_exclude(configurator):
+    configurator = configurator(CONFIG,
+                                only=['tagGroups.*', 'groups.*'],
+                                exclude=['groups.students'])
+    assert configurator.select(configurator.compiled.references) == {
+        ('tag_groups', 'languages'),
+        ('groups', 'staff-like'),
+    }
+
+
+def test_select_refuses_unused_selectors(configurator):
+    configurator = configurator(CONFIG, only=['groups.*', 'badges.*'])
+    with pytest.raises(Exception, match='badges.*'):
+        configurator.select(configurator.compiled.references)
+
+
+def test_partial_run_does_not_record_the_config(discourse, configurator):
+    configurator(CONFIG, only=['tag_groups.languages']).apply()
+    assert [group['name'] for group in discourse.tag_groups.values()
+            ] == ['Languages']
+    assert discourse.categories == {}
+    assert configurator(CONFIG).store.get_config_hash() is None
+
+
+def test_prune_deletes_only_created_entities(discourse, configurator):
+    # The group exists before it is added to the config.
+    discourse.handle('POST', 'admin/groups.json', {},
+                     {'group': {
+                         'name': 'existing'
+                     }})
+    config = json.loads(json.dumps(CONFIG))
+    config['groups']['existing'] = {'name': 'existing'}
+    config['groups']['staff'] = {'name': 'staff'}
+    config['groups']['kept'] = {'name': 'kept'}
+    configurator(config).apply()
+
+    configurator = configurator(CONFIG, prune=True, keep=['kept'])
+    reasons = {
+        attr: reason
+        for _, attr, _, reason, _ in configurator.prune_orphans(dry_run=True)
+    }
+    assert reasons == {
+        'existing': 'it existed before it was added to the config',
+        'staff': 'it is managed by Discourse',
+        'kept': 'it is kept explicitly',
+    }
+
+    configurator.apply()
+    names = {group['name'] for group in discourse.groups.values()}
+    assert {'existing', 'staff', 'kept', 'students', 'tutors'} <= names
+    assert configurator.stats.deleted == 0
+
+
+def test_prune_deletes_groups_removed_from_the_config(discourse,
+                                                      configurator):
+    configurator(CONFIG).apply()
+    config = json.loads(json.dumps(CONFIG))
+    del config['groups']['staff-like']
+    configurator = configurator(config, prune=True)
+    configurator.apply()
+    names = {group['name'] for group in discourse.groups.values()}
+    assert 'tutors' not in names
+    assert configurator.stats.deleted == 1
+
+
+def test_legacy_store_is_imported_as_adopted(discourse, configurator,
+                                             tmp_path):
+    group = discourse.handle('POST', 'admin/groups.json', {},
+                             {'group': {
+                                 'name': 'legacy'
+                             }})['basic_group']
+    (tmp_path / 'nix_to_discourse_ids.json').write_text(
+        json.dumps({
+            'groups': {
+                'legacy': group['id']
+            },
+            'hashes': {
+                'groups': {
+                    'legacy': 'old'
+                }
+            },
+        }))
+    configurator = configurator(CONFIG, prune=True)
+    assert (tmp_path / 'nix_to_discourse_ids.json.imported').exists()
+    assert configurator.store.get_hash('groups', 'legacy') == 'old'
+    configurator.apply()
+    assert group['id'] in discourse.groups
+    assert configurator.stats.deleted == 0
+
+
+def test_lost_response_of_adding_members_is_retried(discourse, configurator):
+    handle = discourse.handle
+    lost = []
+
+    # The members are added, but the response never reaches the applier.
+    def lose_first_response(method, path, params, body):
+        response = handle(method, path, params, body)
+        if method == 'PUT' and path.endswith('/members.json') and not lost:
+            lost.append(path)
+            raise RuntimeError('connection lost')
+        return response
+
+    discourse.handle = lose_first_response
+    configurator = configurator(CONFIG)
+    configurator.apply()
+    assert lost
+    students = group_named(discourse, 'students')
+    assert discourse.members[students['id']] == {'alice', 'bob'}
+    assert configurator.client.governor.retries >= 1
+
+
+def test_http_errors_are_raised(client):
+    from transport import HTTPError
+    with pytest.raises(HTTPError) as error:
+        client.update_group(12345, {'name': 'missing'})
+    assert error.value.status_code in (404, 422)
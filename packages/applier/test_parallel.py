@@ -0,0 +1,83 @@
+# Tests of ./parallel.py.
+
+import logging
+import threading
+import time
+
+import pytest
+
+# Local module ./parallel.py
+from parallel import map_ordered, run_graph, topological_order
+
+
+def test_topological_order_keeps_the_order_of_independent_keys():
+    dependencies = {'category': ['group'], 'tag_group': ['group']}
+    keys = ['setting', 'category', 'tag_group', 'group']
+    assert topological_order(keys, dependencies) == [
+        'setting', 'group', 'category', 'tag_group'
+    ]
+
+
+def test_topological_order_refuses_cycles():
+    dependencies = {'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': []}
+    with pytest.raises(Exception, match='Dependency cycle between: a, b, c'):
+        topological_order(['a', 'b', 'c', 'd'], dependencies)
+
+
+def test_map_ordered_returns_results_in_order():
+    # Later items finish first.
+    def slow_square(x):
+        time.sleep((5 - x) * 0.01)
+        return x * x
+
+    items = [(x, ) for x in range(5)]
+    assert map_ordered(slow_square, items, 4) == [0, 1, 4, 9, 16]
+    assert map_ordered(slow_square, items, 1) == [0, 1, 4, 9, 16]
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_run_graph_runs_dependencies_first(jobs):
+    lock = threading.Lock()
+    finished = []
+
+    def apply(key):
+        time.sleep(0.01 if key == 'group' else 0)
+        with lock:
+            finished.append(key)
+
+    dependencies = {'category': ['group'], 'subcategory': ['category']}
+    keys = topological_order(['setting', 'subcategory', 'category', 'group'],
+                             dependencies)
+    run_graph(apply, [(key, (key, )) for key in keys], dependencies, jobs)
+    assert sorted(finished) == sorted(keys)
+    assert finished.index('group') < finished.index('category')
+    assert finished.index('category') < finished.index('subcategory')
+
+
+def test_run_graph_does_not_start_dependents_of_a_failure():
+    started = []
+
+    def apply(key):
+        started.append(key)
+        if key == 'group':
+            raise ValueError('group failed')
+
+    dependencies = {'category': ['group']}
+    items = [(key, (key, )) for key in ['group', 'setting', 'category']]
+    with pytest.raises(ValueError, match='group failed'):
+        run_graph(apply, items, dependencies, 4)
+    assert 'category' not in started
+
+
+def test_run_graph_replays_logs_in_order(caplog):
+
+    def apply(key, delay):
+        time.sleep(delay)
+        logging.info(f'applied {key}')
+
+    items = [(key, (key, delay))
+             for key, delay in [('a', 0.05), ('b', 0.02), ('c', 0)]]
+    with caplog.at_level(logging.INFO):
+        run_graph(apply, items, {}, 3)
+    assert [record.getMessage() for record in caplog.records
+            ] == ['applied a', 'applied b', 'applied c']
@@ -0,0 +1,71 @@
+# Tests of ./reconcile.py.
+
+# Local module ./reconcile.py
+from reconcile import (Snapshot, canonical_hash, chunks, diff_definition,
+                       diff_members, projection_hash)
+
+
+def test_canonical_hash_ignores_key_order():
+    assert canonical_hash({'a': 1, 'b': [1, 2]}) == canonical_hash({
+        'b': [1, 2],
+        'a': 1
+    })
+    assert canonical_hash({'a': 1}) != canonical_hash({'a': 2})
+
+
+def test_diff_definition_normalizes_values():
+    desired = {'name': 'students', 'bio_raw': '', 'tag_names': ['b', 'a']}
+    remote = {'name': 'students', 'bio_raw': None, 'tag_names': ['a', 'b']}
+    assert diff_definition(desired, remote) == []
+
+
+def test_diff_definition_finds_changed_attributes():
+    desired = {'name': 'students', 'full_name': 'Students', 'public_exit': True}
+    remote = {'name': 'students', 'full_name': 'Old', 'public_exit': False}
+    assert diff_definition(desired, remote) == ['full_name', 'public_exit']
+
+
+def test_diff_definition_falls_back_to_last_applied():
+    desired = {'name': 'students', 'owner_usernames': 'alice'}
+    remote = {'name': 'students'}
+    assert diff_definition(desired, remote) == ['owner_usernames']
+    assert diff_definition(desired, remote, {'owner_usernames': 'alice'}) == []
+    assert diff_definition(desired, remote, {'owner_usernames': 'bob'}) == [
+        'owner_usernames'
+    ]
+
+
+def test_projection_hash_agrees_with_diff_definition():
+    desired = {'name': 'students', 'bio_raw': '', 'owner_usernames': 'alice'}
+    same = {'id': 1, 'name': 'students', 'bio_raw': None, 'user_count': 3}
+    different = {'id': 1, 'name': 'students', 'bio_raw': 'Hi'}
+    assert diff_definition(desired, same, desired) == []
+    assert projection_hash(desired, same) == projection_hash(desired, desired)
+    assert diff_definition(desired, different, desired) == ['bio_raw']
+    assert projection_hash(desired, different) != projection_hash(
+        desired, desired)
+
+
+def test_diff_members_is_case_insensitive_and_keeps_protected():
+    desired = {'alice': 'Alice', 'bob': 'bob'}
+    current = {'alice': 'alice', 'carol': 'Carol', 'owner': 'Owner'}
+    to_add, to_remove = diff_members(desired, current, {'owner'})
+    assert to_add == ['bob']
+    assert to_remove == ['Carol']
+
+
+def test_snapshot_records_renames_and_removals():
+    snapshot = Snapshot([{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+    snapshot.record(1, {'name': 'c'})
+    assert snapshot.find_id_by_name('a') is None
+    assert snapshot.find_id_by_name('c') == 1
+    snapshot.record(3, {'name': 'd'})
+    assert snapshot.by_id[3] == {'id': 3, 'name': 'd'}
+    snapshot.remove(2)
+    assert snapshot.find_id_by_name('b') is None
+    assert len(snapshot) == 2
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunks([], 2)) == []
@@ -0,0 +1,49 @@
+# HTTP transports used by the `DiscourseClient`.
+#
+# A transport sends the requests of the client and keeps the connections to
+# Discourse (both TCP and UNIX socket ones) alive, so that they are reused
+# between the calls instead of being opened anew for every request. There are
+# two of them:
+# - `requests` (./requests_transport.py), based on `requests.Session`,
+# - `stdlib` (./stdlib_transport.py), based on `http.client`. Importing
+#   `requests` (along with urllib3, certifi, charset_normalizer and idna)
+#   takes most of the startup time of the applier, which dominates runs that
+#   have little or nothing to apply. This transport supports only plain HTTP,
+#   over TCP or a UNIX socket, which is all that is needed to talk to the
+#   local Unicorn.
+# Both accept extra `headers` of a single request (e.g. `If-None-Match`) and
+# return responses with `status_code`, `headers`, `content`, `text`,
+# `json()` and `sent_bytes` (the size of the request body) and raise
+# `TransportError` if no response was received.
+#
+# The transports are imported when they are created, this module itself is
+# cheap to import.
+
+UNIX_SOCKET_SCHEME = 'http+unix://'
+TRANSPORTS = ('requests', 'stdlib')
+
+
+# Failure of the transport itself (as opposed to an error response), after
+# which an idempotent request may be safely retried.
+class TransportError(Exception):
+    pass
+
+
+# Error response of the API.
+class HTTPError(Exception):
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Create the transport named `name` (one of `TRANSPORTS`). `headers` are sent
+# with every request.
+def create_transport(name, pool_size, connect_timeout, headers):
+    if name == 'stdlib':
+        # Local module ./stdlib_transport.py
+        from stdlib_transport import StdlibTransport
+        return StdlibTransport(pool_size, connect_timeout, headers)
+    # Local module ./requests_transport.py
+    from requests_transport import RequestsTransport
+    return RequestsTransport(pool_size, connect_timeout, headers)
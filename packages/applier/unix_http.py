@@ -0,0 +1,25 @@
+# HTTP over UNIX sockets using only the standard library, for the code paths
+# that should not pay for importing `requests` (see ./transport.py).
+
+import http.client
+import socket
+
+
+# `http.client.HTTPConnection` to a server listening on the UNIX socket at
+# `socket_path`.
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.socket_path)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
@@ -0,0 +1,478 @@
+# Bulk provisioning of users from a roster (`applier users`).
+#
+# A roster is a CSV file (with a header) or a JSON lines file, with a row per
+# user. Rows have the following fields:
+# - username, email (required),
+# - name (optional, the full name of the user),
+# - password (optional, a random one is generated if it is missing, so that
+#   the user has to reset it),
+# - groups (optional, Nix attribute names of the groups the user should be a
+#   member of, separated by spaces in CSV files or given as a list in JSON).
+# Users are matched with the existing ones by their usernames. Missing users
+# are created and existing ones get their name updated (emails of existing
+# users are never changed, Discourse requires the users to confirm them).
+# Users are then added to the groups they are not members of yet. Groups
+# whose membership is defined by their `usernames` in Nix cannot be used, as
+# the applier would remove the users added from the roster.
+#
+# The roster is never loaded into memory as a whole. Instead, the existing
+# users (fetched page by page) and the members of the groups are kept in an
+# SQLite database in the data directory, rows are read one by one and only a
+# bounded number of them is being provisioned (by `--jobs` concurrent
+# workers) at any time, so the memory usage does not depend on the size of the
+# roster. The same database holds the progress: every provisioned row is
+# committed along with its hash and the group memberships still to be added.
+# Rows which did not change since they were provisioned are skipped without
+# calling the API, so a rerun after an interruption resumes where the
+# previous run stopped. `--force` provisions all rows again.
+
+import collections
+import csv
+import itertools
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+
+# Local module ./artifact.py
+import artifact
+# Local module ./entities.py
+from entities import MEMBERSHIP_CHUNK_SIZE
+# Local module ./main.py
+from main import ArgumentProvider, create_client, export_metrics
+# Local module ./parallel.py
+from parallel import imap_ordered, map_ordered
+# Local module ./reconcile.py
+from reconcile import canonical_hash
+
+ROSTER_FORMATS = ('csv', 'jsonl')
+# Progress is logged after every this many rows.
+PROGRESS_INTERVAL = 1000
+
+
+# Read the roster at `path`, yielding (line number, record) pairs.
+def read_roster(path, roster_format):
+    with open(path, 'r', newline='') as f:
+        if roster_format == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for number, line in enumerate(f, start=1):
+                if line.strip():
+                    yield number, json.loads(line)
+
+
+# Convert a record of the roster into a row with all the fields, in a
+# canonical form (so that its hash changes only if the row really does).
+def parse_row(record):
+    username = (record.get('username') or '').strip()
+    email = (record.get('email') or '').strip()
+    if not username or not email:
+        raise ValueError('username and email are required')
+    groups = record.get('groups') or []
+    if isinstance(groups, str):
+        groups = groups.split()
+    return {
+        'username': username,
+        'email': email,
+        'name': (record.get('name') or '').strip(),
+        'password': record.get('password') or None,
+        'groups': sorted(set(groups)),
+    }
+
+
+# State of the provisioning, kept in `users.sqlite3` in the data directory.
+# Usernames are compared case insensitively, like Discourse does.
+class RosterStore:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS remote_users (
+            username TEXT NOT NULL COLLATE NOCASE PRIMARY KEY,
+            id INTEGER NOT NULL,
+            name TEXT,
+            email TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS remote_members (
+            group_id INTEGER NOT NULL,
+            username TEXT NOT NULL COLLATE NOCASE,
+            PRIMARY KEY (group_id, username)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS provisioned (
+            username TEXT NOT NULL COLLATE NOCASE PRIMARY KEY,
+            hash TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS pending_members (
+            group_id INTEGER NOT NULL,
+            username TEXT NOT NULL COLLATE NOCASE,
+            PRIMARY KEY (group_id, username)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(os.path.dirname(path)):
+            raise Exception(
+                f'Data directory {os.path.dirname(path)} does not exist')
+        # Group members are added concurrently, the connection is shared by
+        # all threads and guarded by a lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _query_one(self, query, parameters):
+        with self.lock:
+            return self.db.execute(query, parameters).fetchone()
+
+    # Replace the known remote users with the ones in `pages`, an iterable of
+    # lists of users (as returned by the API).
+    def replace_remote_users(self, pages):
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM remote_users')
+            for users in pages:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO remote_users'
+                    ' (username, id, name, email) VALUES (?, ?, ?, ?)',
+                    [(user['username'], user['id'], user.get('name'),
+                      user.get('email')) for user in users])
+
+    # Replace the known members of the group with `members` (as returned by
+    # the API) and forget the pending memberships that exist already.
+    def replace_remote_members(self, group_id, members):
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM remote_members WHERE group_id = ?',
+                            (group_id, ))
+            self.db.executemany(
+                'INSERT OR IGNORE INTO remote_members (group_id, username)'
+                ' VALUES (?, ?)',
+                ((group_id, member['username']) for member in members))
+            self.db.execute(
+                'DELETE FROM pending_members WHERE group_id = ? AND username IN'
+                ' (SELECT username FROM remote_members WHERE group_id = ?)',
+                (group_id, group_id))
+
+    # (id, name, email) of the remote user, or None if there is no such user.
+    def remote_user(self, username):
+        return self._query_one(
+            'SELECT id, name, email FROM remote_users WHERE username = ?',
+            (username, ))
+
+    def provisioned_hash(self, username):
+        row = self._query_one(
+            'SELECT hash FROM provisioned WHERE username = ?', (username, ))
+        return None if row is None else row[0]
+
+    # Record that the user was provisioned from a row with `row_hash` and
+    # that it still has to be added to the groups with `group_ids` it is not
+    # a member of. This is the checkpoint a resumed run starts from.
+    def checkpoint(self, username, row_hash, group_ids):
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.execute(
+                'INSERT OR REPLACE INTO provisioned (username, hash)'
+                ' VALUES (?, ?)', (username, row_hash))
+            self.db.executemany(
+                'INSERT OR IGNORE INTO pending_members (group_id, username)'
+                ' SELECT ?1, ?2 WHERE NOT EXISTS (SELECT 1 FROM remote_members'
+                ' WHERE group_id = ?1 AND username = ?2)',
+                [(group_id, username) for group_id in group_ids])
+
+    def pending_groups(self):
+        with self.lock:
+            return [
+                group_id for (group_id, ) in self.db.execute(
+                    'SELECT DISTINCT group_id FROM pending_members')
+            ]
+
+    def pending_members(self, group_id, limit):
+        with self.lock:
+            return [
+                username for (username, ) in self.db.execute(
+                    'SELECT username FROM pending_members WHERE group_id = ?'
+                    ' ORDER BY username LIMIT ?', (group_id, limit))
+            ]
+
+    # Record that `usernames` were added to the group.
+    def complete_members(self, group_id, usernames):
+        rows = [(group_id, username) for username in usernames]
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'DELETE FROM pending_members WHERE group_id = ?'
+                ' AND username = ?', rows)
+            self.db.executemany(
+                'INSERT OR IGNORE INTO remote_members (group_id, username)'
+                ' VALUES (?, ?)', rows)
+
+    def forget_pending(self, group_id):
+        with self.lock:
+            self.db.execute('DELETE FROM pending_members WHERE group_id = ?',
+                            (group_id, ))
+
+
+class Provisioner:
+
+    def __init__(self, client, config, store, jobs=1, force=False):
+        self.client = client
+        self.metrics = client.metrics
+        self.store = store
+        self.jobs = jobs
+        self.force = force
+        self.counts = collections.Counter()
+
+        # Nix attribute -> name of the groups users may be added to.
+        self.group_names = {}
+        # Nix attribute -> reason why users cannot be added to the group.
+        self.unusable_groups = {}
+        for attr, definition in config.get('groups', {}).items():
+            if definition.get('usernames') is not None:
+                self.unusable_groups[attr] = (
+                    f'members of group {attr} are defined by its usernames')
+            else:
+                self.group_names[attr] = definition['name']
+        # Name -> id of the groups, fetched when the first one is needed.
+        self.group_ids = None
+        # Ids of the groups whose members were fetched by this run.
+        self.fetched_members = set()
+
+    def fetch_group_ids(self):
+        if self.group_ids is not None:
+            return
+        names = set(self.group_names.values())
+        self.group_ids = {
+            group['name']: group['id']
+            for group in self.client.iter_groups() if group['name'] in names
+        }
+
+    # Group id of the group with Nix attribute `attr`. The members of the
+    # group are fetched the first time it is needed.
+    def group_id(self, attr):
+        if attr in self.unusable_groups:
+            raise ValueError(self.unusable_groups[attr])
+        if attr not in self.group_names:
+            raise ValueError(f'group {attr} is not defined in the config')
+        self.fetch_group_ids()
+        name = self.group_names[attr]
+        if name not in self.group_ids:
+            raise ValueError(
+                f'group {attr} does not exist yet, apply the config first')
+        group_id = self.group_ids[name]
+        if group_id not in self.fetched_members:
+            with self.metrics.span('snapshot', f'{name} members'):
+                self.store.replace_remote_members(
+                    group_id, self.client.iter_group_members(name))
+            self.fetched_members.add(group_id)
+        return group_id
+
+    def fetch_users(self):
+        pages = imap_ordered(self.client.list_users,
+                             ((page, ) for page in itertools.count(1)),
+                             self.jobs)
+        try:
+            with self.metrics.span('phase', 'fetch'):
+                self.store.replace_remote_users(
+                    itertools.takewhile(lambda users: users, pages))
+        finally:
+            pages.close()
+
+    # Rows of the roster which have to be provisioned, along with everything
+    # the workers need to provision them. Runs on the main thread.
+    def rows_to_provision(self, roster, roster_format):
+        for number, record in read_roster(roster, roster_format):
+            self.counts['rows'] += 1
+            if self.counts['rows'] % PROGRESS_INTERVAL == 0:
+                self.log_progress()
+            try:
+                row = parse_row(record)
+            except (AttributeError, ValueError) as e:
+                logging.warning(f'Row {number} of the roster is invalid: {e}')
+                self.counts['failed'] += 1
+                continue
+            # Passwords are not compared, the ones of existing users are
+            # never changed anyway.
+            row_hash = canonical_hash(dict(row, password=None))
+            if (not self.force and self.store.provisioned_hash(row['username'])
+                    == row_hash):
+                self.counts['unchanged'] += 1
+                continue
+            try:
+                group_ids = [self.group_id(attr) for attr in row['groups']]
+            except ValueError as e:
+                logging.warning(f'Row {number} of the roster is invalid: {e}')
+                self.counts['failed'] += 1
+                continue
+            yield (row, row_hash, group_ids,
+                   self.store.remote_user(row['username']))
+
+    # Create or update a single user. Runs on a worker thread, failures are
+    # returned instead of raised, so that they do not stop the whole run.
+    def provision(self, row, row_hash, group_ids, remote):
+        try:
+            outcome = self.create_or_update(row, remote)
+        except Exception as e:
+            return row, row_hash, group_ids, 'failed', e
+        return row, row_hash, group_ids, outcome, None
+
+    def create_or_update(self, row, remote):
+        username = row['username']
+        if remote is None:
+            self.client.create_user({
+                'username':
+                username,
+                'email':
+                row['email'],
+                'name':
+                row['name'],
+                'password':
+                row['password'] or secrets.token_urlsafe(32),
+                'active':
+                True,
+                'approved':
+                True,
+            })
+            return 'created'
+
+        _, name, email = remote
+        if email is not None and email.lower() != row['email'].lower():
+            logging.warning(
+                f'User {username} has email {email} instead of {row["email"]},'
+                ' emails of existing users are not changed')
+        if row['name'] and row['name'] != name:
+            self.client.update_user(username, {'name': row['name']})
+            return 'updated'
+        return 'skipped'
+
+    def provision_roster(self, roster, roster_format):
+        with self.metrics.span('phase', 'write'):
+            for row, row_hash, group_ids, outcome, error in imap_ordered(
+                    self.provision,
+                    self.rows_to_provision(roster, roster_format), self.jobs):
+                self.counts[outcome] += 1
+                if error is not None:
+                    logging.warning(
+                        f'Provisioning user {row["username"]} failed: {error}')
+                    continue
+                self.store.checkpoint(row['username'], row_hash, group_ids)
+
+    # Add the pending members of the group, in chunks of
+    # `MEMBERSHIP_CHUNK_SIZE` usernames. Returns the number of members added.
+    def add_pending_members(self, group_id):
+        added = 0
+        while True:
+            usernames = self.store.pending_members(group_id,
+                                                   MEMBERSHIP_CHUNK_SIZE)
+            if not usernames:
+                return added
+            self.client.add_group_members(group_id, usernames)
+            self.store.complete_members(group_id, usernames)
+            added += len(usernames)
+            logging.info(f'Group {group_id}: added {added} members')
+
+    def assign_groups(self):
+        group_ids = self.store.pending_groups()
+        if not group_ids:
+            return
+        # Memberships left pending by an interrupted run may have been added
+        # since, so the members of their groups have to be fetched first.
+        self.fetch_group_ids()
+        attrs = {
+            self.group_ids[name]: attr
+            for attr, name in self.group_names.items()
+            if name in self.group_ids
+        }
+        for group_id in group_ids:
+            if group_id in attrs:
+                self.group_id(attrs[group_id])
+            else:
+                logging.warning(
+                    f'Group {group_id} is no longer in the config, not adding'
+                    ' the members left pending by the previous run')
+                self.store.forget_pending(group_id)
+        with self.metrics.span('phase', 'members'):
+            added = map_ordered(self.add_pending_members,
+                                [(group_id, )
+                                 for group_id in self.store.pending_groups()],
+                                self.jobs)
+        self.counts['members_added'] += sum(added)
+
+    def log_progress(self):
+        logging.info(
+            f'Processed {self.counts["rows"]} rows of the roster'
+            f' (created: {self.counts["created"]},'
+            f' updated: {self.counts["updated"]},'
+            f' skipped (already up to date): {self.counts["skipped"]},'
+            f' unchanged since the last run: {self.counts["unchanged"]},'
+            f' failed: {self.counts["failed"]})')
+
+    def run(self, roster, roster_format):
+        self.fetch_users()
+        self.provision_roster(roster, roster_format)
+        self.log_progress()
+        self.assign_groups()
+        logging.info(f'Added {self.counts["members_added"]} group members')
+
+
+# `applier users` entry point.
+def provision_users(argv):
+    provider = ArgumentProvider(prog='applier users', argv=argv)
+    provider.add_url_related_options()
+    # Only the options of `add_config_related_options` that apply to users
+    # (the rest of them select and prune the entities of the config).
+    provider.parser.add_argument('config', help='Path to the config file')
+    provider.parser.add_argument('data_dir',
+                                 help='Path to the data directory')
+    provider.parser.add_argument('roster',
+                                 help='Path to the roster (CSV or JSON lines)')
+    provider.parser.add_argument(
+        '--format',
+        choices=ROSTER_FORMATS,
+        default=None,
+        help='Format of the roster (by default guessed from its extension)')
+    provider.parser.add_argument(
+        '--jobs',
+        type=int,
+        default=8,
+        help='Number of users that may be provisioned concurrently')
+    provider.parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Provision all rows, even the ones that did not change since'
+        ' the last run')
+    args = provider.parse_args()
+    roster_format = args.format
+    if roster_format is None:
+        roster_format = 'jsonl' if args.roster.endswith(
+            ('.jsonl', '.ndjson')) else 'csv'
+
+    # The config may be compiled (see ./artifact.py).
+    config = artifact.load(args.config).config
+    client = create_client(args)
+    store = RosterStore(os.path.join(args.data_dir, 'users.sqlite3'))
+    try:
+        provisioner = Provisioner(client,
+                                  config,
+                                  store,
+                                  jobs=args.jobs,
+                                  force=args.force)
+        provisioner.run(args.roster, roster_format)
+    finally:
+        store.close()
+        client.close()
+        export_metrics(args, client)
+
+    if provisioner.counts['failed']:
+        logging.error(f'Provisioning of {provisioner.counts["failed"]} users'
+                      ' failed, run the applier again to retry them')
+        raise SystemExit(1)
+    logging.info('Provisioned the users successfully')
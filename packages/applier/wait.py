@@ -0,0 +1,127 @@
+# Readiness probe of Discourse (`applier wait`).
+#
+# Unicorn creates its socket before the Rails application is able to respond,
+# so the existence of the socket does not mean the API can be used yet. This
+# waits for the socket to appear (reacting to its creation right away, with
+# inotify) and then requests a lightweight endpoint through it, with
+# exponentially growing delays, until Discourse responds successfully.
+
+import http.client
+import logging
+import os
+import select
+import time
+
+# Local module ./inotify.py
+from inotify import IN_CREATE, IN_MOVED_TO, Inotify
+# Local module ./main.py
+from main import ArgumentProvider
+# Local module ./unix_http.py
+from unix_http import UnixHTTPConnection
+
+# Endpoint Discourse answers without doing any work (meant for health checks).
+STATUS_PATH = '/srv/status'
+# Delays between probes grow from the first to the maximum one.
+FIRST_PROBE_DELAY = 0.05
+MAX_PROBE_DELAY = 1.0
+# Interval of checking whether the socket exists, if inotify cannot tell.
+POLL_INTERVAL = 0.1
+# Without inotify, or if the watched directory is replaced, the socket is
+# still checked at least this often.
+MAX_WATCH_INTERVAL = 1.0
+
+
+class Timeout(Exception):
+    pass
+
+
+# Block until there is a file at `path`. `deadline` is a `time.monotonic()`
+# value.
+def wait_for_path(path, deadline):
+    directory = os.path.dirname(os.path.abspath(path))
+    inotify = None
+    use_inotify = True
+    try:
+        while not os.path.exists(path):
+            if use_inotify and inotify is None and os.path.isdir(directory):
+                try:
+                    inotify = Inotify()
+                    inotify.add_watch(directory, IN_CREATE | IN_MOVED_TO)
+                except OSError as e:
+                    logging.debug(f'Cannot use inotify ({e}), polling {path}')
+                    use_inotify = False
+                # The file may have been created before the watch was added.
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Timeout(f'{path} did not appear')
+            if inotify is not None:
+                select.select([inotify], [], [],
+                              min(remaining, MAX_WATCH_INTERVAL))
+                inotify.drain()
+            else:
+                time.sleep(min(remaining, POLL_INTERVAL))
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+
+# Request `path` through the UNIX socket until the response is 200 OK.
+# Returns the number of requests made.
+def probe(socket_path, path, deadline):
+    delay = FIRST_PROBE_DELAY
+    probes = 0
+    while True:
+        probes += 1
+        remaining = deadline - time.monotonic()
+        connection = UnixHTTPConnection(socket_path,
+                                        timeout=max(remaining, 0.01))
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                return probes
+            reason = f'status code {response.status}'
+        except (OSError, http.client.HTTPException) as e:
+            reason = str(e) or e.__class__.__name__
+        finally:
+            connection.close()
+        logging.debug(f'Probe {probes} of {path} failed: {reason}')
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Timeout(f'{path} did not respond ({reason})')
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, MAX_PROBE_DELAY)
+
+
+# `applier wait` entry point.
+def wait(argv):
+    provider = ArgumentProvider(prog='applier wait', argv=argv)
+    provider.parser.add_argument('unix_socket',
+                                 help='UNIX socket Unicorn listens on')
+    provider.parser.add_argument(
+        '--timeout',
+        type=float,
+        default=60,
+        help='Time (in seconds) after which waiting fails')
+    provider.parser.add_argument('--path',
+                                 default=STATUS_PATH,
+                                 help='Path requested to check readiness')
+    args = provider.parse_args()
+
+    logging.info(f'Waiting for Discourse to respond at {args.unix_socket}')
+    start = time.monotonic()
+    deadline = start + args.timeout
+    try:
+        wait_for_path(args.unix_socket, deadline)
+        socket_seconds = time.monotonic() - start
+        probes = probe(args.unix_socket, args.path, deadline)
+    except Timeout as e:
+        logging.error(f'Discourse did not start within {args.timeout}s: {e}')
+        raise SystemExit(1)
+    logging.info(
+        f'Discourse responded after {time.monotonic() - start:.2f}s (the socket'
+        f' appeared after {socket_seconds:.2f}s, {probes} probes)')
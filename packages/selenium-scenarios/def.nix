@@ -18,8 +18,8 @@ python3Packages.buildPythonApplication rec {
   version = "0.0.0"; # Some version is required.
   src = ./.; # Source code of the package is here (./scenarios.py, ...).
 
-  # Scenarios depend on selenium
-  propagatedBuildInputs = with python3Packages; [ selenium requests ];
+  # Scenarios depend on selenium, the load generator (./loadgen.py) on aiohttp.
+  propagatedBuildInputs = with python3Packages; [ selenium requests aiohttp ];
 
   # During the build, we want to wrap the output scripts so that they can find
   # the firefox and geckodriver executables at runtime. `wrapProgram` is a tool
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# Load generator for a Discourse server (`load-test`).
+#
+# The Selenium scenarios drive a single browser through a single flow, which
+# says nothing about how the forum behaves when many people use it at once
+# (e.g. during the signups at the start of a term). This runs scripted HTTP
+# sessions of many virtual users concurrently, without browsers, using asyncio.
+# Every virtual user goes through the same flow:
+# 1. registers (with the honeypot challenge the sign-up form answers),
+# 2. activates the account with the link from the activation email, which is
+#    picked up from MailHog as soon as it arrives,
+# 3. logs in again in a fresh session,
+# 4. lists the latest topics,
+# 5. posts a new topic.
+# The latency of every step (every request, and the delivery of the email) is
+# recorded and reported as throughput and p50/p95/p99 percentiles. Thresholds
+# on the percentiles and on the error rate make the exit code 1 when exceeded,
+# so that the load test can fail a check (see ../../tests/load).
+#
+# Discourse limits what a single IP address may do (new accounts, logins,
+# requests per minute) and how fast new users may post, so these limits have
+# to be lifted on the tested server, like the load test does.
+
+import argparse
+import asyncio
+import collections
+import json
+import secrets
+import time
+
+import aiohttp
+
+# Local module ./mail.py
+import mail
+# Local module ./thresholds.py
+from thresholds import percentile, violations
+
+# Steps in the order they are reported in.
+STEPS = ['csrf', 'honeypot', 'register', 'email', 'activate', 'login', 'latest', 'post']
+# Interval of searching MailHog for a message while waiting for it to be
+# pushed, growing from the first to the maximum. If the event stream is down,
+# this is how fast a message is noticed.
+FIRST_SEARCH_SECONDS = 0.2
+MAX_SEARCH_SECONDS = 2.0
+# Number of sample errors kept per step.
+ERROR_SAMPLES = 3
+
+class StepFailed(Exception):
+    pass
+
+# Latencies (in seconds) and errors of every step.
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.error_samples = collections.defaultdict(list)
+
+    def record(self, step, seconds):
+        self.latencies[step].append(seconds)
+
+    def fail(self, step, error):
+        self.errors[step] += 1
+        if len(self.error_samples[step]) < ERROR_SAMPLES:
+            self.error_samples[step].append(error)
+
+    # Summary of every step that was attempted, with the latencies in
+    # milliseconds and the throughput of successful steps per second of
+    # `wall_seconds`.
+    def summary(self, wall_seconds):
+        steps = {}
+        for step in STEPS:
+            latencies = sorted(self.latencies[step])
+            if not latencies and not self.errors[step]:
+                continue
+            count = len(latencies) + self.errors[step]
+            milliseconds = lambda q: None if not latencies else round(percentile(latencies, q) * 1000, 1)
+            steps[step] = {
+                'count': count,
+                'errors': self.errors[step],
+                'error_rate': self.errors[step] / count,
+                'throughput': round(len(latencies) / wall_seconds, 2),
+                'p50_ms': milliseconds(50),
+                'p95_ms': milliseconds(95),
+                'p99_ms': milliseconds(99),
+                'max_ms': milliseconds(100),
+                'error_samples': self.error_samples[step],
+            }
+        return steps
+
+# Waits for messages delivered to MailHog, for all the virtual users at once.
+# Like `mail.Inbox`, it listens to the event stream of MailHog and hands every
+# new message to the user waiting for it, but the stream is shared. Messages
+# are also searched for (by recipient) when a user starts waiting and then
+# periodically, so that none is missed while the stream reconnects.
+class AsyncInbox:
+    def __init__(self, session, address):
+        self.session = session
+        self.address = address.rstrip('/')
+        # Lowercase recipient -> future of the message.
+        self.waiters = {}
+        self.streaming = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.session.get(f'{self.address}/api/v1/events',
+                                            timeout=aiohttp.ClientTimeout(total=None)) as response:
+                    response.raise_for_status()
+                    self.streaming = True
+                    data = []
+                    async for raw_line in response.content:
+                        line = raw_line.decode('utf-8').rstrip('\r\n')
+                        if line.startswith('data:'):
+                            data.append(line[len('data:'):].removeprefix(' '))
+                        elif not line and data:
+                            self._dispatch('\n'.join(data))
+                            data = []
+            # Lines longer than the limit of aiohttp raise ValueError.
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f'MailHog event stream failed ({e!r}), searching for messages instead')
+            self.streaming = False
+            await asyncio.sleep(MAX_SEARCH_SECONDS)
+
+    def _dispatch(self, data):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        for recipient, future in self.waiters.items():
+            if not future.done() and mail.is_addressed_to(message, recipient):
+                future.set_result(message)
+
+    async def search(self, recipient):
+        async with self.session.get(f'{self.address}/api/v2/search',
+                                    params={'kind': 'to', 'query': recipient}) as response:
+            response.raise_for_status()
+            messages = await response.json(content_type=None)
+        for message in messages['items']:
+            if mail.is_addressed_to(message, recipient):
+                return message
+        return None
+
+    # The message addressed to `recipient` (parsed, see `mail.parse`), or
+    # None if it did not arrive within `timeout` seconds.
+    async def wait_for(self, recipient, timeout):
+        deadline = time.monotonic() + timeout
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[recipient.lower()] = future
+        delay = FIRST_SEARCH_SECONDS
+        try:
+            while True:
+                # The waiter is registered before searching, so that no
+                # message falls in between.
+                message = await self.search(recipient)
+                if message is not None:
+                    return mail.parse(message)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    message = await asyncio.wait_for(asyncio.shield(future), min(delay, remaining))
+                    return mail.parse(message)
+                except asyncio.TimeoutError:
+                    pass
+                # With the stream working, searching is only a safety net.
+                delay = min(delay * 2, MAX_SEARCH_SECONDS if not self.streaming else timeout)
+        finally:
+            del self.waiters[recipient.lower()]
+
+# A scripted session of a single user. Every user has its own cookies, the
+# connections to the server are shared by all of them.
+class VirtualUser:
+    def __init__(self, index, run_id, args, connector, inbox, stats):
+        self.args = args
+        self.inbox = inbox
+        self.stats = stats
+        self.connector = connector
+        self.session = None
+        self.csrf_token = None
+        # Usernames may be up to 20 characters long.
+        self.username = f'load{run_id}{index}'
+        self.email = f'{self.username}@{args.email_domain}'
+        self.password = secrets.token_urlsafe(12)
+        self.name = f'Load User {index}'
+
+    # Make a request that is a part of `step`, recording its latency. Returns
+    # the decoded JSON response.
+    async def request(self, step, method, path, data=None, params=None):
+        headers = {'X-Requested-With': 'XMLHttpRequest', 'Accept': 'application/json'}
+        if self.csrf_token is not None:
+            headers['X-CSRF-Token'] = self.csrf_token
+        start = time.monotonic()
+        try:
+            async with self.session.request(method, f'{self.args.address}/{path}',
+                                            data=data, params=params, headers=headers) as response:
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise StepFailed(f'{method} {path} failed: {e!r}') from e
+        if response.status != 200:
+            raise StepFailed(f'{method} {path} responded with {response.status}: {body[:200]!r}')
+        self.stats.record(step, time.monotonic() - start)
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise StepFailed(f'{method} {path} did not respond with JSON: {body[:200]!r}')
+
+    async def fetch_csrf(self):
+        self.csrf_token = None
+        self.csrf_token = (await self.request('csrf', 'GET', 'session/csrf.json'))['csrf']
+
+    # Answer to the honeypot challenge of the sign-up and activation forms.
+    async def honeypot(self):
+        res = await self.request('honeypot', 'GET', 'session/hp.json')
+        return {'password_confirmation': res['value'], 'challenge': res['challenge'][::-1]}
+
+    async def register(self):
+        await self.fetch_csrf()
+        data = {
+            'name': self.name,
+            'email': self.email,
+            'username': self.username,
+            'password': self.password,
+            **await self.honeypot(),
+        }
+        res = await self.request('register', 'POST', 'u.json', data=data)
+        if not res.get('success'):
+            raise StepFailed(f'Registration failed: {res.get("message")}')
+
+    async def activate(self):
+        start = time.monotonic()
+        try:
+            message = await self.inbox.wait_for(self.email, self.args.mail_timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise StepFailed(f'Searching MailHog failed: {e!r}') from e
+        if message is None:
+            raise StepFailed(f'No email addressed to {self.email}')
+        self.stats.record('email', time.monotonic() - start)
+        link = mail.find_link(message, r'u/activate-account/[0-9a-zA-Z]+')
+        if link is None:
+            raise StepFailed('No activation link in the email')
+        res = await self.request('activate', 'PUT', f'{link}.json', data=await self.honeypot())
+        if res.get('needs_approval'):
+            raise StepFailed('The account needs to be approved')
+
+    # Log in from scratch, as if from another device.
+    async def login(self):
+        self.session.cookie_jar.clear()
+        await self.fetch_csrf()
+        res = await self.request('login', 'POST', 'session.json',
+                                 data={'login': self.username, 'password': self.password})
+        if 'error' in res:
+            raise StepFailed(f'Login failed: {res["error"]}')
+
+    async def latest(self):
+        await self.request('latest', 'GET', 'latest.json')
+
+    async def post(self):
+        data = {
+            'title': f'Load test topic of {self.username}',
+            'raw': f'This topic was posted by {self.name} during a load test.',
+            # Posts typed faster than `min_first_post_typing_time` are held
+            # for review.
+            'typing_duration_msecs': 10000,
+            'composer_open_duration_msecs': 10000,
+        }
+        res = await self.request('post', 'POST', 'posts.json', data=data)
+        if 'id' not in res:
+            raise StepFailed(f'Posting failed: {res}')
+
+    # Go through the flow, stopping at the first failed step. Returns whether
+    # all the steps succeeded.
+    async def run(self):
+        flow = [('register', self.register), ('activate', self.activate),
+                ('login', self.login), ('latest', self.latest), ('post', self.post)]
+        timeout = aiohttp.ClientTimeout(total=self.args.request_timeout)
+        async with aiohttp.ClientSession(connector=self.connector, connector_owner=False,
+                                         timeout=timeout) as self.session:
+            for step, action in flow:
+                try:
+                    await action()
+                except StepFailed as e:
+                    self.stats.fail(step, str(e))
+                    return False
+        return True
+
+async def run_load(args):
+    stats = Stats()
+    run_id = secrets.token_hex(2)
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with aiohttp.ClientSession() as mailhog_session:
+        inbox = AsyncInbox(mailhog_session, args.mailhog_address)
+        inbox.start()
+
+        async def user_session(index):
+            # Users start evenly spread over the ramp-up period.
+            await asyncio.sleep(index * args.ramp_up / args.users)
+            async with semaphore:
+                return await VirtualUser(index, run_id, args, connector, inbox, stats).run()
+
+        start = time.monotonic()
+        try:
+            results = await asyncio.gather(*(user_session(index) for index in range(args.users)))
+        finally:
+            await inbox.close()
+            await connector.close()
+        wall_seconds = time.monotonic() - start
+    return stats, results, wall_seconds
+
+# `load-test` entry point (defined in the setup.py).
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run concurrent sessions of virtual users against Discourse')
+    parser.add_argument('--address', default='http://server',
+                        help='Discourse server address')
+    parser.add_argument('--mailhog-address', default='http://server:8025')
+    parser.add_argument('--email-domain', default='students.mimuw.edu.pl',
+                        help='Domain of the emails of the virtual users')
+    parser.add_argument('--users', type=int, default=100,
+                        help='Number of virtual users')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Maximum number of users going through the flow at once')
+    parser.add_argument('--connections', type=int, default=100,
+                        help='Maximum number of connections to the server')
+    parser.add_argument('--ramp-up', type=float, default=0,
+                        help='Time (in seconds) over which the users start')
+    parser.add_argument('--request-timeout', type=float, default=60)
+    parser.add_argument('--mail-timeout', type=float, default=60,
+                        help='Time (in seconds) to wait for an activation email')
+    parser.add_argument('--threshold', action='append', default=[],
+                        help='Latency threshold such as login.p95=2000 (in ms,'
+                        ' the step may be a glob pattern, may be repeated)')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='Maximum fraction of failed attempts of any step')
+    parser.add_argument('--report', default=None,
+                        help='Write the results to this file as JSON')
+    args = parser.parse_args()
+    args.address = args.address.rstrip('/')
+    # Fail on invalid thresholds before generating any load.
+    violations({}, args.threshold, args.max_error_rate)
+
+    print(f'Running {args.users} virtual users ({args.concurrency} at once) against {args.address}.')
+    stats, results, wall_seconds = asyncio.run(run_load(args))
+    summary = stats.summary(wall_seconds)
+
+    print(f'{"step":>10} {"count":>7} {"errors":>7} {"per s":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for step, result in summary.items():
+        cells = [result[key] for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')]
+        print(f'{step:>10} {result["count"]:>7} {result["errors"]:>7} {result["throughput"]:>8}'
+              + ''.join(f' {"-" if cell is None else cell:>9}' for cell in cells))
+        for sample in result['error_samples']:
+            print(f'{"":>10} error: {sample}')
+    completed = sum(results)
+    print(f'{completed} of {args.users} users completed the flow in {wall_seconds:.1f}s.')
+
+    found = violations(summary, args.threshold, args.max_error_rate)
+    for violation in found:
+        print(f'Threshold exceeded: {violation}')
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({
+                'users': args.users,
+                'concurrency': args.concurrency,
+                'completed': completed,
+                'wall_seconds': round(wall_seconds, 3),
+                'steps': summary,
+                'violations': found,
+            }, f, indent=2)
+
+    return 1 if found else 0
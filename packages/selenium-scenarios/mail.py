@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Waiting for emails delivered to MailHog (https://github.com/mailhog/MailHog).
+#
+# Instead of downloading the whole mailbox at a fixed interval, `Inbox`
+# subscribes to the stream of new messages MailHog pushes as server-sent
+# events (`api/v1/events`) and returns as soon as a message addressed to the
+# expected recipient arrives. Messages that arrived before the subscription
+# are found with the search API (`api/v2/search`), which returns only the
+# messages of the recipient. If the stream is not available, the search API
+# is polled instead.
+#
+# Messages are parsed as MIME (quoted-printable and base64 encoded parts are
+# decoded), so that links can be looked for in their text.
+
+import email
+import email.policy
+import email.utils
+import json
+import re
+import time
+
+import requests
+
+# Interval of polling the search API, growing from the first to the maximum.
+FIRST_POLL_SECONDS = 0.1
+MAX_POLL_SECONDS = 1.0
+
+# Whether the MailHog message (as returned by its API) is addressed to
+# `recipient`, either in its envelope or in its To header. Addresses are
+# compared exactly (case insensitively), so that e.g. a@x.org does not match
+# aa@x.org.
+def is_addressed_to(message, recipient):
+    recipient = recipient.strip().lower()
+    envelope = message.get('Raw', {}).get('To') or []
+    headers = message.get('Content', {}).get('Headers', {}).get('To') or []
+    return any(address.lower() == recipient
+               for _, address in email.utils.getaddresses(envelope + headers))
+
+# Parse the MailHog message into an `email.message.EmailMessage`.
+def parse(message):
+    return email.message_from_string(message['Raw']['Data'],
+                                     policy=email.policy.default)
+
+# Decoded text of all the text/plain and text/html parts of the message.
+def text(message):
+    return '\n'.join(part.get_content() for part in message.walk()
+                     if part.get_content_type() in ('text/plain', 'text/html'))
+
+# The first link in the text of the message matching the `pattern` regular
+# expression, or None.
+def find_link(message, pattern):
+    match = re.search(pattern, text(message))
+    return None if match is None else match.group(0)
+
+# Parse server-sent events from the lines of a stream, yielding the data of
+# every event.
+def events(lines):
+    data = []
+    for line in lines:
+        if line:
+            if line.startswith('data:'):
+                data.append(line[len('data:'):].removeprefix(' '))
+            continue
+        # An empty line ends the event.
+        if data:
+            yield '\n'.join(data)
+            data = []
+
+class Inbox:
+    # `address` is the address of the MailHog HTTP API, e.g.
+    # http://server:8025.
+    def __init__(self, address):
+        self.address = address.rstrip('/')
+        self.session = requests.Session()
+
+    # The latest message addressed to `recipient` found by the search API, or
+    # None.
+    def search(self, recipient):
+        response = self.session.get(f'{self.address}/api/v2/search',
+                                    params={'kind': 'to', 'query': recipient},
+                                    timeout=10)
+        response.raise_for_status()
+        # Messages are listed from the latest one.
+        for message in response.json()['items']:
+            if is_addressed_to(message, recipient):
+                return message
+        return None
+
+    # Wait up to `timeout` seconds for a message addressed to `recipient` and
+    # return it parsed (see `parse`), or None if none arrived. If some
+    # arrived already, the latest one is returned right away.
+    def wait_for(self, recipient, timeout):
+        deadline = time.monotonic() + timeout
+        try:
+            message = self._watch(recipient, deadline)
+        except requests.RequestException as e:
+            print(f'Cannot watch the MailHog event stream ({e}), polling it')
+            message = self._poll(recipient, deadline)
+        return None if message is None else parse(message)
+
+    def _watch(self, recipient, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # The stream is opened before searching, so that no message falls
+            # in between.
+            with self.session.get(f'{self.address}/api/v1/events',
+                                  stream=True,
+                                  timeout=(5, remaining)) as stream:
+                stream.raise_for_status()
+                message = self.search(recipient)
+                if message is not None:
+                    return message
+                # The stream does not declare its charset.
+                stream.encoding = 'utf-8'
+                try:
+                    lines = stream.iter_lines(chunk_size=None, decode_unicode=True)
+                    for data in events(lines):
+                        try:
+                            message = json.loads(data)
+                        except ValueError:
+                            continue
+                        if isinstance(message, dict) and is_addressed_to(message, recipient):
+                            return message
+                        if time.monotonic() >= deadline:
+                            return None
+                except requests.ConnectionError:
+                    # The read timed out or the stream was closed, a message
+                    # may have been missed meanwhile, so it is searched for
+                    # again.
+                    pass
+            time.sleep(min(FIRST_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+    def _poll(self, recipient, deadline):
+        delay = FIRST_POLL_SECONDS
+        while True:
+            message = self.search(recipient)
+            if message is not None:
+                return message
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, MAX_POLL_SECONDS)
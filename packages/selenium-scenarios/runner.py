@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Runs a list of scenarios (see ./scenarios.py) against a Discourse server on a
+# pool of browsers, launched once and shared by the scenarios. Scenarios run
+# in parallel, one per browser, and the state of a browser is reset between
+# them (see `utils.DriverPool`), so adding a scenario does not add a browser
+# launch.
+#
+# The scenarios are given as a JSON list, e.g.:
+# [
+#   {"scenario": "verify-login", "args": {"username": "admin"}},
+#   {
+#     "name": "registration of a non-student",
+#     "scenario": "registration",
+#     "args": {"username": "malypudzian2", "email": "malypudzian@amorek.pl"},
+#     "expect_error": "Registration requires manual approval"
+#   }
+# ]
+# where `args` are the arguments of the console script of the scenario (with
+# underscores instead of dashes) and `expect_error` makes a scenario pass only
+# if it fails with an error containing the given text. The output of every
+# scenario is printed once it finishes (in the order of the list), followed by
+# a summary with the outcome and the duration of every scenario. The JSON
+# report also has the page load cost of the steps of every scenario (see
+# `utils.Performance`).
+
+import argparse
+import contextlib
+import concurrent.futures
+import io
+import json
+import sys
+import threading
+import time
+import traceback
+
+# Local module ./scenarios.py
+import scenarios
+# Local module ./utils.py
+import utils
+
+# Diverts what a thread prints into a buffer while it runs a scenario, so that
+# the output of scenarios running in parallel is not interleaved.
+class CapturedOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    @contextlib.contextmanager
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+# Convert the `args` of a scenario from the list into command line arguments.
+def to_argv(args):
+    argv = []
+    for name, value in args.items():
+        option = '--' + name.replace('_', '-')
+        if value is True:
+            argv.append(option)
+        elif value is not False:
+            argv += [option, str(value)]
+    return argv
+
+# A scenario from the list, along with its parsed arguments.
+class Entry:
+    def __init__(self, index, entry, defaults):
+        if entry['scenario'] not in scenarios.SCENARIOS:
+            raise Exception(f'Unknown scenario {entry["scenario"]}, known ones: {", ".join(scenarios.SCENARIOS)}')
+        self.name = entry.get('name', f'{index}. {entry["scenario"]}')
+        self.scenario = scenarios.SCENARIOS[entry['scenario']]
+        self.expect_error = entry.get('expect_error')
+        self.args = self.scenario.parse(to_argv(entry.get('args', {})), defaults)
+
+# Run a single scenario on a driver from the `pool`. Returns the result shown
+# in the summary along with the output of the scenario.
+def run_entry(pool, output, entry):
+    start = time.monotonic()
+    error = None
+    performance = utils.Performance()
+    with output.capture() as buffer:
+        try:
+            with pool.driver(entry.args.address) as driver:
+                code = entry.scenario.run(driver, entry.args, performance)
+            if code:
+                error = f'Exit code {code}'
+        except (Exception, SystemExit) as e:
+            traceback.print_exc(file=buffer)
+            error = f'{e.__class__.__name__}: {e}'
+
+    if entry.expect_error is None:
+        passed = error is None
+    else:
+        passed = error is not None and entry.expect_error in error
+        if error is None:
+            error = f'Expected an error containing: {entry.expect_error}'
+    result = {
+        'name': entry.name,
+        'passed': passed,
+        'seconds': round(time.monotonic() - start, 3),
+        'error': error,
+        'performance': performance.report()['steps'],
+    }
+    return result, buffer.getvalue()
+
+def load_list(path):
+    if path == '-':
+        return json.load(sys.stdin)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# `run-scenarios` entry point (defined in the setup.py).
+def run_scenarios():
+    parser = argparse.ArgumentParser(
+        description='Run scenarios in parallel on a pool of browsers')
+    parser.add_argument('scenarios',
+                        help='JSON file with the list of scenarios (- for stdin)')
+    parser.add_argument('--drivers', type=int, default=2,
+                        help='Number of browsers (and of scenarios run at once)')
+    parser.add_argument('--headless', action='store_true')
+    parser.add_argument('--address', default='http://server',
+                        help='Discourse server address, unless a scenario sets its own')
+    parser.add_argument('--mailhog-address', default='http://server:8025',
+                        help='MailHog address, unless a scenario sets its own')
+    parser.add_argument('--report', default=None,
+                        help='Write the results to this file as JSON')
+    args = parser.parse_args()
+
+    # The arguments of all the scenarios are checked before any browser is
+    # launched.
+    defaults = {
+        'address': args.address,
+        'mailhog_address': args.mailhog_address,
+        'headless': args.headless,
+    }
+    entries = [
+        Entry(index, entry, defaults)
+        for index, entry in enumerate(load_list(args.scenarios), start=1)
+    ]
+
+    start = time.monotonic()
+    drivers = max(1, min(args.drivers, len(entries)))
+    print(f'Launching {drivers} browsers.')
+    pool = utils.DriverPool(drivers, args.headless)
+    launch_seconds = time.monotonic() - start
+    print(f'Launched the browsers in {launch_seconds:.1f}s.')
+
+    output = CapturedOutput(sys.stdout)
+    sys.stdout = output
+    results = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=drivers) as executor:
+            run = lambda entry: run_entry(pool, output, entry)
+            for result, scenario_output in executor.map(run, entries):
+                print(f'=== {result["name"]}')
+                print(scenario_output, end='')
+                results.append(result)
+    finally:
+        sys.stdout = output.stream
+        pool.close()
+
+    total_seconds = time.monotonic() - start
+    print('Summary:')
+    for result in results:
+        outcome = 'PASS' if result['passed'] else 'FAIL'
+        line = f'{outcome} {result["name"]} ({result["seconds"]:.1f}s)'
+        if not result['passed']:
+            line += f': {result["error"]}'
+        print(line)
+    failed = sum(not result['passed'] for result in results)
+    print(f'{len(results) - failed} passed, {failed} failed in {total_seconds:.1f}s'
+          f' (launching {drivers} browsers took {launch_seconds:.1f}s).')
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({
+                'drivers': drivers,
+                'launch_seconds': round(launch_seconds, 3),
+                'total_seconds': round(total_seconds, 3),
+                'scenarios': results,
+            }, f, indent=2)
+
+    return 1 if failed else 0
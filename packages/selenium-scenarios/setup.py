@@ -6,11 +6,13 @@ from setuptools import setup, find_packages
 setup(
     name='selenium-scenarios',
     packages=find_packages(),
-    py_modules=['scenarios', 'utils'],
+    py_modules=['loadgen', 'mail', 'runner', 'scenarios', 'thresholds', 'utils'],
     entry_points={
         'console_scripts': [
             'verify-login = scenarios:verify_login',
-            'registration = scenarios:registration'
+            'registration = scenarios:registration',
+            'run-scenarios = runner:run_scenarios',
+            'load-test = loadgen:main'
         ]
     },
 )
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Tests of the percentiles and threshold checks of the load test (run with
+# `python -m unittest` in this directory, or as `checks.selenium-scenarios-unit`
+# of the flake).
+
+import unittest
+
+# Local module ./thresholds.py
+import thresholds
+
+def result(p95_ms, errors=0, count=100):
+    return {
+        'count': count,
+        'errors': errors,
+        'error_rate': errors / count,
+        'p50_ms': p95_ms,
+        'p95_ms': p95_ms,
+        'p99_ms': p95_ms,
+        'max_ms': p95_ms,
+    }
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(thresholds.percentile(values, 50), 50)
+        self.assertEqual(thresholds.percentile(values, 95), 95)
+        self.assertEqual(thresholds.percentile(values, 100), 100)
+
+    def test_single_value(self):
+        self.assertEqual(thresholds.percentile([7], 1), 7)
+        self.assertEqual(thresholds.percentile([7], 99), 7)
+
+    def test_no_values(self):
+        self.assertIsNone(thresholds.percentile([], 50))
+
+class ViolationsTest(unittest.TestCase):
+    def test_glob_applies_to_every_step(self):
+        summary = {'login': result(6000), 'post': result(1000)}
+        found = thresholds.violations(summary, ['*.p95=5000'], 0.01)
+        self.assertEqual(found, ['login p95 is 6000 ms, more than 5000 ms'])
+
+    def test_step_threshold_overrides_glob(self):
+        summary = {'email': result(12000), 'login': result(6000)}
+        limits = ['*.p95=5000', 'email.p95=30000']
+        found = thresholds.violations(summary, limits, 0.01)
+        self.assertEqual(found, ['login p95 is 6000 ms, more than 5000 ms'])
+
+    def test_override_does_not_depend_on_order(self):
+        summary = {'email': result(12000)}
+        limits = ['email.p95=30000', '*.p95=5000']
+        self.assertEqual(thresholds.violations(summary, limits, 0.01), [])
+
+    def test_stricter_step_threshold_applies(self):
+        summary = {'latest': result(2000)}
+        limits = ['*.p95=5000', 'latest.p95=1500']
+        found = thresholds.violations(summary, limits, 0.01)
+        self.assertEqual(found, ['latest p95 is 2000 ms, more than 1500 ms'])
+
+    def test_error_rate(self):
+        summary = {'post': result(100, errors=5)}
+        found = thresholds.violations(summary, [], 0.01)
+        self.assertEqual(len(found), 1)
+        self.assertIn('post failed 5 of 100 times', found[0])
+
+    def test_invalid_threshold(self):
+        with self.assertRaises(ValueError):
+            thresholds.violations({}, ['login.p90=1000'], 0.01)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Percentiles and thresholds of the load test (see ./loadgen.py).
+#
+# Kept apart from the load generator and free of third-party imports, so that
+# it can be tested without aiohttp and requests (see ./test_thresholds.py).
+
+import fnmatch
+import math
+import re
+
+# Nearest-rank percentile of the sorted `values`.
+def percentile(values, q):
+    if not values:
+        return None
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+# How specific a threshold pattern is: a step name beats a glob pattern, and
+# of glob patterns, the one with more literal characters wins.
+def specificity(pattern):
+    literal = len(pattern) - sum(pattern.count(c) for c in '*?')
+    return (not any(c in pattern for c in '*?'), literal)
+
+# Check the `summary` against `thresholds` (a list of `step.pXX=milliseconds`
+# strings, where the step may be a glob pattern) and the maximum error rate.
+# A step is held only to the most specific threshold matching it for every
+# statistic, so e.g. `email.p95=30000` relaxes `*.p95=5000` for the email.
+# Returns the descriptions of the violations.
+def violations(summary, thresholds, max_error_rate):
+    # (step, statistic) -> (specificity, limit) of the applicable threshold.
+    limits = {}
+    for threshold in thresholds:
+        match = re.fullmatch(r'([\w*?]+)\.(p50|p95|p99|max)=(\d+(?:\.\d+)?)', threshold)
+        if match is None:
+            raise ValueError(f'Invalid threshold {threshold}, expected e.g. login.p95=2000')
+        pattern, statistic, limit = match.group(1), match.group(2), float(match.group(3))
+        for step in summary:
+            if not fnmatch.fnmatchcase(step, pattern):
+                continue
+            current = limits.get((step, statistic))
+            if current is None or specificity(pattern) >= current[0]:
+                limits[(step, statistic)] = (specificity(pattern), limit)
+
+    found = []
+    for (step, statistic), (_, limit) in limits.items():
+        value = summary[step][f'{statistic}_ms']
+        if value is not None and value > limit:
+            found.append(f'{step} {statistic} is {value} ms, more than {limit:g} ms')
+    for step, result in summary.items():
+        if result['error_rate'] > max_error_rate:
+            found.append(f'{step} failed {result["errors"]} of {result["count"]} times'
+                         f' ({result["error_rate"]:.1%}), the maximum error rate is {max_error_rate:.1%}')
+    return found
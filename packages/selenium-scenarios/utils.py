@@ -1,10 +1,18 @@
 import argparse
+import collections
+import concurrent.futures
 import contextlib
+import json
 import os
+import queue
 import sys
+import time
 
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver import Firefox
 from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.support.events import AbstractEventListener, EventFiringWebDriver
+from selenium.webdriver.support.ui import WebDriverWait
 
 class ArgumentsProvider:
     def __init__(self, description):
@@ -15,6 +23,9 @@ class ArgumentsProvider:
         self.parser.add_argument('--address',
                                  help='Discourse server address',
                                  default='http://server')
+        self.parser.add_argument('--performance-report', default=None,
+                                 help='Write the page load cost of every step'
+                                 ' to this file as JSON')
 
     # Expect password to be set as environment variable & username to be passed
     # as command line argument.
@@ -30,8 +41,10 @@ class ArgumentsProvider:
     def add_mailhog(self):
         self.parser.add_argument('--mailhog-address', default='http://server:8025')
 
-    def parse(self):
-        args = self.parser.parse_args()
+    # `argv` are the arguments to parse, by default the ones the program was
+    # run with.
+    def parse(self, argv=None):
+        args = self.parser.parse_args(argv)
 
         # If trailing slash is not present, add it.
         if not args.address.endswith('/'):
@@ -44,13 +57,15 @@ class ArgumentsProvider:
 
         return args
 
-@contextlib.contextmanager
-def webdriver(args, implicit_wait_seconds=10):
+def firefox(headless):
     options = Options()
-    if args.headless:
+    if headless:
         options.add_argument("--headless")
+    return Firefox(options)
 
-    driver = Firefox(options)
+@contextlib.contextmanager
+def webdriver(args, implicit_wait_seconds=10):
+    driver = firefox(args.headless)
 
     if implicit_wait_seconds is not None:
         # Wait up to `implicit_wait_seconds` for elements to appear.
@@ -61,4 +76,274 @@ def webdriver(args, implicit_wait_seconds=10):
     finally:
         driver.quit()
 
+# Lightweight page of Discourse (meant for health checks), used to get into
+# its origin without loading the whole application.
+STATUS_PATH = 'srv/status'
+
+# Make `driver` look like a freshly launched browser to the Discourse at
+# `address` (ending with a slash): forget its cookies and local storage and
+# leave its page. Cookies can only be deleted for the origin of the current
+# page, hence the visit of the status page.
+def reset(driver, address):
+    driver.get(f'{address}{STATUS_PATH}')
+    driver.delete_all_cookies()
+    driver.execute_script('window.localStorage.clear(); window.sessionStorage.clear();')
+    driver.get('about:blank')
+
+# Snapshot of the current page: its Navigation Timing entry, its paint
+# entries and all its Resource Timing entries (in the order they were
+# recorded). `timeOrigin` identifies the document. The resource timing buffer
+# (250 entries by default) is enlarged, so that a single-page application
+# like Discourse keeps recording the requests it makes while it is used.
+SNAPSHOT_SCRIPT = """
+performance.setResourceTimingBufferSize(100000);
+const navigation = performance.getEntriesByType('navigation')[0];
+const paint = performance.getEntriesByName('first-contentful-paint')[0];
+return {
+    url: location.href,
+    timeOrigin: performance.timeOrigin,
+    navigation: navigation ? navigation.toJSON() : null,
+    firstContentfulPaint: paint ? paint.startTime : null,
+    resources: performance.getEntriesByType('resource').map(entry => ({
+        type: entry.initiatorType,
+        transferSize: entry.transferSize,
+        encodedBodySize: entry.encodedBodySize,
+    })),
+};
+"""
+
+# Time (in milliseconds since the navigation) at which the Ember application
+# of Discourse has booted, i.e. rendered its main outlet and hidden the
+# loading splash, or null if it has not yet. Null on pages that are not the
+# application (they lack its setup data).
+INTERACTIVE_SCRIPT = """
+if (!document.getElementById('data-discourse-setup')) {
+    return -1;
+}
+const splash = document.getElementById('d-splash');
+const booted = document.getElementById('main-outlet') && (!splash || splash.offsetParent === null);
+return booted ? performance.now() : null;
+"""
+
+# How often the boot of the application is checked for, which is the
+# resolution of the measured time to interactive.
+INTERACTIVE_POLL_SECONDS = 0.05
+INTERACTIVE_TIMEOUT_SECONDS = 10
+
+# Page load cost of the steps of a scenario, read from the Navigation Timing
+# and Resource Timing APIs of the browser. A scenario marks the beginning of
+# every step with `step`. The timing entries are read at the end of every
+# step and before the driver leaves a page, and every page and request is
+# accounted to the step in which it was first seen. Pages loaded with
+# `driver.get` are also waited on until Discourse boots (see
+# `INTERACTIVE_SCRIPT`), which gives their time to interactive. Pages loaded
+# otherwise (e.g. by a redirect) have no time to interactive, since the
+# scenario itself waits for what it needs on them.
+#
+# It listens to the events of an `EventFiringWebDriver` (see `wrap`).
+class Performance(AbstractEventListener):
+    def __init__(self):
+        self.driver = None
+        self.steps = []
+        # timeOrigin of a document -> its page in the report.
+        self.pages = {}
+        # timeOrigin of a document -> number of its resources accounted.
+        self.seen_resources = collections.Counter()
+
+    # Wrap `driver`, so that the pages it loads are measured.
+    def wrap(self, driver):
+        self.driver = driver
+        return EventFiringWebDriver(driver, self)
+
+    def step(self, name):
+        self.finish()
+        self.steps.append({
+            'name': name,
+            'start': time.monotonic(),
+            'pages': [],
+            'requests': 0,
+            'transfer_bytes': 0,
+            'body_bytes': 0,
+            'by_type': {},
+        })
+
+    # End the current step, if any.
+    def finish(self):
+        if not self.steps or 'seconds' in self.steps[-1]:
+            return
+        self._collect()
+        step = self.steps[-1]
+        step['seconds'] = round(time.monotonic() - step.pop('start'), 3)
+
+    def report(self):
+        self.finish()
+        return {'steps': self.steps}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def before_navigate_to(self, url, driver):
+        self._collect()
+
+    def after_navigate_to(self, url, driver):
+        page = self._collect()
+        if page is None or page['interactive_ms'] is not None:
+            return
+        try:
+            interactive = WebDriverWait(driver, INTERACTIVE_TIMEOUT_SECONDS,
+                                        poll_frequency=INTERACTIVE_POLL_SECONDS) \
+                .until(lambda driver: driver.execute_script(INTERACTIVE_SCRIPT))
+        except (TimeoutException, WebDriverException):
+            return
+        if interactive >= 0:
+            page['interactive_ms'] = round(interactive, 1)
+
+    def _account(self, step, kind, transfer_size, body_size):
+        step['requests'] += 1
+        step['transfer_bytes'] += transfer_size
+        step['body_bytes'] += body_size
+        by_type = step['by_type'].setdefault(kind, {'count': 0, 'transfer_bytes': 0})
+        by_type['count'] += 1
+        by_type['transfer_bytes'] += transfer_size
+
+    # Account the pages and requests that appeared since the last time to the
+    # current step. Returns the page of the current document, or None if
+    # there is nothing to measure (no step, or a blank page).
+    def _collect(self):
+        if not self.steps or 'seconds' in self.steps[-1]:
+            return None
+        try:
+            snapshot = self.driver.execute_script(SNAPSHOT_SCRIPT)
+        except WebDriverException:
+            # E.g. a page that is still unloading.
+            return None
+        navigation = snapshot['navigation']
+        if navigation is None or not snapshot['url'].startswith('http'):
+            return None
+        step = self.steps[-1]
+        origin = snapshot['timeOrigin']
+        page = self.pages.get(origin)
+        if page is None:
+            milliseconds = lambda value: round(value, 1) if value else None
+            page = {
+                'url': snapshot['url'],
+                'ttfb_ms': milliseconds(navigation['responseStart']),
+                'dom_content_loaded_ms': milliseconds(navigation['domContentLoadedEventEnd']),
+                'load_ms': milliseconds(navigation['loadEventEnd']),
+                'first_contentful_paint_ms': milliseconds(snapshot['firstContentfulPaint']),
+                'interactive_ms': None,
+            }
+            self.pages[origin] = page
+            step['pages'].append(page)
+            self._account(step, 'navigation', navigation['transferSize'],
+                          navigation['encodedBodySize'])
+        resources = snapshot['resources']
+        for resource in resources[self.seen_resources[origin]:]:
+            self._account(step, resource['type'], resource['transferSize'],
+                          resource['encodedBodySize'])
+        self.seen_resources[origin] = len(resources)
+        return page
+
+# A scenario that can be run on its own (by its console script) or on a
+# driver from a `DriverPool` (by `run-scenarios`, see ./runner.py).
+# `add_arguments` adds the arguments of the scenario to an
+# `ArgumentsProvider`, `steps` runs the scenario on a driver with the parsed
+# arguments and a `Performance` to mark its steps with, and returns the exit
+# code (None meaning success).
+class Scenario:
+    def __init__(self, description, add_arguments, steps, implicit_wait_seconds=10):
+        self.description = description
+        self.add_arguments = add_arguments
+        self.steps = steps
+        self.implicit_wait_seconds = implicit_wait_seconds
+
+    def parse(self, argv=None, defaults={}):
+        provider = ArgumentsProvider(self.description)
+        self.add_arguments(provider)
+        provider.parser.set_defaults(**defaults)
+        return provider.parse(argv)
+
+    # Run the scenario on `driver`, which may have been used by another one,
+    # measuring its steps with `performance`. The measurements are written to
+    # the --performance-report file, if given.
+    def run(self, driver, args, performance=None):
+        if performance is None:
+            performance = Performance()
+        # Zero disables the implicit waits.
+        driver.implicitly_wait(self.implicit_wait_seconds or 0)
+        try:
+            return self.steps(performance.wrap(driver), args, performance)
+        finally:
+            performance.finish()
+            if args.performance_report is not None:
+                performance.write(args.performance_report)
+
+    # Console script entry point, launching a browser just for the scenario.
+    def main(self):
+        args = self.parse()
+        with webdriver(args, self.implicit_wait_seconds) as driver:
+            return self.run(driver, args)
+
+# Drivers launched once and shared by scenarios. Launching Firefox is the
+# most expensive part of a short scenario, so instead of relaunching it, a
+# driver is reset (see `reset`) when a scenario returns it to the pool. If the
+# reset fails (e.g. the browser crashed), the driver is replaced with a new
+# one, and if that fails too, the pool shrinks.
+class DriverPool:
+    def __init__(self, size, headless):
+        self.headless = headless
+        self.idle = queue.Queue()
+        self.drivers = []
+        # Launching in parallel takes as long as launching a single browser.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=size) as executor:
+            for driver in executor.map(firefox, [headless] * size):
+                self.drivers.append(driver)
+                self.idle.put(driver)
+
+    # Borrow a driver for the enclosed block, waiting for one to be idle.
+    # `address` is the Discourse the block visits, the state of the browser
+    # is reset for it afterwards.
+    @contextlib.contextmanager
+    def driver(self, address):
+        driver = self._acquire()
+        try:
+            yield driver
+        finally:
+            try:
+                reset(driver, address)
+            except Exception as e:
+                print(f'Resetting the browser failed ({e}), launching a new one')
+                driver = self._replace(driver)
+            if driver is not None:
+                self.idle.put(driver)
+
+    def _acquire(self):
+        while True:
+            if not self.drivers:
+                raise Exception('No browser is left in the pool')
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    # The new driver, or None if launching it failed.
+    def _replace(self, driver):
+        self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        try:
+            replacement = firefox(self.headless)
+        except Exception as e:
+            print(f'Launching a new browser failed ({e})')
+            return None
+        self.drivers.append(replacement)
+        return replacement
+
+    def close(self):
+        for driver in self.drivers:
+            driver.quit()
+
 
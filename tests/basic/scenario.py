@@ -1,5 +1,20 @@
 # See https://nixos.org/manual/nixos/stable/#ssec-machine-objects for
 # documentation of methods available on `server` and `client` objects.
+#
+# Independent checks run one after another, each on a client VM of its own
+# (see `clients` in ./setup.nix), so that they do not share browser state.
+# The machines boot in parallel, which is where most of the time goes. The
+# checks are not run in parallel themselves, as the methods of the machines
+# (and the nesting of their logs) are not safe to use from several threads,
+# and some checks change the configuration of the shared server. Checks never
+# share users or mailboxes (see `unique_user`). Every step is timed, and a
+# summary of the timings is printed at the end.
+
+import contextlib
+import itertools
+import json
+import shlex
+import time
 
 start_all()
 
@@ -12,63 +27,140 @@ server.wait_for_unit("discourse.service")
 api_key = server.succeed("cat /var/lib/discourse/api/key")
 api_key = api_key[:-1] # Remove the trailing newline.
 
-# Verify that the admin user is able to log in.
-# `verify-login` is a script provided by the `selenium-scenarios` package.
-client.succeed(
-    "verify-login"
-    " --address http://server"
-    " --username \"$USERNAME\""
-    " --headless"
-)
-
-# Verify it is possible to register a new user with a email address from
-# the trusted students.mimuw.edu.pl domain.
-# `registration` is a script provided by the `selenium-scenarios` package.
-client.succeed(
-    "registration"
-    " --address http://server"
-    " --mailhog-address http://server:8025"
-    " --name \"Duży Pudzian\""
-    " --username pudzian5"
-    " --email duzypudzian5@students.mimuw.edu.pl"
-    " --headless"
-)
-
-# Verify that the newly registered user is in the students group.
-# `user-in-group` is a script provided by the `applier` package.
-client.succeed(
-    f"env DISCOURSE_API_KEY='{api_key}'"
-    " user-in-group http://server pudzian5 students"
-)
-
-# Change the group configuration (group name: students -> studenciaki).
-# Leveraging the fact that `applier` saves the current configuration as an
-# attribute in its store, we can use `jq` to extract it, change it and save it
-# for later use as an configuration input to `applier`.
-server.succeed(
-    "jq '.config | .groups.students.name = \"studenciaki\"' /var/lib/discourse/api/nix_to_discourse_ids.json > /changed.json"
-)
-server.succeed(
-    f"env DISCOURSE_API_KEY='{api_key}'"
-    " applier http://server /changed.json /var/lib/discourse/api"
-)
-
-# Validate that the group configuration has changed.
-client.succeed(
-    f"env DISCOURSE_API_KEY='{api_key}'"
-    " user-in-group http://server pudzian5 studenciaki"
-)
-
-# Given a user with a non-student email address, registration should fail.
-status, output = client.execute(
-    "registration"
-    " --address http://server"
-    " --mailhog-address http://server:8025"
-    " --name \"Mały Pudzian\""
-    " --username malypudzian2"
-    " --email malypudzian@amorek.pl" # (not a student email)
-    " --headless"
-    " 2>&1"
-)
-assert status != 0
-assert ("Exception: Registration requires manual approval" in output)
+clients = sorted((machine for machine in machines if machine.name.startswith("client")),
+                 key=lambda machine: machine.name)
+for client in clients:
+    client.wait_for_unit("multi-user.target")
+
+# (check, step, seconds) of every finished step.
+timings = []
+
+@contextlib.contextmanager
+def step(check, name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings.append((check, name, time.monotonic() - start))
+
+user_numbers = itertools.count(1)
+
+# A username no other check uses, and its mailbox (with an email address from
+# the trusted students.mimuw.edu.pl domain, unless `domain` is given).
+def unique_user(prefix, domain="students.mimuw.edu.pl"):
+    username = f"{prefix}{next(user_numbers)}"
+    return username, f"{username}@{domain}"
+
+# Run browser scenarios on `client` with `run-scenarios` (a script provided
+# by the `selenium-scenarios` package).
+def run_scenarios(client, scenarios):
+    client.succeed(
+        f"echo {shlex.quote(json.dumps(scenarios))} | run-scenarios -"
+        " --address http://server"
+        " --mailhog-address http://server:8025"
+        " --drivers 1"
+        " --headless"
+        " --report /tmp/scenarios.json"
+    )
+    # Print the page load cost of every step into the log of the check, to
+    # see the effect of changes to the site settings and plugins.
+    print(client.succeed("jq -c '.scenarios[] | {name, performance}' /tmp/scenarios.json"))
+
+# Verify that `username` is in `group`. `user-in-group` is a script provided
+# by the `applier` package.
+def assert_in_group(client, username, group):
+    client.succeed(
+        f"env DISCOURSE_API_KEY='{api_key}'"
+        f" user-in-group http://server {username} {group}"
+    )
+
+# The admin user is able to log in.
+def check_login(client, check):
+    with step(check, "log in"):
+        run_scenarios(client, [
+            {
+                "scenario": "verify-login",
+                "args": {"username": client.succeed("echo -n \"$USERNAME\"")},
+            },
+        ])
+
+# It is possible to register a new user with an email address from the
+# trusted students.mimuw.edu.pl domain, the user ends up in the students
+# group, and the group follows changes to its configuration.
+def check_student_registration(client, check):
+    username, email = unique_user("pudzian")
+    with step(check, "register"):
+        run_scenarios(client, [
+            {
+                "name": "registration of a student",
+                "scenario": "registration",
+                "args": {"name": "Duży Pudzian", "username": username, "email": email},
+            },
+        ])
+
+    with step(check, "check group"):
+        assert_in_group(client, username, "students")
+
+    # Change the group configuration (group name: students -> studenciaki).
+    # Leveraging the fact that `applier` saves the definitions of the applied
+    # entities in its SQLite store, we can use `sqlite3` to reassemble the
+    # current configuration and `jq` to change it and save it for later use as
+    # an configuration input to `applier`.
+    with step(check, "rename group"):
+        server.succeed(
+            "sqlite3 /var/lib/discourse/api/state.sqlite3"
+            " \"SELECT json_group_object(kind, json(entities)) FROM"
+            " (SELECT kind, json_group_object(attr, json(definition)) AS entities"
+            " FROM entities WHERE definition IS NOT NULL GROUP BY kind)\""
+            " | jq '.groups.students.name = \"studenciaki\"' > /changed.json"
+        )
+        server.succeed(
+            f"env DISCOURSE_API_KEY='{api_key}'"
+            " applier http://server /changed.json /var/lib/discourse/api"
+        )
+
+    # Validate that the group configuration has changed.
+    with step(check, "check renamed group"):
+        assert_in_group(client, username, "studenciaki")
+
+# Given a user with a non-student email address, registration fails.
+def check_non_student_registration(client, check):
+    username, email = unique_user("malypudzian", domain="amorek.pl")
+    with step(check, "register"):
+        run_scenarios(client, [
+            {
+                "name": "registration of a non-student",
+                "scenario": "registration",
+                "args": {"name": "Mały Pudzian", "username": username, "email": email},
+                "expect_error": "Registration requires manual approval",
+            },
+        ])
+
+# Checks by their names, in the order they run in. The student registration
+# renames a group on the server, so it runs last.
+checks = {
+    "login": check_login,
+    "non-student registration": check_non_student_registration,
+    "student registration": check_student_registration,
+}
+assert len(checks) <= len(clients), "every check needs a client of its own"
+
+failed = []
+start = time.monotonic()
+for check, client in zip(checks, clients):
+    with client.nested(f"check: {check} (on {client.name})"):
+        try:
+            with step(check, "total"):
+                checks[check](client, check)
+        except Exception as exception:
+            failed.append((check, exception))
+wall_seconds = time.monotonic() - start
+
+print("Timings of the checks:")
+for check, name, seconds in timings:
+    print(f"{check:>25} {name:<20} {seconds:>7.1f}s")
+print(f"The checks took {wall_seconds:.1f}s.")
+
+for check, exception in failed:
+    print(f"Check {check} failed: {exception!r}")
+assert not failed, f"{len(failed)} of {len(checks)} checks failed"
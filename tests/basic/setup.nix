@@ -11,23 +11,30 @@
       environment.systemPackages = [
         self.packages.x86_64-linux.applier
         pkgs.jq
+        pkgs.sqlite
       ];
     };
+  } // builtins.listToAttrs (builtins.genList
+    (i: {
+      # Every check of the scenario runs on a client VM of its own (see
+      # ./scenario.py), a new one only costs its boot, which happens
+      # alongside the server's.
+      name = "client${toString (i + 1)}";
+      value = { self, nodes, pkgs, ... }: {
+        environment.systemPackages = [
+          self.packages.x86_64-linux.selenium-scenarios
+          self.packages.x86_64-linux.applier
+          pkgs.jq
+        ];
 
-    client = { self, nodes, pkgs, ... }: {
-      environment.systemPackages = [
-        self.packages.x86_64-linux.selenium-scenarios
-        self.packages.x86_64-linux.applier
-      ];
-
-      # This leaks the password into the store, but it is already in the store
-      # by self.nixosModules.test anyway.
-      environment.sessionVariables = {
-        PASSWORD = builtins.readFile nodes.server.services.discourse.admin.passwordFile;
-        USERNAME = nodes.server.services.discourse.admin.username;
+        # This leaks the password into the store, but it is already in the
+        # store by self.nixosModules.test anyway.
+        environment.sessionVariables = {
+          PASSWORD = builtins.readFile nodes.server.services.discourse.admin.passwordFile;
+          USERNAME = nodes.server.services.discourse.admin.username;
+        };
       };
-    };
-  };
+    }) 3);
 
   testScript = builtins.readFile ./scenario.py;
 }
@@ -0,0 +1,41 @@
+# See https://nixos.org/manual/nixos/stable/#ssec-machine-objects for
+# documentation of methods available on `server` and `client` objects.
+
+# Fixed load of the test. It approximates the signups at the start of a term,
+# the thresholds are the latencies (in milliseconds) students are expected to
+# put up with. A threshold of a step overrides the `*` one for that step.
+USERS = 500
+CONCURRENCY = 100
+RAMP_UP_SECONDS = 30
+THRESHOLDS = [
+    "*.p95=5000",
+    "login.p99=5000",
+    "latest.p95=1500",
+    "post.p95=3000",
+    # Activation emails are sent by Sidekiq, which falls behind first.
+    "email.p95=30000",
+]
+
+start_all()
+
+server.wait_for_unit("discourse.service")
+client.wait_for_unit("multi-user.target")
+
+# `load-test` is a script provided by the `selenium-scenarios` package. It
+# fails when any of the thresholds is exceeded or when more than 1% of the
+# attempts of any step fail. The report is printed either way, so that it ends
+# up in the log of the check.
+status, output = client.execute(
+    "load-test"
+    " --address http://server"
+    " --mailhog-address http://server:8025"
+    f" --users {USERS}"
+    f" --concurrency {CONCURRENCY}"
+    f" --ramp-up {RAMP_UP_SECONDS}"
+    + "".join(f" --threshold {threshold}" for threshold in THRESHOLDS)
+    + " --max-error-rate 0.01"
+    " --report /tmp/load-report.json"
+)
+print(output)
+print(client.succeed("cat /tmp/load-report.json"))
+assert status == 0, "The load test exceeded its thresholds"
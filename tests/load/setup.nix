@@ -0,0 +1,42 @@
+(import ../lib.nix) {
+  name = "Discourse load test";
+
+  nodes = {
+    server = { self, ... }: {
+      imports = [
+        self.nixosModules.test
+      ];
+
+      # All the virtual users of the load test come from the client's address,
+      # so the limits Discourse puts on a single IP address are lifted.
+      services.discourse.backendSettings = {
+        max_reqs_per_ip_mode = "none";
+        max_reqs_rate_limit_on_private = false;
+      };
+      services.discourse.siteSettings = {
+        spam.max_new_accounts_per_registration_ip = 100000;
+        rate_limits = {
+          max_logins_per_ip_per_minute = 100000;
+          max_logins_per_ip_per_hour = 100000;
+          # New users may post their first topic right away.
+          rate_limit_create_topic = 0;
+          rate_limit_new_user_create_topic = 0;
+        };
+      };
+    };
+
+    client = { self, ... }: {
+      environment.systemPackages = [
+        self.packages.x86_64-linux.selenium-scenarios
+      ];
+
+      # Thousands of concurrent connections need more file descriptors than
+      # the default limit allows.
+      security.pam.loginLimits = [
+        { domain = "*"; type = "-"; item = "nofile"; value = "65536"; }
+      ];
+    };
+  };
+
+  testScript = builtins.readFile ./scenario.py;
+}